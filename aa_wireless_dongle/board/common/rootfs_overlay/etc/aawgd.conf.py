@@ -13,3 +13,106 @@ os.environ["AAWG_CONNECTION_STRATEGY"] = "1"
 # Override bluetooth name suffix
 # Set a custom suffix to replace unique id used in "WirelessAADongle-<suffix>" or "AndroidAuto-Dongle-<suffix>"
 # os.environ["AAWG_UNIQUE_NAME_SUFFIX"] = ""
+
+# Select the proxy forwarding engine
+# copy   - (default) Read into userspace and write out again on two forwarding threads.
+# splice - Move data through a kernel pipe with splice(), falling back to copy for fds that don't support it.
+# epoll  - Forward both directions from a single epoll loop with non-blocking fds.
+# os.environ["AAWG_PROXY_ENGINE"] = "copy"
+
+# Follow Android Auto frame boundaries in the forwarded streams and count frames per channel
+# Not available with the splice engine, where data never enters userspace.
+# os.environ["AAWG_PROXY_PARSE_FRAMES"] = "1"
+
+# Write queued phone frames to the head unit by channel priority (control/input, then audio, then video)
+# Requires the epoll engine. Encrypted frames are never reordered relative to each other.
+# os.environ["AAWG_PROXY_PRIORITIZE"] = "1"
+
+# Proxy metrics (bytes, stalls, latency histograms) in Prometheus text format
+# The file is rewritten every AAWG_METRICS_INTERVAL seconds, set an empty path to disable it.
+# os.environ["AAWG_METRICS_FILE"] = "/run/aawgd/metrics.prom"
+# os.environ["AAWG_METRICS_INTERVAL"] = "10"
+
+# Let the proxy read size grow during video bursts and shrink again for interactive traffic
+# os.environ["AAWG_PROXY_ADAPTIVE_READS"] = "1"
+
+# Socket options applied to the phone's TCP connection, the applied values are reported in the metrics
+# Buffer sizes of 0 keep the kernel's autotuning, a TCP_NOTSENT_LOWAT of 0 keeps the kernel default.
+# os.environ["AAWG_PROXY_TCP_NODELAY"] = "1"
+# os.environ["AAWG_PROXY_TCP_QUICKACK"] = "1"
+# os.environ["AAWG_PROXY_TCP_NOTSENT_LOWAT"] = "16384"
+# os.environ["AAWG_PROXY_SO_RCVBUF"] = "0"
+# os.environ["AAWG_PROXY_SO_SNDBUF"] = "0"
+
+# Select how the daemon runs its session lifecycle
+# threads - (default) One thread each for uevents, the proxy and the bluetooth retry loop.
+# asyncio - Uevents, the proxy and the bluetooth retry loop share one asyncio loop, and a new session
+#           starts as soon as the UDC has detached instead of after a fixed 2 second sleep.
+#           Forwarding always uses the event loop, AAWG_PROXY_ENGINE is ignored.
+# os.environ["AAWG_ORCHESTRATOR"] = "threads"
+
+# Bluetooth reconnects try the most recently connected phones first, the history is kept in this file
+# os.environ["AAWG_BT_HISTORY_FILE"] = "/persist/aawgd/bluetooth_devices.json"
+# Seconds before a connection attempt to a phone is given up
+# os.environ["AAWG_BT_CONNECT_TIMEOUT"] = "10"
+# Connection attempts in flight at once. BlueZ pages one device at a time, so keep this small.
+# os.environ["AAWG_BT_PARALLEL_CONNECTS"] = "2"
+
+# Seconds the phone gets to finish the Wi-Fi credential exchange over bluetooth
+# os.environ["AAWG_BT_HANDSHAKE_TIMEOUT"] = "15"
+
+# Timeline of every session's phases (init, bluetooth, handshake, accept, USB switch, first write)
+# One JSON line is appended per session, set an empty path to disable it.
+# Send SIGUSR1 to write the last sessions to AAWG_TRACE_CHROME_FILE for chrome://tracing or Perfetto.
+# os.environ["AAWG_TRACE_FILE"] = "/run/aawgd/sessions.jsonl"
+# os.environ["AAWG_TRACE_CHROME_FILE"] = "/run/aawgd/trace.json"
+
+# Log messages are written to syslog and stderr by a background thread
+# Messages queued beyond 3/4 of the queue size are sampled, a full queue drops them; the number
+# dropped is logged and exported as aawg_log_dropped_total.
+# os.environ["AAWG_LOG_QUEUE_SIZE"] = "1024"
+# Also write debug messages
+# os.environ["AAWG_LOG_DEBUG"] = "0"
+
+# Comma separated ACTION@DEVPATH prefixes of the uevents the daemon listens to, empty for all
+# Other uevents are dropped in the kernel by a socket filter.
+# os.environ["AAWG_UEVENT_FILTER"] = "change@/devices/virtual/misc/usb_accessory"
+
+# Location of configfs gadgets and UDCs, e.g. to run against a fake configfs
+# os.environ["AAWG_USB_GADGET_PATH"] = "/sys/kernel/config/usb_gadget"
+# os.environ["AAWG_USB_UDC_PATH"] = "/sys/class/udc"
+# Longest wait for the UDC to detach when switching from the default to the accessory gadget
+# os.environ["AAWG_USB_SWITCH_TIMEOUT_MS"] = "100"
+
+# Capture the forwarded traffic of each session to a new file in this directory, empty to disable
+# Replay a capture on a dev box with: python3 -m bench.replay <file>
+# Data that doesn't fit into the buffers while the disk is busy is dropped and exported as
+# aawg_capture_dropped_bytes_total. Not available with the splice engine.
+# os.environ["AAWG_CAPTURE_DIR"] = ""
+# os.environ["AAWG_CAPTURE_BUFFER_KB"] = "256"
+# os.environ["AAWG_CAPTURE_BUFFERS"] = "8"
+
+# Send SIGHUP to aawgd to apply changes to this file without restarting it
+# A connected phone stays connected, new values apply to the next session. The file is only applied if all
+# values are valid. AAWG_ORCHESTRATOR, AAWG_PROXY_ENGINE, AAWG_PROXY_PORT, AAWG_PROXY_ENDPOINTS, the metrics,
+# trace and log options, AAWG_BT_HISTORY_FILE, AAWG_UEVENT_FILTER and the USB gadget and UDC paths need a
+# restart, options removed from the file keep their value until the next restart.
+# Location of this file for reloads
+# os.environ["AAWG_CONF_FILE"] = "/etc/aawgd.conf.py"
+
+# Comma separated accessory endpoints to serve several phones at once, e.g. on a test stand
+# Each client connecting to AAWG_PROXY_PORT gets the first free endpoint, one arriving while all are busy
+# is closed. Bluetooth and USB gadgets are left alone in this mode. Empty for the normal single phone mode.
+# os.environ["AAWG_PROXY_ENDPOINTS"] = ""
+
+# Forwarding watchdog, ends a session that stopped making progress so a fresh one can start, 0 disables a check
+# Idle: milliseconds a direction may go without reading anything once its first data arrived, e.g. a phone that left the WiFi without a FIN
+# Stall: milliseconds data may stay queued without the destination taking any of it
+# TCP_USB is the phone to head unit direction, USB_TCP the other one.
+# os.environ["AAWG_WATCHDOG_TCP_USB_IDLE_MS"] = "30000"
+# os.environ["AAWG_WATCHDOG_TCP_USB_STALL_MS"] = "10000"
+# os.environ["AAWG_WATCHDOG_USB_TCP_IDLE_MS"] = "30000"
+# os.environ["AAWG_WATCHDOG_USB_TCP_STALL_MS"] = "10000"
+# Milliseconds a peer may stay half-closed before the session is ended, it normally ends through EOF right away
+# Teardowns, their duration and the time until the next session forwards are exported as aawg_watchdog_*.
+# os.environ["AAWG_WATCHDOG_HALF_CLOSE_MS"] = "1000"
@@ -1,13 +1,24 @@
+import sys
+
+from startupProfile import ImportProfiler
+# Installed before anything else is imported, so every import is measured
+import_profiler = ImportProfiler.install() if "--profile-startup" in sys.argv else None
+
+import importlib
+import os
 import threading
 import time
 import signal
-from typing import Optional
+from typing import List, Optional
 
-from common import Logger, Config, ConnectionStrategy
+from common import Logger, Config, ConnectionStrategy, Orchestrator
 from bluetoothHandler import BluetoothHandler
 from proxyHandler import ProxyHandler
+from proxyMetrics import MetricsExporter
 from usb import UsbHandler
 from uevent import UeventHandler
+from sessionTrace import SessionTracer
+from startupGraph import StartupGraph
 
 class AAWG:
     def __init__(self):
@@ -15,19 +26,55 @@ class AAWG:
         self.bluetooth_handler = BluetoothHandler()
         self.proxy_handler = ProxyHandler()
         self.usb_handler = UsbHandler()
-        self.uevent_handler = UeventHandler()
+        self.uevent_handler = UeventHandler.instance()
         self.running = False
         self.uevent_thread = None
+        self.metrics_exporter: Optional[MetricsExporter] = None
+        self.teardown_thread: Optional[threading.Thread] = None
+        self.accessory_ready = threading.Event()
+        self.tracer = SessionTracer.instance()
+        
+        # Stop bluetooth retry when TCP connected
+        self.proxy_handler.on_client_connected = self.bluetooth_handler.stop_connect_with_retry
+        # A phone may connect while the previous session is torn down
+        self.proxy_handler.wait_accessory_ready = self.accessory_ready.wait
+        # A stuck f_accessory read or write only returns once the gadget is gone
+        self.proxy_handler.on_watchdog_expired = self.usb_handler.disable_gadget
         
     def init(self):
         # Global initialization
-        self.uevent_thread = self.uevent_handler.start()
-        self.usb_handler.init()
-        self.bluetooth_handler.init()
+        with self.tracer.span("init"):
+            self.uevent_thread = self.uevent_handler.start()
+            self.init_handlers()
+            if self.metrics_exporter:
+                self.metrics_exporter.start()
+            
+    def init_handlers(self):
+        """Initialize the handlers, without starting any threads
         
+        Independent steps run in parallel, e.g. staging the USB gadgets while
+        BlueZ registers the profiles, and the critical path is logged at the end.
+        """
         strategy = Config.instance().get_connection_strategy()
+        graph = StartupGraph()
+        graph.add("usb_init", self.usb_handler.init)
+        graph.add("bluetooth_start", self.bluetooth_handler.start)
+        graph.add("bluetooth_alias", self.bluetooth_handler.configure_adapter, requires=["bluetooth_start"])
+        graph.add("bluetooth_profiles", self.bluetooth_handler.export_profiles, requires=["bluetooth_start"])
+        # The socket stays open across sessions, so the first one doesn't have to bind it
+        graph.add("proxy_listen", lambda: self.proxy_handler.listen(Config.instance().get_wifi_info().port))
+        graph.add("metrics_init", self._init_metrics)
         if strategy == ConnectionStrategy.DONGLE_MODE:
-            self.bluetooth_handler.power_on()
+            # The phone must find the profiles and the alias once the adapter is discoverable
+            graph.add("dongle_power_on", self.bluetooth_handler.power_on,
+                      requires=["bluetooth_alias", "bluetooth_profiles"])
+        graph.run()
+        
+    def _init_metrics(self):
+        metrics_path = Config.instance().get_env("AAWG_METRICS_FILE", "/run/aawgd/metrics.prom")
+        if metrics_path:
+            interval = Config.instance().get_env("AAWG_METRICS_INTERVAL", 10)
+            self.metrics_exporter = MetricsExporter(metrics_path, interval, self.proxy_handler.metrics.render)
             
     def run(self):
         self.running = True
@@ -37,24 +84,49 @@ class AAWG:
             strategy = Config.instance().get_connection_strategy()
             self.logger.info(f"Connection Strategy: {strategy}")
             
-            if strategy == ConnectionStrategy.USB_FIRST:
-                self.logger.info("Waiting for accessory to connect first")
-                self.usb_handler.enable_default_and_wait_for_accessory()
-                
-            # Get WifiInfo object and access port attribute directly
+            # Accept right away, the session waits for accessory_ready
+            # before it touches the USB accessory
+            self.accessory_ready.clear()
             wifi_info = Config.instance().get_wifi_info()
             proxy_thread = self.proxy_handler.start_server(wifi_info.port)
                 
             if not proxy_thread:
                 return 1
                 
-            if strategy != ConnectionStrategy.DONGLE_MODE:
-                self.bluetooth_handler.power_on()
+            with self.tracer.span("wait_for_teardown"):
+                self._wait_for_teardown()
+                
+            if strategy == ConnectionStrategy.USB_FIRST:
+                self.logger.info("Waiting for accessory to connect first")
+                with self.tracer.span("wait_for_accessory"):
+                    self.usb_handler.enable_default_and_wait_for_accessory()
                 
-            bt_thread = self.bluetooth_handler.connect_with_retry()
+            self.accessory_ready.set()
             
+            # A phone connecting from here on stops the retry loop, even one that hasn't started yet
+            self.bluetooth_handler.reset_connect_retry()
+            # The phone may have reconnected on its own already, then the adapter stays off
+            bt_thread = None
+            if not self.proxy_handler.client_connected.is_set():
+                if strategy != ConnectionStrategy.DONGLE_MODE:
+                    self.bluetooth_handler.power_on()
+                # Powers the adapter off again once it stops
+                bt_thread = self.bluetooth_handler.connect_with_retry()
+                
             proxy_thread.join()
+            self.tracer.next_session()
+            
+            self.teardown_thread = threading.Thread(target=self._teardown_session,
+                                                    args=(strategy, bt_thread), name="SessionTeardown")
+            self.teardown_thread.start()
+            
+        self._wait_for_teardown()
+        if self.uevent_thread:
+            self.uevent_thread.join()
             
+    def _teardown_session(self, strategy: ConnectionStrategy, bt_thread: Optional[threading.Thread]):
+        """Tear down a finished session while the proxy accepts the next one"""
+        with self.tracer.span("session_teardown"):
             if bt_thread:
                 self.bluetooth_handler.stop_connect_with_retry()
                 bt_thread.join()
@@ -63,25 +135,119 @@ class AAWG:
             
             if strategy != ConnectionStrategy.DONGLE_MODE:
                 time.sleep(2)
-                
-        if self.uevent_thread:
-            self.uevent_thread.join()
-
+            
+    def _wait_for_teardown(self):
+        if self.teardown_thread:
+            self.teardown_thread.join()
+            self.teardown_thread = None
+            
     def cleanup(self, signum, frame):
         self.logger.info("Received signal to shutdown")
         self.running = False
+        # Wakes up a session waiting for the accessory or a phone
+        self.accessory_ready.set()
+        if self.proxy_handler:
+            self.proxy_handler.close_server()
         if self.bluetooth_handler:
             self.bluetooth_handler.cleanup()
         if self.usb_handler:
             self.usb_handler.cleanup()
+        if self.metrics_exporter:
+            self.metrics_exporter.stop()
+
+# Written by start-stop-daemon in S93aawgd
+DAEMON_PIDFILE = "/var/run/aawgd.pid"
+
+def daemon_running() -> bool:
+    """Check whether a daemon started by the init script is running"""
+    try:
+        with open(DAEMON_PIDFILE) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except (OSError, ValueError):
+        return False
+    return pid != os.getpid()
 
+def profile_startup(aawg: AAWG) -> int:
+    """Initialize the handlers once, report what the imports and the initialization cost and exit
+    
+    The initialization is the real one: it binds the proxy port, registers
+    the bluetooth profiles, powers on the adapter in dongle mode and
+    disables the USB gadgets on exit. It must not run next to a running
+    daemon, so it refuses to start while the init script's daemon is up.
+    """
+    if daemon_running():
+        Logger("AAWG").error(f"aawgd is running (see {DAEMON_PIDFILE}), stop it before profiling the startup")
+        return 1
+        
+    if Config.instance().get_orchestrator() == Orchestrator.ASYNCIO:
+        # Imported only to be measured, the orchestrator loads it at startup in this mode
+        importlib.import_module("asyncOrchestrator")
+        
+    started = time.monotonic()
+    aawg.init_handlers()
+    init_time = time.monotonic() - started
+    import_profiler.uninstall()
+    import_profiler.report(sys.stdout, init_time)
+    aawg.cleanup(None, None)
+    return 0
+
+def serve_endpoints(paths: List[str]) -> int:
+    """Forward the sessions of several clients to a set of accessory endpoints, without bluetooth or USB gadgets"""
+    from sessionManager import SessionManager
+    manager = SessionManager(paths)
+    if not manager.start(Config.instance().get_wifi_info().port):
+        return 1
+        
+    exporter = None
+    metrics_path = Config.instance().get_env("AAWG_METRICS_FILE", "/run/aawgd/metrics.prom")
+    if metrics_path:
+        exporter = MetricsExporter(metrics_path, Config.instance().get_env("AAWG_METRICS_INTERVAL", 10),
+                                   manager.render_metrics)
+        exporter.start()
+        
+    stopping = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    stopping.wait()
+    
+    Logger("AAWG").info("Received signal to shutdown")
+    manager.stop()
+    if exporter:
+        exporter.stop()
+    return 0
+    
 def main():
     """Main entry point for the daemon"""
+    endpoints = Config.instance().get_env("AAWG_PROXY_ENDPOINTS", "")
+    if endpoints:
+        return serve_endpoints([path.strip() for path in endpoints.split(",") if path.strip()])
+        
     aawg = AAWG()
     
+    if import_profiler:
+        return profile_startup(aawg)
+        
+    if Config.instance().get_orchestrator() == Orchestrator.ASYNCIO:
+        # asyncio is a large import that only this mode needs
+        import asyncio
+        from asyncOrchestrator import AsyncOrchestrator
+        try:
+            return asyncio.run(AsyncOrchestrator(aawg).run())
+        except Exception as e:
+            Logger("AAWG").error(f"Fatal error: {e}")
+            return 1
+            
     # Set up signal handlers
     signal.signal(signal.SIGINT, aawg.cleanup)
     signal.signal(signal.SIGTERM, aawg.cleanup)
+    # Write the trace off the signal handler, which may interrupt a thread holding the tracer's lock
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(
+        target=aawg.tracer.write_chrome_trace, name="TraceWriter").start())
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=Config.instance().reload, name="ConfigReload").start())
     
     try:
         return aawg.run()
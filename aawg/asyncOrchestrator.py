@@ -0,0 +1,207 @@
+import asyncio
+import signal
+import socket
+import time
+from typing import Optional
+
+from common import Logger, Config, ConnectionStrategy
+from uevent import NETLINK_MSG_SIZE
+from usb import UsbGadgetConfig, UDC_DETACHED_STATES, MIN_SWITCH_DELAY
+from sessionTrace import SessionTracer
+
+# Upper bound for the wait on the UDC to detach between sessions
+UDC_DETACH_TIMEOUT = 2.0
+UDC_POLL_INTERVAL = 0.01
+
+class AsyncOrchestrator:
+    """Runs the AAWG session lifecycle as coroutines on one asyncio loop
+    
+    Uevents, the TCP accept, forwarding and the bluetooth retry share the
+    loop's thread. D-Bus calls run on the GLib main loop thread, and only an
+    fd that can't be polled (f_accessory) gets a blocking reader thread.
+    """
+    
+    def __init__(self, aawg):
+        self.logger = Logger("AsyncOrchestrator")
+        self.aawg = aawg
+        self.running = False
+        self.main_task: Optional[asyncio.Task] = None
+        self.retry_task: Optional[asyncio.Task] = None
+        self.uevent_sock: Optional[socket.socket] = None
+        self.tracer = SessionTracer.instance()
+        
+        # Stop bluetooth retry when TCP connected
+        self.aawg.proxy_handler.on_client_connected = self._on_client_connected
+        
+    async def run(self) -> int:
+        loop = asyncio.get_running_loop()
+        self.running = True
+        self.main_task = asyncio.current_task()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop, signum)
+        loop.add_signal_handler(signal.SIGUSR1, self.tracer.write_chrome_trace)
+        # Reloading runs the configuration file and may call BlueZ
+        loop.add_signal_handler(signal.SIGHUP, loop.run_in_executor, None, Config.instance().reload)
+            
+        # Global initialization
+        self._start_uevents(loop)
+        self.aawg.init_handlers()
+        metrics_task = None
+        if self.aawg.metrics_exporter:
+            metrics_task = asyncio.create_task(self._export_metrics())
+            
+        teardown: Optional[asyncio.Task] = None
+        try:
+            while self.running:
+                teardown = await self._run_session(teardown)
+                if not teardown:
+                    return 1
+        except asyncio.CancelledError:
+            self.logger.info("Session loop stopped")
+        finally:
+            self.aawg.proxy_handler.close_server()
+            if metrics_task:
+                metrics_task.cancel()
+                self.aawg.metrics_exporter.export()
+            self._stop_uevents(loop)
+        return 0
+        
+    async def _run_session(self, previous_teardown: Optional[asyncio.Task]) -> Optional[asyncio.Task]:
+        """Run one phone session
+        
+        Returns:
+            The task tearing the session down, or None if the proxy could not start
+        """
+        strategy = Config.instance().get_connection_strategy()
+        self.logger.info(f"Connection Strategy: {strategy}")
+        
+        wifi_info = Config.instance().get_wifi_info()
+        server_sock = self.aawg.proxy_handler.listen(wifi_info.port)
+        if not server_sock:
+            return None
+            
+        # Accept right away, the session waits for accessory_ready
+        # before it touches the USB accessory
+        accessory_ready = asyncio.Event()
+        session = asyncio.create_task(self.aawg.proxy_handler.serve_async(server_sock, accessory_ready))
+        try:
+            if previous_teardown:
+                waiting = time.monotonic()
+                await previous_teardown
+                self.tracer.record("wait_for_teardown", waiting)
+                
+            if strategy == ConnectionStrategy.USB_FIRST:
+                self.logger.info("Waiting for accessory to connect first")
+                waiting = time.monotonic()
+                await self._wait_for_accessory()
+                self.tracer.record("wait_for_accessory", waiting)
+                
+            accessory_ready.set()
+            
+            # A phone connecting from here on stops the retry loop, even one that hasn't started yet
+            self.aawg.bluetooth_handler.reset_connect_retry()
+            # The phone may have reconnected on its own already, then the adapter stays off
+            if not self.aawg.proxy_handler.client_connected.is_set():
+                if strategy != ConnectionStrategy.DONGLE_MODE:
+                    self.aawg.bluetooth_handler.power_on()
+                # Powers the adapter off again once it stops
+                self.retry_task = asyncio.create_task(self.aawg.bluetooth_handler.retry_connect_async())
+            await session
+        finally:
+            session.cancel()
+            await self._stop_retry()
+            self.tracer.next_session()
+            
+        return asyncio.create_task(self._teardown_session(strategy))
+        
+    async def _teardown_session(self, strategy: ConnectionStrategy):
+        """Tear down a finished session while the proxy accepts the next one"""
+        started = time.monotonic()
+        self.aawg.usb_handler.disable_gadget()
+        
+        # Start over as soon as the host has seen the gadget go away
+        if strategy != ConnectionStrategy.DONGLE_MODE:
+            await self._wait_for_udc_detached()
+        self.tracer.record("session_teardown", started)
+        
+    def _on_client_connected(self):
+        self.aawg.bluetooth_handler.stop_connect_with_retry()
+        if self.retry_task:
+            self.retry_task.cancel()
+            
+    async def _stop_retry(self):
+        if not self.retry_task:
+            return
+        self.retry_task.cancel()
+        await asyncio.gather(self.retry_task, return_exceptions=True)
+        self.retry_task = None
+        
+    async def _wait_for_accessory(self):
+        """Enable the default gadget and wait for the head unit's accessory start request"""
+        requested = asyncio.wrap_future(
+            self.aawg.uevent_handler.wait_for(DEVNAME="usb_accessory", ACCESSORY="START"))
+        self.aawg.usb_handler.enable_gadget(UsbGadgetConfig.DEFAULT_GADGET)
+        self.logger.info("Enabled default gadget")
+        
+        await requested
+        self.logger.info("Received accessory start request")
+        self.tracer.mark("accessory_start_request")
+        switching = time.monotonic()
+        self.aawg.usb_handler.disable_gadget(UsbGadgetConfig.DEFAULT_GADGET)
+        # Let the host recognize the change before the accessory appears
+        await self._wait_for_udc_detached(self.aawg.usb_handler.switch_timeout)
+        await asyncio.sleep(max(0.0, switching + MIN_SWITCH_DELAY - time.monotonic()))
+        self.aawg.usb_handler.enable_gadget(UsbGadgetConfig.ACCESSORY_GADGET)
+        self.tracer.record("usb_switch_to_accessory", switching)
+        self.logger.info("Switched to accessory gadget from default")
+        
+    async def _wait_for_udc_detached(self, timeout: float = UDC_DETACH_TIMEOUT):
+        """Wait until the UDC reports the gadget detached, at most timeout seconds"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            if self.aawg.usb_handler.get_udc_state() in UDC_DETACHED_STATES:
+                return
+            await asyncio.sleep(UDC_POLL_INTERVAL)
+            
+    def _start_uevents(self, loop: asyncio.AbstractEventLoop):
+        """Read uevents from the netlink socket on the loop"""
+        try:
+            self.uevent_sock = self.aawg.uevent_handler.open_socket()
+            self.uevent_sock.setblocking(False)
+            loop.add_reader(self.uevent_sock.fileno(), self._read_uevents)
+            self.logger.info("Uevent monitoring started")
+        except Exception as e:
+            self.logger.error(f"Failed to start uevent monitoring: {e}")
+            
+    def _read_uevents(self):
+        while True:
+            try:
+                msg = self.uevent_sock.recv(NETLINK_MSG_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.logger.error(f"Error in uevent monitor loop: {e}")
+                return
+                
+            if msg:
+                self.aawg.uevent_handler.handle_message(msg)
+                
+    def _stop_uevents(self, loop: asyncio.AbstractEventLoop):
+        if self.uevent_sock:
+            loop.remove_reader(self.uevent_sock.fileno())
+            self.uevent_sock.close()
+            self.uevent_sock = None
+            
+    async def _export_metrics(self):
+        exporter = self.aawg.metrics_exporter
+        while True:
+            await asyncio.sleep(exporter.interval)
+            exporter.export()
+            
+    def stop(self, signum: int):
+        """Shut down on a signal, cancelling the running session"""
+        self.running = False
+        self.aawg.cleanup(signum, None)
+        if self.main_task:
+            self.main_task.cancel()
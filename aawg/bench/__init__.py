@@ -0,0 +1,8 @@
+# Off-device benchmarks for the aawgd data path, run from the aawg directory:
+#   python3 -m bench.frames
+#   python3 -m bench.priority
+#   python3 -m bench.proxy
+#   python3 -m bench.reload
+#   python3 -m bench.replay <capture file>
+#   python3 -m bench.sessions
+#   python3 -m bench.watchdog
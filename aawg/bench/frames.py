@@ -0,0 +1,45 @@
+import argparse
+import time
+
+from frameParser import FrameParser
+from bench.streams import load_stream
+
+# Matches ProxyHandler.BUFFER_SIZE, the size of one forwarding read
+DEFAULT_CHUNK_SIZE = 16384
+
+def run(stream: bytes, chunk_size: int, repeat: int):
+    """Feed the stream through a FrameParser in forwarding sized chunks"""
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+    best_ns = None
+    frames = 0
+    
+    for _ in range(repeat):
+        parser = FrameParser()
+        start = time.perf_counter_ns()
+        for chunk in chunks:
+            parser.feed(chunk)
+        elapsed = time.perf_counter_ns() - start
+        if best_ns is None or elapsed < best_ns:
+            best_ns = elapsed
+        frames = parser.frames
+        
+    if not parser.at_boundary:
+        print("warning: stream does not end on a frame boundary")
+        
+    print(f"stream:      {len(stream)} bytes, {len(chunks)} chunks of {chunk_size}, {frames} frames")
+    print(f"per frame:   {best_ns / max(frames, 1) / 1000:.2f} us")
+    print(f"per chunk:   {best_ns / len(chunks) / 1000:.2f} us")
+    print(f"throughput:  {len(stream) / (best_ns / 1e9) / 1e6:.1f} MB/s")
+    
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Android Auto frame parser")
+    parser.add_argument("--input", help="Raw captured stream of one direction, synthetic if omitted")
+    parser.add_argument("--size", type=int, default=32 * 1024 * 1024, help="Synthetic stream size in bytes")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    
+    run(load_stream(args.input, args.size), args.chunk_size, args.repeat)
+    
+if __name__ == "__main__":
+    main()
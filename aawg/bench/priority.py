@@ -0,0 +1,120 @@
+import argparse
+import os
+import socket
+import statistics
+import threading
+import time
+from typing import Dict, List
+
+from common import ForwardingEngine
+from frameParser import Channel, FRAME_TYPE_FIRST, FRAME_TYPE_LAST, FRAME_ENCRYPTED
+from proxyHandler import ProxyHandler
+from bench.streams import encode_message, FrameReader, frame_payload
+
+# Small socket buffers keep the backlog inside the proxy where it can be scheduled
+SOCKET_BUFFER_SIZE = 16384
+
+def build_schedule(duration: float, video_burst: int) -> List[tuple]:
+    """Build (send time, channel, message size) events for a mixed channel stream"""
+    events = []
+    for i in range(int(duration / 0.1)):
+        events.append((i * 0.1, Channel.VIDEO, video_burst))
+    for i in range(int(duration / 0.02)):
+        events.append((i * 0.02, Channel.MEDIA_AUDIO, 4096))
+    for i in range(int(duration / 0.05)):
+        events.append((i * 0.05 + 0.01, Channel.CONTROL, 64))
+    events.sort(key=lambda event: event[0])
+    return events
+
+def send_stream(sock: socket.socket, events: List[tuple], flags: int, sent: Dict[int, float]):
+    """Send every event at its scheduled time, tagging messages with their index"""
+    start = time.monotonic()
+    for msg_id, (at, channel, size) in enumerate(events):
+        delay = start + at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        sent[msg_id] = start + at
+        payload = msg_id.to_bytes(8, "big") + os.urandom(size - 8)
+        sock.sendall(b"".join(encode_message(channel, payload, flags)))
+
+def receive_stream(sock: socket.socket, rate: int, expected: int,
+                   latencies: Dict[int, List[float]], sent: Dict[int, float]):
+    """Drain the accessory side at a limited rate and time each complete message"""
+    reader = FrameReader()
+    current: Dict[int, int] = {}
+    start = time.monotonic()
+    received = 0
+    messages = 0
+    
+    while messages < expected:
+        # Pace reads so the accessory link is the bottleneck
+        delay = start + received / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        chunk = sock.recv(SOCKET_BUFFER_SIZE)
+        if not chunk:
+            break
+        received += len(chunk)
+        
+        for frame in reader.feed(chunk):
+            channel, flags = frame[0], frame[1]
+            if flags & FRAME_TYPE_FIRST:
+                current[channel] = int.from_bytes(frame_payload(frame)[:8], "big")
+            if flags & FRAME_TYPE_LAST:
+                msg_id = current.pop(channel)
+                latencies.setdefault(channel, []).append(time.monotonic() - sent[msg_id])
+                messages += 1
+                
+def run(prioritize: bool, events: List[tuple], flags: int, rate: int) -> Dict[int, List[float]]:
+    """Replay the events through an epoll ProxyHandler and collect per channel latencies"""
+    tcp, tcp_peer = socket.socketpair()
+    usb, usb_peer = socket.socketpair()
+    for sock in (tcp, tcp_peer, usb, usb_peer):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        
+    proxy = ProxyHandler(engine=ForwardingEngine.EPOLL, parse_frames=False, prioritize=prioritize)
+    proxy.connection.tcp_fd = tcp.fileno()
+    proxy.connection.usb_fd = usb.fileno()
+    forwarder = threading.Thread(target=proxy._start_forwarding)
+    forwarder.start()
+    
+    sent: Dict[int, float] = {}
+    latencies: Dict[int, List[float]] = {}
+    receiver = threading.Thread(target=receive_stream, args=(usb_peer, rate, len(events), latencies, sent))
+    receiver.start()
+    send_stream(tcp_peer, events, flags, sent)
+    receiver.join()
+    
+    proxy.stop_forwarding()
+    forwarder.join()
+    for sock in (tcp, tcp_peer, usb, usb_peer):
+        sock.close()
+    return latencies
+    
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+    
+def main():
+    parser = argparse.ArgumentParser(description="Per channel latency with and without frame prioritization")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds of traffic to replay")
+    parser.add_argument("--video-burst", type=int, default=200000, help="Video bytes sent every 100 ms")
+    parser.add_argument("--usb-rate", type=int, default=3000000, help="Accessory drain rate in bytes/s")
+    parser.add_argument("--encrypted", action="store_true",
+                        help="Mark frames encrypted, which keeps them in order")
+    args = parser.parse_args()
+    
+    events = build_schedule(args.duration, args.video_burst)
+    flags = FRAME_ENCRYPTED if args.encrypted else 0
+    
+    for prioritize in (False, True):
+        latencies = run(prioritize, events, flags, args.usb_rate)
+        print(f"prioritize={prioritize}")
+        for channel, values in sorted(latencies.items()):
+            print(f"  {Channel(channel).name:<12} n={len(values):<5} "
+                  f"p50={statistics.median(values) * 1000:7.1f} ms  "
+                  f"p99={percentile(values, 99) * 1000:7.1f} ms")
+                  
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import argparse
+import errno
+import os
+import pty
+import select
+import selectors
+import socket
+import statistics
+import threading
+import time
+import tty
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from common import ForwardingEngine
+from frameParser import Channel, encode_frame, FRAME_TYPE_FIRST, FRAME_TYPE_LAST
+from proxyHandler import ProxyHandler
+from bench.streams import FrameReader, frame_payload
+
+TIMESTAMP_SIZE = 8
+FRAME_FLAGS = FRAME_TYPE_FIRST | FRAME_TYPE_LAST
+
+ACCESSORY_KINDS = ["socketpair", "pty", "unpollable"]
+
+class UnpollableEpoll:
+    """select.epoll that refuses unpollable fake accessories, as the kernel refuses f_accessory"""
+    inodes: Set[int] = set()  # Of the proxy ends, an fd is matched by inode since the proxy gets a duplicate
+    epoll = select.epoll
+    
+    def __init__(self, *args):
+        self._epoll = self.epoll(*args)
+        
+    def register(self, fd: int, eventmask: int = select.EPOLLIN | select.EPOLLOUT | select.EPOLLPRI):
+        if os.fstat(fd).st_ino in self.inodes:
+            raise PermissionError(errno.EPERM, os.strerror(errno.EPERM))
+        self._epoll.register(fd, eventmask)
+        
+    def __getattr__(self, name: str):
+        return getattr(self._epoll, name)
+
+class FakeAccessory:
+    """Stand-in for /dev/usb_accessory, proxy_fd is handed to the proxy and peer_fd plays the head unit"""
+    
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.path: Optional[str] = None
+        if kind in ("socketpair", "unpollable"):
+            proxy_sock, peer_sock = socket.socketpair()
+            self.proxy_fd = proxy_sock.detach()
+            self.peer_fd = peer_sock.detach()
+            if kind == "unpollable":
+                # Stays blocking as well, the proxy only switches fds it could register
+                UnpollableEpoll.inodes.add(os.fstat(self.proxy_fd).st_ino)
+                # asyncio loops created afterwards poll through a selector
+                select.epoll = selectors.EpollSelector._selector_cls = UnpollableEpoll
+        elif kind == "pty":
+            self.peer_fd, self.proxy_fd = pty.openpty()
+            tty.setraw(self.peer_fd)
+            tty.setraw(self.proxy_fd)
+            self.path = os.ttyname(self.proxy_fd)
+        else:
+            raise ValueError(f"Unknown accessory kind {kind}")
+            
+    def open(self) -> int:
+        """Open the proxy end, the proxy closes the returned fd when the session ends"""
+        if self.path:
+            return os.open(self.path, os.O_RDWR | os.O_NOCTTY)
+        return os.dup(self.proxy_fd)
+        
+    def unplug(self):
+        """Make reads and writes blocked on the proxy end fail, like unbinding the USB gadget"""
+        if self.path:
+            # The proxy has the pty's slave end, it gets EIO once the master is gone
+            os.close(self.peer_fd)
+            self.peer_fd = -1
+            return
+        sock = socket.socket(fileno=os.dup(self.proxy_fd))
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        finally:
+            sock.close()
+            
+    def close(self):
+        for fd in (self.proxy_fd, self.peer_fd):
+            if fd == -1:
+                continue
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+class BenchProxyHandler(ProxyHandler):
+    """ProxyHandler that forwards to a FakeAccessory instead of the USB gadget"""
+    
+    def __init__(self, accessory: FakeAccessory, **kwargs):
+        super().__init__(**kwargs)
+        self.accessory = accessory
+        
+    def _open_accessory(self) -> int:
+        return self.accessory.open()
+
+@dataclass
+class DirectionStats:
+    """Traffic seen by the receiving end of one direction"""
+    bytes: int = 0
+    frames: int = 0
+    latencies: List[float] = field(default_factory=list)
+
+# A traffic profile yields (channel, payload size, pause after sending) for one direction
+Profile = Callable[[], Tuple[int, int, float]]
+
+def bulk_video() -> Tuple[int, int, float]:
+    return Channel.VIDEO, 16000, 0.0
+
+def interactive() -> Tuple[int, int, float]:
+    return Channel.INPUT, 64, 0.002
+
+def mixed_factory() -> Profile:
+    sequence = [(Channel.VIDEO, 16000, 0.0)] * 6 + [(Channel.MEDIA_AUDIO, 2048, 0.0), (Channel.CONTROL, 32, 0.001)]
+    state = {"i": 0}
+    
+    def mixed() -> Tuple[int, int, float]:
+        state["i"] = (state["i"] + 1) % len(sequence)
+        return sequence[state["i"]]
+    return mixed
+
+def head_unit_feedback() -> Tuple[int, int, float]:
+    # Touch events and acks going back to the phone
+    return Channel.INPUT, 128, 0.01
+
+PROFILES: Dict[str, Tuple[Callable[[], Profile], Callable[[], Profile]]] = {
+    # name: (phone to head unit, head unit to phone)
+    "video": (lambda: bulk_video, lambda: head_unit_feedback),
+    "interactive": (lambda: interactive, lambda: interactive),
+    "mixed": (mixed_factory, lambda: head_unit_feedback),
+}
+
+def send_frames(fd: int, profile: Profile, stop: threading.Event):
+    """Send timestamped frames described by the profile until stopped"""
+    padding = bytes(65535)
+    try:
+        while not stop.is_set():
+            channel, size, pause = profile()
+            payload = time.monotonic_ns().to_bytes(TIMESTAMP_SIZE, "big") + padding[:size - TIMESTAMP_SIZE]
+            view = memoryview(encode_frame(channel, FRAME_FLAGS, payload))
+            while view:
+                view = view[os.write(fd, view):]
+            if pause:
+                time.sleep(pause)
+    except OSError:
+        pass
+
+def receive_frames(fd: int, stats: DirectionStats):
+    """Receive frames and record the latency of each one"""
+    reader = FrameReader()
+    try:
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            now = time.monotonic_ns()
+            stats.bytes += len(data)
+            for frame in reader.feed(data):
+                stats.frames += 1
+                sent = int.from_bytes(frame_payload(frame)[:TIMESTAMP_SIZE], "big")
+                stats.latencies.append((now - sent) / 1e9)
+    except OSError:
+        pass
+
+def thread_cpu_times() -> Dict[str, float]:
+    """Get CPU seconds used by each named thread of this process"""
+    ticks = os.sysconf("SC_CLK_TCK")
+    by_id = {t.native_id: t.name for t in threading.enumerate()}
+    times = {}
+    for tid, name in by_id.items():
+        try:
+            with open(f"/proc/self/task/{tid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime are fields 14 and 15, counted from the pid
+        times[name] = (int(fields[11]) + int(fields[12])) / ticks
+    return times
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def run(profile_name: str, engine: ForwardingEngine, accessory_kind: str,
+        buffer_size: int, adaptive: bool, duration: float):
+    """Run one proxy session with the given traffic and print its statistics"""
+    accessory = FakeAccessory(accessory_kind)
+    proxy = BenchProxyHandler(accessory, engine=engine, parse_frames=False, prioritize=False,
+                              adaptive_reads=adaptive)
+    proxy.BUFFER_SIZE = buffer_size
+    server_thread = proxy.start_server(0)
+    if not server_thread:
+        raise RuntimeError("Proxy failed to start")
+        
+    phone = socket.create_connection(("127.0.0.1", proxy.server_port))
+    phone.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    phone_fd = phone.fileno()
+    
+    to_head_unit, to_phone = PROFILES[profile_name]
+    stats = {"TCP->USB": DirectionStats(), "USB->TCP": DirectionStats()}
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=send_frames, args=(phone_fd, to_head_unit(), stop), daemon=True),
+        threading.Thread(target=receive_frames, args=(accessory.peer_fd, stats["TCP->USB"]), daemon=True),
+        threading.Thread(target=send_frames, args=(accessory.peer_fd, to_phone(), stop), daemon=True),
+        threading.Thread(target=receive_frames, args=(phone_fd, stats["USB->TCP"]), daemon=True),
+    ]
+    
+    cpu_before = thread_cpu_times()
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    elapsed = time.monotonic() - start
+    cpu_after = thread_cpu_times()
+    
+    stop.set()
+    phone.shutdown(socket.SHUT_RDWR)
+    server_thread.join()
+    proxy.close_server()
+    phone.close()
+    accessory.close()
+    
+    print(f"profile={profile_name} engine={engine.value} accessory={accessory_kind} "
+          f"buffer={buffer_size}{' adaptive' if adaptive else ''} duration={elapsed:.1f}s")
+    for name, direction in stats.items():
+        if direction.latencies:
+            latency = (f"p50={statistics.median(direction.latencies) * 1000:.2f} ms  "
+                       f"p99={percentile(direction.latencies, 99) * 1000:.2f} ms")
+        else:
+            latency = "no frames"
+        print(f"  {name}  {direction.bytes / elapsed / 1e6:8.2f} MB/s  {direction.frames:7} frames  {latency}")
+        
+    # Forwarding threads are named after their direction, the epoll loop runs on ProxyServer
+    for name in sorted(cpu_after):
+        if name == "ProxyServer" or "->" in name:
+            used = cpu_after[name] - cpu_before.get(name, 0.0)
+            print(f"  cpu {name:<16} {used:6.2f} s  ({used / elapsed * 100:5.1f} %)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ProxyHandler against a simulated USB accessory")
+    parser.add_argument("--profile", choices=sorted(PROFILES), action="append",
+                        help="Traffic profile, may be repeated (default: all)")
+    parser.add_argument("--engine", choices=[e.value for e in ForwardingEngine], action="append",
+                        help="Forwarding engine, may be repeated (default: all)")
+    parser.add_argument("--accessory", choices=ACCESSORY_KINDS, default="socketpair")
+    parser.add_argument("--buffer-size", type=int, action="append",
+                        help="Forwarding read size, may be repeated (default: ProxyHandler.BUFFER_SIZE)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Let the read size adapt to the traffic, starting at the buffer size")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds per run")
+    args = parser.parse_args()
+    
+    for profile_name in args.profile or sorted(PROFILES):
+        for engine in args.engine or [e.value for e in ForwardingEngine]:
+            for buffer_size in args.buffer_size or [ProxyHandler.BUFFER_SIZE]:
+                run(profile_name, ForwardingEngine(engine), args.accessory, buffer_size, args.adaptive,
+                    args.duration)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import os
+import tempfile
+
+from common import Config, WifiInfo
+from bluetoothHandler import BluetoothHandler
+
+class FakeHandshake:
+    """Stand-in for WifiHandshakeProfile that keeps what the phone would be sent"""
+    
+    def __init__(self, wifi_info: WifiInfo):
+        self.wifi_info = wifi_info
+        
+    def set_wifi_info(self, wifi_info: WifiInfo):
+        self.wifi_info = wifi_info
+
+def reload_with(values: dict) -> bool:
+    """Write the configuration file with values and reload it"""
+    with open(os.environ["AAWG_CONF_FILE"], "w") as f:
+        f.write("import os\n")
+        for name, value in values.items():
+            f.write(f"os.environ[{name!r}] = {str(value)!r}\n")
+    return Config.instance().reload()
+
+def run() -> bool:
+    """Reload a port change, then another change, and check what the handshake advertises"""
+    bound_port = Config.instance().get_wifi_info().port
+    handler = BluetoothHandler()
+    handler.wifi_handshake = FakeHandshake(Config.instance().get_wifi_info())
+    Config.instance().on_reload.append(handler._config_reloaded)
+    
+    ok = True
+    steps = [
+        ("port change", {"AAWG_PROXY_PORT": bound_port + 1}),
+        ("password change", {"AAWG_PROXY_PORT": bound_port + 1, "AAWG_WIFI_PASSWORD": "ReloadedPassword"}),
+    ]
+    for name, values in steps:
+        if not reload_with(values):
+            print(f"{name}: reload failed")
+            return False
+        advertised = handler.wifi_handshake.wifi_info
+        passed = advertised.port == bound_port and advertised.key == Config.instance().get_wifi_info().key
+        ok = ok and passed
+        print(f"{name}: advertised port {advertised.port}, listening on {bound_port}  {'ok' if passed else 'FAILED'}")
+    return ok
+
+def main():
+    argparse.ArgumentParser(description="Check that configuration reloads reach the handlers correctly").parse_args()
+    with tempfile.TemporaryDirectory() as conf_dir:
+        # Read when the configuration is first loaded, so it's set before anything uses it
+        os.environ["AAWG_CONF_FILE"] = os.path.join(conf_dir, "aawgd.conf.py")
+        ok = run()
+    raise SystemExit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import argparse
+import hashlib
+import os
+import socket
+import statistics
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+from common import ForwardingEngine
+from sessionCapture import read_capture, DIRECTIONS
+from bench.proxy import FakeAccessory, BenchProxyHandler, ACCESSORY_KINDS, percentile
+
+@dataclass
+class ReplayStats:
+    """One direction of a replay, filled in by its sender and receiver"""
+    records: List[Tuple[int, bytes]] = field(default_factory=list)  # (timestamp, data) from the capture
+    sent: List[Tuple[int, float]] = field(default_factory=list)  # (end offset, monotonic time) of each record
+    max_lag: float = 0.0  # Furthest the sender fell behind the capture's timing
+    received: int = 0
+    latencies: List[float] = field(default_factory=list)
+    digest: Any = field(default_factory=hashlib.sha256)
+    done: threading.Event = field(default_factory=threading.Event)
+    
+    @property
+    def total(self) -> int:
+        return sum(len(data) for _, data in self.records)
+
+def send_records(fd: int, stats: ReplayStats, start: float, speed: float):
+    """Write each record at its captured time, divided by speed, or back to back if speed is 0"""
+    offset = 0
+    try:
+        for timestamp, data in stats.records:
+            if speed:
+                delay = start + timestamp / 1e9 / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    stats.max_lag = max(stats.max_lag, -delay)
+            offset += len(data)
+            stats.sent.append((offset, time.monotonic()))
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+    except OSError:
+        pass
+
+def receive_records(fd: int, stats: ReplayStats):
+    """Read until all of the direction's data arrived and record when each record was complete"""
+    expected = stats.total
+    pending = 0  # Index of the first record not completely received
+    try:
+        while stats.received < expected:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            now = time.monotonic()
+            stats.received += len(data)
+            stats.digest.update(data)
+            # The sender appends before writing, so a record received is always in sent
+            while pending < len(stats.sent) and stats.sent[pending][0] <= stats.received:
+                stats.latencies.append(now - stats.sent[pending][1])
+                pending += 1
+    except OSError:
+        pass
+    finally:
+        stats.done.set()
+
+def load(path: str) -> Dict[str, ReplayStats]:
+    stats = {name: ReplayStats() for name in DIRECTIONS}
+    for record in read_capture(path):
+        stats[record.direction].records.append((record.timestamp, record.data))
+    return stats
+
+def run(path: str, engine: ForwardingEngine, accessory_kind: str, speed: float, timeout: float):
+    """Replay a capture through one proxy session and print how it was forwarded"""
+    stats = load(path)
+    expected = {name: hashlib.sha256(b"".join(data for _, data in direction.records)).hexdigest()
+                for name, direction in stats.items()}
+    duration = max((direction.records[-1][0] for direction in stats.values() if direction.records), default=0) / 1e9
+    
+    accessory = FakeAccessory(accessory_kind)
+    proxy = BenchProxyHandler(accessory, engine=engine, parse_frames=False, prioritize=False)
+    server_thread = proxy.start_server(0)
+    if not server_thread:
+        raise RuntimeError("Proxy failed to start")
+        
+    phone = socket.create_connection(("127.0.0.1", proxy.server_port))
+    phone.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    phone_fd = phone.fileno()
+    
+    # The phone sends what went to USB, the head unit what went to TCP
+    start = time.monotonic() + 0.1
+    threads = [
+        threading.Thread(target=send_records, args=(phone_fd, stats["TCP->USB"], start, speed), daemon=True),
+        threading.Thread(target=receive_records, args=(accessory.peer_fd, stats["TCP->USB"]), daemon=True),
+        threading.Thread(target=send_records, args=(accessory.peer_fd, stats["USB->TCP"], start, speed), daemon=True),
+        threading.Thread(target=receive_records, args=(phone_fd, stats["USB->TCP"]), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    deadline = start + (duration / speed if speed else 0) + timeout
+    for direction in stats.values():
+        direction.done.wait(max(0.0, deadline - time.monotonic()))
+    elapsed = time.monotonic() - start
+    
+    phone.shutdown(socket.SHUT_RDWR)
+    server_thread.join()
+    proxy.close_server()
+    phone.close()
+    accessory.close()
+    
+    print(f"capture={path} engine={engine.value} accessory={accessory_kind} "
+          f"speed={speed or 'max'} captured={duration:.1f}s replayed={elapsed:.1f}s")
+    for name, direction in stats.items():
+        if direction.latencies:
+            latency = (f"p50={statistics.median(direction.latencies) * 1000:.2f} ms  "
+                       f"p99={percentile(direction.latencies, 99) * 1000:.2f} ms  "
+                       f"max={max(direction.latencies) * 1000:.2f} ms")
+        else:
+            latency = "no records"
+        match = "identical" if direction.digest.hexdigest() == expected[name] else "MISMATCH"
+        print(f"  {name}  {direction.received:10}/{direction.total} bytes  {len(direction.records):7} records  "
+              f"{latency}  lag={direction.max_lag * 1000:.1f} ms  {match}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a session capture through ProxyHandler against fake endpoints")
+    parser.add_argument("capture", help="File written with AAWG_CAPTURE_DIR set")
+    parser.add_argument("--engine", choices=[e.value for e in ForwardingEngine], action="append",
+                        help="Forwarding engine, may be repeated (default: all)")
+    parser.add_argument("--accessory", choices=ACCESSORY_KINDS, default="socketpair")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed relative to the capture, 0 sends without pauses")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="Seconds to wait for the data after the last record was sent")
+    args = parser.parse_args()
+    
+    for engine in args.engine or [e.value for e in ForwardingEngine]:
+        run(args.capture, ForwardingEngine(engine), args.accessory, args.speed, args.timeout)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import argparse
+import os
+import socket
+import statistics
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from common import ForwardingEngine
+from sessionManager import SessionManager
+from bench.proxy import (FakeAccessory, BenchProxyHandler, DirectionStats, PROFILES, ACCESSORY_KINDS, send_frames,
+                         receive_frames, percentile)
+
+@dataclass
+class Session:
+    """A phone connected through the manager and the head unit end of the endpoint it was given"""
+    phone: socket.socket
+    stats: Dict[str, DirectionStats] = field(
+        default_factory=lambda: {"TCP->USB": DirectionStats(), "USB->TCP": DirectionStats()})
+
+def latency_summary(latencies: List[float]) -> str:
+    if not latencies:
+        return "no frames"
+    return (f"p50={statistics.median(latencies) * 1000:.2f} ms  "
+            f"p99={percentile(latencies, 99) * 1000:.2f} ms")
+
+def run(sessions: int, clients: int, profile_name: str, engine: ForwardingEngine, accessory_kind: str,
+        duration: float, verbose: bool):
+    """Run sessions proxy sessions side by side through one SessionManager and print their statistics"""
+    accessories = {f"fake{i}": FakeAccessory(accessory_kind) for i in range(sessions)}
+    manager = SessionManager(list(accessories), lambda path: BenchProxyHandler(
+        accessories[path], engine=engine, parse_frames=False, prioritize=False))
+    if not manager.start(0):
+        raise RuntimeError("Session manager failed to start")
+        
+    phones = []
+    for _ in range(clients):
+        phone = socket.create_connection(("127.0.0.1", manager.server_port))
+        phone.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        phones.append(phone)
+    # Wait until every client was either given an endpoint or closed
+    deadline = time.monotonic() + 5
+    while len(manager.active_sessions()) + manager.rejected < clients and time.monotonic() < deadline:
+        time.sleep(0.01)
+        
+    # Map each phone to its endpoint by the client address the manager saw
+    by_client = {client: path for path, client in manager.active_sessions().items()}
+    to_head_unit, to_phone = PROFILES[profile_name]
+    stop = threading.Event()
+    running: Dict[str, Session] = {}
+    threads = []
+    for phone in phones:
+        host, port = phone.getsockname()
+        path = by_client.get(f"{host}:{port}")
+        if not path:
+            continue
+        session = running[path] = Session(phone)
+        peer_fd = accessories[path].peer_fd
+        threads += [
+            threading.Thread(target=send_frames, args=(phone.fileno(), to_head_unit(), stop), daemon=True),
+            threading.Thread(target=receive_frames, args=(peer_fd, session.stats["TCP->USB"]), daemon=True),
+            threading.Thread(target=send_frames, args=(peer_fd, to_phone(), stop), daemon=True),
+            threading.Thread(target=receive_frames, args=(phone.fileno(), session.stats["USB->TCP"]), daemon=True),
+        ]
+        
+    cpu_before = os.times()
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    elapsed = time.monotonic() - start
+    cpu_after = os.times()
+    
+    stop.set()
+    for phone in phones:
+        try:
+            phone.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    manager.stop()
+    for phone in phones:
+        phone.close()
+    for accessory in accessories.values():
+        accessory.close()
+        
+    print(f"sessions={sessions} clients={clients} profile={profile_name} engine={engine.value} "
+          f"accessory={accessory_kind} duration={elapsed:.1f}s")
+    print(f"  served {len(running)} rejected {manager.rejected}")
+    if verbose:
+        for path, session in sorted(running.items()):
+            print(f"  {path:<8} " + "  ".join(
+                f"{name} {direction.bytes / elapsed / 1e6:7.2f} MB/s" for name, direction in session.stats.items()))
+                
+    for name in ("TCP->USB", "USB->TCP"):
+        directions = [session.stats[name] for session in running.values()]
+        rates = [direction.bytes / elapsed / 1e6 for direction in directions] or [0.0]
+        latencies = [latency for direction in directions for latency in direction.latencies]
+        print(f"  {name}  total {sum(rates):8.2f} MB/s  per session min {min(rates):.2f} "
+              f"max {max(rates):.2f} MB/s  {sum(direction.frames for direction in directions):8} frames  "
+              f"{latency_summary(latencies)}")
+              
+    # Includes the traffic generators, which run in this process as well
+    used = (cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system)
+    print(f"  cpu {used:6.2f} s  ({used / elapsed * 100:5.1f} %)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test SessionManager with many phones and fake accessories")
+    parser.add_argument("--sessions", type=int, default=16, help="Number of accessory endpoints")
+    parser.add_argument("--clients", type=int, help="Number of phones connecting (default: one per endpoint)")
+    parser.add_argument("--profile", choices=list(PROFILES), default="interactive")
+    parser.add_argument("--engine", choices=[e.value for e in ForwardingEngine], default=ForwardingEngine.COPY.value)
+    parser.add_argument("--accessory", choices=ACCESSORY_KINDS, default="socketpair")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--verbose", action="store_true", help="Print the throughput of every session")
+    args = parser.parse_args()
+    
+    run(args.sessions, args.clients if args.clients is not None else args.sessions, args.profile,
+        ForwardingEngine(args.engine), args.accessory, args.duration, args.verbose)
+
+if __name__ == "__main__":
+    main()
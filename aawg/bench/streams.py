@@ -0,0 +1,84 @@
+import os
+import random
+from typing import List, Optional, Tuple
+
+from frameParser import (Channel, encode_frame, header_size, FRAME_HEADER_SIZE,
+                         FRAME_TYPE_FIRST, FRAME_TYPE_LAST, FRAME_ENCRYPTED)
+
+# Largest payload carried by one frame before a message is split
+MAX_FRAME_PAYLOAD = 0x4000
+
+# (channel, message size range in bytes, relative weight) for phone to head unit traffic
+PHONE_TRAFFIC_PROFILE = [
+    (Channel.VIDEO, (4000, 60000), 30),
+    (Channel.MEDIA_AUDIO, (2048, 4096), 40),
+    (Channel.SPEECH_AUDIO, (1024, 2048), 5),
+    (Channel.CONTROL, (6, 64), 10),
+    (Channel.INPUT, (16, 128), 15),
+]
+
+def encode_message(channel: int, payload: bytes, flags: int = FRAME_ENCRYPTED) -> List[bytes]:
+    """Split a message into frames the way the phone does"""
+    if len(payload) <= MAX_FRAME_PAYLOAD:
+        return [encode_frame(channel, flags | FRAME_TYPE_FIRST | FRAME_TYPE_LAST, payload)]
+        
+    frames = []
+    for offset in range(0, len(payload), MAX_FRAME_PAYLOAD):
+        chunk = payload[offset:offset + MAX_FRAME_PAYLOAD]
+        frame_flags = flags
+        if offset == 0:
+            frame_flags |= FRAME_TYPE_FIRST
+        if offset + len(chunk) == len(payload):
+            frame_flags |= FRAME_TYPE_LAST
+        frames.append(encode_frame(channel, frame_flags, chunk, len(payload)))
+    return frames
+
+def synthetic_messages(total_bytes: int, profile=PHONE_TRAFFIC_PROFILE,
+                       seed: int = 0) -> List[Tuple[int, List[bytes]]]:
+    """Generate (channel, frames) messages until total_bytes of frames are produced"""
+    rng = random.Random(seed)
+    weights = [weight for _, _, weight in profile]
+    messages = []
+    produced = 0
+    while produced < total_bytes:
+        channel, (low, high), _ = rng.choices(profile, weights)[0]
+        frames = encode_message(channel, os.urandom(rng.randint(low, high)))
+        messages.append((channel, frames))
+        produced += sum(len(frame) for frame in frames)
+    return messages
+
+def synthetic_stream(total_bytes: int, seed: int = 0) -> bytes:
+    """Generate a mixed channel frame stream of about total_bytes"""
+    return b"".join(b"".join(frames) for _, frames in synthetic_messages(total_bytes, seed=seed))
+
+def load_stream(path: Optional[str], total_bytes: int) -> bytes:
+    """Load a captured frame stream, or synthesize one if no path is given"""
+    if path:
+        with open(path, "rb") as f:
+            return f.read()
+    return synthetic_stream(total_bytes)
+
+class FrameReader:
+    """Reassemble complete frames from a byte stream received in chunks"""
+    
+    def __init__(self):
+        self._buf = bytearray()
+        
+    def feed(self, data: bytes) -> List[bytes]:
+        """Add received data and return the frames completed by it"""
+        buf = self._buf
+        buf += data
+        frames = []
+        pos = 0
+        while len(buf) - pos >= FRAME_HEADER_SIZE:
+            size = header_size(buf[pos + 1]) + ((buf[pos + 2] << 8) | buf[pos + 3])
+            if len(buf) - pos < size:
+                break
+            frames.append(bytes(buf[pos:pos + size]))
+            pos += size
+        del buf[:pos]
+        return frames
+        
+def frame_payload(frame: bytes) -> bytes:
+    """Get the payload of a complete frame"""
+    return frame[header_size(frame[1]):]
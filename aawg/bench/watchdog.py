@@ -0,0 +1,152 @@
+import argparse
+import fcntl
+import os
+import socket
+import struct
+import termios
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from common import ForwardingEngine, WatchdogConfig, WatchdogThresholds
+from frameParser import Channel, encode_frame
+from bench.proxy import FakeAccessory, BenchProxyHandler, send_frames, bulk_video, ACCESSORY_KINDS, FRAME_FLAGS
+
+# Frames sent after the head unit's end is full, enough to pause the epoll engine
+HALF_CLOSE_FRAMES = 6
+# Seconds before the first frame of late_first_frame, twice its idle limit
+LATE_FIRST_FRAME = 1.0
+
+def thresholds(idle: float = 0.0, stall: float = 0.0) -> Dict[str, WatchdogThresholds]:
+    return {name: WatchdogThresholds(idle, stall) for name in ("TCP->USB", "USB->TCP")}
+
+def unread(fd: int) -> int:
+    """Get the number of bytes waiting to be read from a socket or tty"""
+    return struct.unpack("i", fcntl.ioctl(fd, termios.FIONREAD, bytes(4)))[0]
+
+def exchange(phone: socket.socket, accessory: FakeAccessory):
+    """Pass one frame each way, so the session is known to be forwarding"""
+    frame = encode_frame(Channel.CONTROL, FRAME_FLAGS, bytes(16))
+    phone.sendall(frame)
+    if not os.read(accessory.peer_fd, 65536):
+        raise RuntimeError("Session ended before the head unit got a frame")
+    os.write(accessory.peer_fd, frame)
+    if not phone.recv(65536):
+        raise RuntimeError("Session ended before the phone got a frame")
+
+def silent_phone(phone: socket.socket, accessory: FakeAccessory, stop: threading.Event) -> float:
+    """Both ends stop sending, as when the phone drops off the WiFi without a FIN"""
+    exchange(phone, accessory)
+    return time.monotonic()
+
+def stalled_head_unit(phone: socket.socket, accessory: FakeAccessory, stop: threading.Event) -> float:
+    """The phone keeps sending while the head unit stops reading"""
+    exchange(phone, accessory)
+    threading.Thread(target=send_frames, args=(phone.fileno(), bulk_video, stop), daemon=True).start()
+    # Returns once the buffers are full and the proxy's writes stop going through
+    time.sleep(0.2)
+    return time.monotonic()
+
+def late_first_frame(phone: socket.socket, accessory: FakeAccessory, stop: threading.Event) -> float:
+    """Nothing is sent for longer than the idle limit after the accept, as with a head unit slow to start"""
+    time.sleep(LATE_FIRST_FRAME)
+    try:
+        exchange(phone, accessory)
+    except OSError as e:
+        raise RuntimeError(f"Session ended before the first frame: {e}")
+    # Then both ends go silent, so the idle limit ends the session
+    return time.monotonic()
+
+def half_closed_phone(phone: socket.socket, accessory: FakeAccessory, stop: threading.Event) -> float:
+    """The phone shuts down its sending side while the proxy is stuck writing to the head unit"""
+    exchange(phone, accessory)
+    # Send until the head unit's end stopped filling up for a few frames, the proxy
+    # is stuck then. Its receive window still has room, so the FIN gets through
+    frame = encode_frame(Channel.VIDEO, FRAME_FLAGS, bytes(16000))
+    unchanged = 0
+    while unchanged < HALF_CLOSE_FRAMES:
+        previous = unread(accessory.peer_fd)
+        phone.sendall(frame)
+        time.sleep(0.05)
+        unchanged = unchanged + 1 if unread(accessory.peer_fd) == previous else 0
+    phone.shutdown(socket.SHUT_WR)
+    return time.monotonic()
+
+Scenario = Callable[[socket.socket, FakeAccessory, threading.Event], float]
+
+# name: (scenario, watchdog configuration, accessory kind it needs or None)
+SCENARIOS: Dict[str, Tuple[Scenario, WatchdogConfig, Optional[str]]] = {
+    "silent_phone": (silent_phone, WatchdogConfig(thresholds(idle=0.5), half_close_grace=0.2), None),
+    "stalled_head_unit": (stalled_head_unit, WatchdogConfig(thresholds(stall=0.5), half_close_grace=0.2), None),
+    # Like f_accessory: the proxy's writes block in a helper thread until the accessory is unplugged
+    "stalled_unpollable_head_unit": (stalled_head_unit, WatchdogConfig(thresholds(stall=0.5), half_close_grace=0.2),
+                                     "unpollable"),
+    # Must not end the session before the first frame, only after it
+    "late_first_frame": (late_first_frame, WatchdogConfig(thresholds(idle=0.5), half_close_grace=0.2), None),
+    # The stall limit is far off, so the half-close is what ends the session
+    "half_closed_phone": (half_closed_phone, WatchdogConfig(thresholds(stall=10.0), half_close_grace=0.2), None),
+}
+
+def run(scenario_name: str, engine: ForwardingEngine, accessory_kind: str):
+    """Get a session stuck, then print how long the watchdog took to end it and to forward again"""
+    scenario, config, needed_kind = SCENARIOS[scenario_name]
+    accessory_kind = needed_kind or accessory_kind
+    accessory = FakeAccessory(accessory_kind)
+    proxy = BenchProxyHandler(accessory, engine=engine, parse_frames=False, prioritize=False, watchdog=config)
+    proxy.on_watchdog_expired = lambda: proxy.accessory.unplug()
+    server_thread = proxy.start_server(0)
+    if not server_thread:
+        raise RuntimeError("Proxy failed to start")
+        
+    phone = socket.create_connection(("127.0.0.1", proxy.server_port))
+    stop = threading.Event()
+    try:
+        stuck = scenario(phone, accessory, stop)
+    except RuntimeError as e:
+        print(f"scenario={scenario_name} engine={engine.value}: {e}")
+        stuck = None
+    server_thread.join(30)
+    ended = time.monotonic()
+    stop.set()
+    phone.close()
+    accessory.close()
+    
+    if server_thread.is_alive():
+        print(f"scenario={scenario_name} engine={engine.value}: session still running after 30s")
+        proxy.stop_forwarding()
+        return
+    if stuck is None:
+        return
+        
+    # A fresh session on the same handler measures the recovery
+    proxy.accessory = FakeAccessory(accessory_kind)
+    server_thread = proxy.start_server(0)
+    phone = socket.create_connection(("127.0.0.1", proxy.server_port))
+    exchange(phone, proxy.accessory)
+    phone.close()
+    server_thread.join()
+    proxy.close_server()
+    proxy.accessory.close()
+    
+    metrics = proxy.metrics
+    reasons = ", ".join(f"{reason}={count}" for reason, count in metrics.watchdog_teardowns.items()) or "none"
+    print(f"scenario={scenario_name} engine={engine.value} accessory={accessory_kind}")
+    print(f"  watchdog {reasons}  stuck to session end {(ended - stuck) * 1000:7.1f} ms  "
+          f"teardown {metrics.watchdog_teardown.sum_us / 1000:6.1f} ms  "
+          f"recovery {metrics.last_watchdog_recovery * 1000:6.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the forwarding watchdog ends stuck sessions")
+    parser.add_argument("--scenario", choices=list(SCENARIOS), action="append",
+                        help="Scenario to run, may be repeated (default: all)")
+    parser.add_argument("--engine", choices=[e.value for e in ForwardingEngine], action="append",
+                        help="Forwarding engine, may be repeated (default: all)")
+    parser.add_argument("--accessory", choices=ACCESSORY_KINDS, default="socketpair")
+    args = parser.parse_args()
+    
+    for scenario in args.scenario or list(SCENARIOS):
+        for engine in args.engine or [e.value for e in ForwardingEngine]:
+            run(scenario, ForwardingEngine(engine), args.accessory)
+
+if __name__ == "__main__":
+    main()
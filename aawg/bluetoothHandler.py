@@ -2,64 +2,125 @@ import dbus
 import dbus.service
 import dbus.mainloop.glib
 from gi.repository import GLib
-from typing import Optional, Dict, List
+from dataclasses import replace
+from typing import TYPE_CHECKING, Optional, Dict, List, Callable, Any
 import threading
 import time
 
-from common import Logger, Config, ConnectionStrategy
+from common import Logger, Config, ConfigSnapshot, ConnectionStrategy
+from bluetoothReconnect import ReconnectScheduler, DeviceHistory
+from bluezObjects import BluezObjects
+from sessionTrace import SessionTracer
+
+if TYPE_CHECKING:
+    import asyncio
+    from wifiHandshake import WifiHandshakeProfile
 
-BLUEZ_BUS_NAME = "org.bluez"
 BLUEZ_INTERFACE = "org.bluez.Adapter1"
 BLUEZ_OBJECT_PATH = "/org/bluez/hci0"
+BLUEZ_DEVICE_INTERFACE = "org.bluez.Device1"
 LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
 ADAPTER_ALIAS_PREFIX = "WirelessAADongle-"
 ADAPTER_ALIAS_DONGLE_PREFIX = "AndroidAuto-Dongle-"
 
 class BluetoothHandler:
-    def __init__(self):
+    def __init__(self, bus: Optional[dbus.Bus] = None):
         self.logger = Logger("BluetoothHandler")
-        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-        self.bus = dbus.SystemBus()
+        # Connected in start(), which runs in parallel with the other startup steps
+        self.bus = bus
+        self.objects: Optional[BluezObjects] = None
         self.adapter = None
         self.adapter_path = None
         self.mainloop = GLib.MainLoop()
+        self.mainloop_thread: Optional[threading.Thread] = None
         self.connect_retry_thread = None
         self.should_stop_retry = threading.Event()
+        self.reconnect = ReconnectScheduler()
+        self.device_history = DeviceHistory(
+            Config.instance().get_env("AAWG_BT_HISTORY_FILE", "/persist/aawgd/bluetooth_devices.json"))
         self.advertisement = None
+        self.wifi_handshake: Optional["WifiHandshakeProfile"] = None
+        self.tracer = SessionTracer.instance()
+        self._connect_started: Dict[str, float] = {}
+        
+    # Read on every use, so a reloaded configuration applies to the next connect attempt
+    @property
+    def connect_timeout(self) -> int:
+        return Config.instance().get_env("AAWG_BT_CONNECT_TIMEOUT", 10)
+        
+    @property
+    def max_parallel_connects(self) -> int:
+        return max(1, Config.instance().get_env("AAWG_BT_PARALLEL_CONNECTS", 2))
         
     def init(self):
         """Initialize the Bluetooth handler"""
-        self._init_adapter()
-        self._export_profiles()
+        self.start()
+        self.configure_adapter()
+        self.export_profiles()
         self.logger.info("Bluetooth handler initialized")
         
-    def _init_adapter(self):
-        """Initialize the Bluetooth adapter"""
-        try:
-            obj = self.bus.get_object(BLUEZ_BUS_NAME, BLUEZ_OBJECT_PATH)
-            self.adapter = dbus.Interface(obj, BLUEZ_INTERFACE)
-            self.adapter_path = BLUEZ_OBJECT_PATH
+    def start(self):
+        """Start dispatching D-Bus signals, mirror the BlueZ objects and find the adapter
+        
+        configure_adapter() and export_profiles() only need this step and
+        can run in parallel after it.
+        """
+        # D-Bus is used from the retry thread while the GLib loop dispatches signals
+        dbus.mainloop.glib.threads_init()
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        if self.bus is None:
+            self.bus = dbus.SystemBus()
+        self.objects = BluezObjects(self.bus)
+        self.start_mainloop_thread()
+        self._watch_objects()
+        # A cached proxy, nothing is sent to BlueZ until the adapter is used
+        self.adapter = self.objects.interface(BLUEZ_OBJECT_PATH, BLUEZ_INTERFACE)
+        self.adapter_path = BLUEZ_OBJECT_PATH
+        self.logger.info(f"Using bluetooth adapter at path: {self.adapter_path}")
+        Config.instance().on_reload.append(self._config_reloaded)
+        
+    def _config_reloaded(self, previous: ConfigSnapshot, current: ConfigSnapshot):
+        """Apply a reloaded configuration to what the phone sees, a connected phone stays connected"""
+        if (current.unique_suffix, current.connection_strategy) != (previous.unique_suffix, previous.connection_strategy):
+            self.configure_adapter()
+        if self.wifi_handshake and current.wifi_info != previous.wifi_info:
+            # The proxy stays on the port it was bound to, AAWG_PROXY_PORT needs a restart
+            wifi_info = replace(current.wifi_info, port=self.wifi_handshake.wifi_info.port)
+            if wifi_info != self.wifi_handshake.wifi_info:
+                self.wifi_handshake.set_wifi_info(wifi_info)
+                self.logger.info("Wi-Fi handshake uses the reloaded configuration")
+            
+    def configure_adapter(self):
+        """Set the adapter alias the phone sees"""
+        if not self.adapter:
+            return
             
-            # Set adapter alias
+        try:
             prefix = ADAPTER_ALIAS_DONGLE_PREFIX if Config.instance().get_connection_strategy() == ConnectionStrategy.DONGLE_MODE else ADAPTER_ALIAS_PREFIX
             alias = prefix + Config.instance().get_unique_suffix()
             self.adapter.Set(BLUEZ_INTERFACE, "Alias", alias)
-            
-            self.logger.info(f"Using bluetooth adapter at path: {self.adapter_path}")
             self.logger.info(f"Bluetooth adapter alias: {alias}")
         except dbus.exceptions.DBusException as e:
             self.logger.error(f"Failed to initialize bluetooth adapter: {e}")
             
-    def _export_profiles(self):
+    def export_profiles(self):
         """Export Bluetooth profiles"""
         if not self.adapter:
             return
             
         try:
+            # Loads protobuf, which only this step needs
+            from wifiHandshake import WifiHandshakeProfile
+            
+            # Replies to the phone's RFCOMM connections with the Wi-Fi credentials
+            self.wifi_handshake = WifiHandshakeProfile(
+                self.bus, self._profile_object_path("AAWireless"), Config.instance().get_wifi_info(),
+                timeout=Config.instance().get_env("AAWG_BT_HANDSHAKE_TIMEOUT", 15)
+            )
             self._register_profile("AAWireless", {
                 "Name": "AA Wireless",
                 "Role": "server",
-                "Channel": 8,
+                "Channel": dbus.UInt16(8),
                 "UUID": "4de17a00-52cb-11e6-bdf4-0800200c9a66"
             })
             self.logger.info("Bluetooth AA Wireless profile active")
@@ -75,25 +136,53 @@ class BluetoothHandler:
             
     def _register_profile(self, profile_path: str, properties: Dict):
         """Register a Bluetooth profile"""
-        profile_manager = dbus.Interface(
-            self.bus.get_object(BLUEZ_BUS_NAME, "/org/bluez"),
-            "org.bluez.ProfileManager1"
-        )
+        profile_manager = self.objects.interface("/org/bluez", "org.bluez.ProfileManager1")
         profile_manager.RegisterProfile(
-            f"/com/aawgd/bluetooth/{profile_path}",
+            self._profile_object_path(profile_path),
             properties["UUID"],
             properties
         )
         
+    def _profile_object_path(self, profile_path: str) -> str:
+        return f"/com/aawgd/bluetooth/{profile_path}"
+        
+    def _watch_objects(self):
+        """Mirror the BlueZ objects and follow devices appearing and showing activity to schedule reconnects"""
+        self.objects.on_interfaces_added = self._interfaces_added
+        self.objects.on_interfaces_removed = self._interfaces_removed
+        self.objects.on_properties_changed = self._properties_changed
+        try:
+            self.objects.start()
+        except Exception as e:
+            self.logger.error(f"Failed to watch bluetooth objects: {e}")
+            
+    def _interfaces_added(self, path: str, interfaces: Dict):
+        if BLUEZ_DEVICE_INTERFACE in interfaces:
+            self.logger.info(f"Device {path} appeared")
+            self.reconnect.add(path)
+            
+    def _interfaces_removed(self, path: str, interfaces: List[str]):
+        if BLUEZ_DEVICE_INTERFACE in interfaces:
+            self.reconnect.remove(path)
+            
+    def _properties_changed(self, path: str, interface: str, changed: Dict):
+        # An RSSI update means the device is in range right now
+        if interface == BLUEZ_DEVICE_INTERFACE and "RSSI" in changed:
+            self.reconnect.seen(path)
+        # A phone dropping right after connecting is retried soon, not after max_delay
+        if interface == BLUEZ_DEVICE_INTERFACE and "Connected" in changed and not changed["Connected"]:
+            self.reconnect.disconnected(path)
+            
     def power_on(self):
         """Power on the Bluetooth adapter"""
         if not self.adapter:
             return
             
         try:
-            self.adapter.Set(BLUEZ_INTERFACE, "Powered", True)
-            self.adapter.Set(BLUEZ_INTERFACE, "Discoverable", True)
-            self.adapter.Set(BLUEZ_INTERFACE, "Pairable", True)
+            with self.tracer.span("bluetooth_power_on"):
+                self.adapter.Set(BLUEZ_INTERFACE, "Powered", True)
+                self.adapter.Set(BLUEZ_INTERFACE, "Discoverable", True)
+                self.adapter.Set(BLUEZ_INTERFACE, "Pairable", True)
             self.logger.info("Bluetooth adapter powered on and made discoverable")
             
             if Config.instance().get_connection_strategy() == ConnectionStrategy.DONGLE_MODE:
@@ -104,10 +193,7 @@ class BluetoothHandler:
     def _start_advertising(self):
         """Start BLE advertising"""
         try:
-            ad_manager = dbus.Interface(
-                self.bus.get_object(BLUEZ_BUS_NAME, self.adapter_path),
-                LE_ADVERTISING_MANAGER_IFACE
-            )
+            ad_manager = self.objects.interface(self.adapter_path, LE_ADVERTISING_MANAGER_IFACE)
             
             self.advertisement = Advertisement(self.bus, 0)
             ad_manager.RegisterAdvertisement(
@@ -125,63 +211,149 @@ class BluetoothHandler:
     def _advertising_error_cb(self, error):
         self.logger.error(f"Failed to register advertisement: {error}")
         
+    def reset_connect_retry(self):
+        """Allow the next retry loop to run, stop_connect_with_retry() after this stops it even before it starts"""
+        self.should_stop_retry.clear()
+        
     def connect_with_retry(self) -> Optional[threading.Thread]:
         """Start a thread that attempts to connect to devices"""
         if not self.adapter:
             return None
             
-        self.should_stop_retry.clear()
         self.connect_retry_thread = threading.Thread(target=self._retry_connect_loop)
         self.connect_retry_thread.start()
         return self.connect_retry_thread
         
     def _retry_connect_loop(self):
-        """Loop that continuously attempts to connect to devices"""
+        """Loop that connects to devices whenever one is due"""
+        try:
+            self._load_devices()
+        except Exception as e:
+            self.logger.error(f"Error in connect retry loop: {e}")
+            
         while not self.should_stop_retry.is_set():
-            try:
-                self._connect_device()
-                time.sleep(20)  # Wait before retry
-            except Exception as e:
-                self.logger.error(f"Error in connect retry loop: {e}")
-                
+            self._connect_due_devices()
+            
+            # Sleeps until the next device is due, an attempt completes,
+            # a device shows up or we are stopped
+            self.reconnect.wait(self.reconnect.next_delay())
+            
         if Config.instance().get_connection_strategy() != ConnectionStrategy.DONGLE_MODE:
             self.power_off()
             
-    def _connect_device(self):
-        """Attempt to connect to available devices"""
-        om = dbus.Interface(
-            self.bus.get_object(BLUEZ_BUS_NAME, "/"),
-            "org.freedesktop.DBus.ObjectManager"
-        )
-        objects = om.GetManagedObjects()
-        
-        for path, interfaces in objects.items():
-            if "org.bluez.Device1" not in interfaces:
-                continue
-                
-            device = interfaces["org.bluez.Device1"]
-            self._try_connect_device(path, device)
+    def _load_devices(self):
+        """Make every known device due for a connection attempt"""
+        for path in self.objects.paths_with(BLUEZ_DEVICE_INTERFACE):
+            self.reconnect.add(path)
                 
-    def _try_connect_device(self, path: str, device: Dict):
-        """Try to connect to a specific device"""
+    def _connect_due_devices(self):
+        """Start attempts for due devices, the most recently connected first"""
+        for path in self.device_history.rank(self.reconnect.due()):
+            if self.should_stop_retry.is_set() or self.reconnect.in_flight() >= self.max_parallel_connects:
+                break
+            self._try_connect_device(path)
+            
+    def _try_connect_device(self, path: str):
+        """Start connecting to a specific device, the result arrives on the GLib main loop"""
+        self.reconnect.started(path)
+        self._connect_started[path] = time.monotonic()
         try:
-            device_obj = self.bus.get_object(BLUEZ_BUS_NAME, path)
-            device_iface = dbus.Interface(device_obj, "org.bluez.Device1")
+            device_iface = self.objects.interface(path, BLUEZ_DEVICE_INTERFACE)
             
-            if device.get("Connected", False):
+            if self.objects.get_property(path, BLUEZ_DEVICE_INTERFACE, "Connected", False):
                 self.logger.info(f"Device {path} already connected, disconnecting")
                 device_iface.Disconnect()
                 
             profile_uuid = "" if Config.instance().get_connection_strategy() == ConnectionStrategy.DONGLE_MODE else "00001112-0000-1000-8000-00805f9b34fb"
-            device_iface.ConnectProfile(profile_uuid)
-            self.logger.info(f"Successfully connected to device {path}")
+            device_iface.ConnectProfile(
+                profile_uuid,
+                reply_handler=lambda: self._connect_succeeded(path),
+                error_handler=lambda error: self._connect_failed(path, error),
+                timeout=self.connect_timeout
+            )
         except Exception as e:
-            self.logger.error(f"Failed to connect to device {path}: {e}")
+            self._connect_failed(path, e)
+            
+    def _connect_succeeded(self, path: str):
+        self.logger.info(f"Successfully connected to device {path}")
+        self._trace_connect(path, True)
+        self.device_history.record_connection(path)
+        self.reconnect.succeeded(path)
+        
+    def _connect_failed(self, path: str, error: Exception):
+        self.logger.error(f"Failed to connect to device {path}: {error}")
+        self._trace_connect(path, False)
+        self.reconnect.failed(path)
+        
+    def _trace_connect(self, path: str, connected: bool):
+        started = self._connect_started.pop(path, None)
+        if started is not None:
+            self.tracer.record("bluetooth_connect", started, device=path, connected=connected)
+        
+    async def retry_connect_async(self):
+        """Coroutine version of the connect retry loop, cancel its task to stop it"""
+        if not self.adapter:
+            return
             
+        import asyncio  # Only loaded by the asyncio orchestrator
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        self.reconnect.on_change = lambda: loop.call_soon_threadsafe(changed.set)
+        try:
+            try:
+                await self.call_in_mainloop_async(self._load_devices)
+            except Exception as e:
+                self.logger.error(f"Error in connect retry loop: {e}")
+                
+            while not self.should_stop_retry.is_set():
+                changed.clear()
+                await self.call_in_mainloop_async(self._connect_due_devices)
+                
+                try:
+                    await asyncio.wait_for(changed.wait(), self.reconnect.next_delay())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.reconnect.on_change = None
+            if Config.instance().get_connection_strategy() != ConnectionStrategy.DONGLE_MODE:
+                self.power_off()
+                
+    def start_mainloop_thread(self) -> threading.Thread:
+        """Run the GLib main loop on its own thread to dispatch D-Bus signals and callbacks"""
+        if self.mainloop_thread:
+            return self.mainloop_thread
+        self.mainloop_thread = threading.Thread(target=self.mainloop.run, name="GLibMainLoop", daemon=True)
+        self.mainloop_thread.start()
+        return self.mainloop_thread
+        
+    def call_in_mainloop_async(self, func: Callable[[], Any]) -> "asyncio.Future":
+        """Run func on the GLib main loop thread and resolve the returned future with its result"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        def resolve(result: Any, error: Optional[Exception]):
+            if future.done():  # Cancelled while func was running
+                return
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+                
+        def run() -> bool:
+            try:
+                loop.call_soon_threadsafe(resolve, func(), None)
+            except Exception as e:
+                loop.call_soon_threadsafe(resolve, None, e)
+            return False  # One shot, remove the idle source
+            
+        GLib.idle_add(run)
+        return future
+        
     def stop_connect_with_retry(self):
-        """Stop the connection retry loop"""
-        if self.connect_retry_thread:
-            self.should_stop_retry.set()
+        """Stop the connection retry loop, sticky until reset_connect_retry()"""
+        self.should_stop_retry.set()
+        self.reconnect.wake()
             
     def power_off(self):
         """Power off the Bluetooth adapter"""
@@ -200,10 +372,7 @@ class BluetoothHandler:
         """Stop BLE advertising"""
         if self.advertisement:
             try:
-                ad_manager = dbus.Interface(
-                    self.bus.get_object(BLUEZ_BUS_NAME, self.adapter_path),
-                    LE_ADVERTISING_MANAGER_IFACE
-                )
+                ad_manager = self.objects.interface(self.adapter_path, LE_ADVERTISING_MANAGER_IFACE)
                 ad_manager.UnregisterAdvertisement(self.advertisement.get_path())
                 self.advertisement = None
                 self.logger.info("BLE Advertisement stopped")
@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional
+
+from common import Logger
+
+@dataclass
+class DeviceBackoff:
+    """Retry state of one device"""
+    attempts: int = 0
+    next_attempt: float = 0.0
+    connecting: bool = False  # An attempt is in flight
+
+class ReconnectScheduler:
+    """Decides when each known device should be connected to next
+    
+    Devices are due as soon as they are added or seen again (e.g. an RSSI
+    update while discovering), and back off exponentially after each
+    failed attempt. Every change wakes up wait(), so the retry loop sleeps
+    exactly until the next device is due or something happens.
+    """
+    
+    def __init__(self, initial_delay: float = 2.0, max_delay: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.devices: Dict[str, DeviceBackoff] = {}
+        self.on_change: Optional[Callable[[], None]] = None
+        self._cond = threading.Condition()
+        self._changed = False  # Set between wait() calls so no wakeup is lost
+        
+    def _notify(self):
+        self._changed = True
+        self._cond.notify_all()
+        if self.on_change:
+            self.on_change()
+            
+    def add(self, path: str):
+        """Track a device and make it due now"""
+        with self._cond:
+            self.devices[path] = DeviceBackoff(next_attempt=self.clock())
+            self._notify()
+            
+    def remove(self, path: str):
+        """Forget a device"""
+        with self._cond:
+            if self.devices.pop(path, None):
+                self._notify()
+                
+    def seen(self, path: str):
+        """A device showed signs of being in range, retry it now"""
+        with self._cond:
+            backoff = self.devices.get(path)
+            if backoff is None:
+                self.devices[path] = DeviceBackoff(next_attempt=self.clock())
+            elif backoff.attempts:
+                backoff.attempts = 0
+                backoff.next_attempt = self.clock()
+            else:
+                return
+            self._notify()
+            
+    def started(self, path: str):
+        """Mark an attempt as in flight, the device isn't due until it completes"""
+        with self._cond:
+            self.devices.setdefault(path, DeviceBackoff()).connecting = True
+            
+    def succeeded(self, path: str):
+        """Reset a device's backoff, while it stays connected it is only retried after max_delay"""
+        with self._cond:
+            self.devices[path] = DeviceBackoff(next_attempt=self.clock() + self.max_delay)
+            self._notify()
+            
+    def disconnected(self, path: str):
+        """A device dropped its connection, retry it after initial_delay like a first failure"""
+        with self._cond:
+            backoff = self.devices.get(path)
+            if backoff is None or backoff.connecting:
+                return
+            backoff.attempts = 0
+            backoff.next_attempt = min(backoff.next_attempt, self.clock() + self.initial_delay)
+            self._notify()
+            
+    def failed(self, path: str):
+        """Back off before trying the device again"""
+        with self._cond:
+            backoff = self.devices.setdefault(path, DeviceBackoff())
+            delay = min(self.initial_delay * 2 ** backoff.attempts, self.max_delay)
+            backoff.attempts += 1
+            backoff.next_attempt = self.clock() + delay
+            backoff.connecting = False
+            self._notify()
+            
+    def due(self) -> List[str]:
+        """Get the devices that should be tried now"""
+        now = self.clock()
+        with self._cond:
+            return [path for path, backoff in self.devices.items()
+                    if backoff.next_attempt <= now and not backoff.connecting]
+                    
+    def in_flight(self) -> int:
+        """Get the number of attempts that haven't completed yet"""
+        with self._cond:
+            return sum(1 for backoff in self.devices.values() if backoff.connecting)
+            
+    def next_delay(self) -> Optional[float]:
+        """Get the seconds until the next device is due, None if no device is waiting"""
+        with self._cond:
+            waiting = [backoff.next_attempt for backoff in self.devices.values() if not backoff.connecting]
+            if not waiting:
+                return None
+        return max(0.0, min(waiting) - self.clock())
+        
+    def wait(self, timeout: Optional[float]):
+        """Sleep until timeout passes or the schedule changes"""
+        with self._cond:
+            if not self._changed:
+                self._cond.wait(timeout)
+            self._changed = False
+            
+    def wake(self):
+        """Interrupt wait(), e.g. to stop retrying"""
+        with self._cond:
+            self._notify()
+
+class DeviceHistory:
+    """Successful connections per device, persisted so the ranking survives reboots"""
+    
+    def __init__(self, path: str):
+        self.logger = Logger("DeviceHistory")
+        self.path = path
+        self.devices: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._load()
+        
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                self.devices = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.error(f"Failed to load device history from {self.path}: {e}")
+            
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(self.devices, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.logger.error(f"Failed to save device history to {self.path}: {e}")
+            
+    def record_connection(self, device: str):
+        """Remember a successful connection to device"""
+        with self._lock:
+            entry = self.devices.setdefault(device, {"last_connected": 0.0, "connections": 0})
+            entry["last_connected"] = time.time()
+            entry["connections"] += 1
+            self._save()
+            
+    def rank(self, devices: Iterable[str]) -> List[str]:
+        """Order devices by the most recent successful connection, then by connection count"""
+        def key(device: str):
+            entry = self.devices.get(device, {})
+            return (-entry.get("last_connected", 0.0), -entry.get("connections", 0))
+            
+        with self._lock:
+            return sorted(devices, key=key)
@@ -0,0 +1,128 @@
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import dbus
+
+from common import Logger
+
+BLUEZ_BUS_NAME = "org.bluez"
+OBJECT_MANAGER_INTERFACE = "org.freedesktop.DBus.ObjectManager"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+
+class BluezObjects:
+    """Local mirror of the BlueZ object tree with cached proxies
+    
+    The tree is fetched once with GetManagedObjects and then kept up to date
+    from the ObjectManager and PropertiesChanged signals, so reading a
+    property or finding the devices doesn't need a D-Bus round-trip. Proxies
+    are created without introspection, cached per path and dropped when the
+    object goes away.
+    
+    Signals are dispatched on the GLib main loop thread while the retry
+    thread reads the mirror, so all state is guarded by a lock.
+    """
+    
+    def __init__(self, bus: dbus.Bus):
+        self.logger = Logger("BluezObjects")
+        self.bus = bus
+        self.objects: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._proxies: Dict[str, Any] = {}
+        self._interfaces: Dict[Tuple[str, str], dbus.Interface] = {}
+        self._lock = threading.Lock()
+        self.on_interfaces_added: Optional[Callable[[str, Dict[str, Dict[str, Any]]], None]] = None
+        self.on_interfaces_removed: Optional[Callable[[str, List[str]], None]] = None
+        self.on_properties_changed: Optional[Callable[[str, str, Dict[str, Any]], None]] = None
+        
+    def start(self):
+        """Subscribe to changes, then fetch the current tree"""
+        # Subscribing first means no change between the two is lost
+        self.bus.add_signal_receiver(
+            self._interfaces_added,
+            dbus_interface=OBJECT_MANAGER_INTERFACE,
+            signal_name="InterfacesAdded",
+            bus_name=BLUEZ_BUS_NAME
+        )
+        self.bus.add_signal_receiver(
+            self._interfaces_removed,
+            dbus_interface=OBJECT_MANAGER_INTERFACE,
+            signal_name="InterfacesRemoved",
+            bus_name=BLUEZ_BUS_NAME
+        )
+        self.bus.add_signal_receiver(
+            self._properties_changed,
+            dbus_interface=PROPERTIES_INTERFACE,
+            signal_name="PropertiesChanged",
+            bus_name=BLUEZ_BUS_NAME,
+            path_keyword="path"
+        )
+        
+        objects = self.interface("/", OBJECT_MANAGER_INTERFACE).GetManagedObjects()
+        with self._lock:
+            for path, interfaces in objects.items():
+                self.objects.setdefault(str(path), {}).update(
+                    (str(name), dict(properties)) for name, properties in interfaces.items())
+        self.logger.info(f"Mirroring {len(self.objects)} BlueZ objects")
+        
+    def get_object(self, path: str):
+        """Get the cached proxy of an object"""
+        with self._lock:
+            proxy = self._proxies.get(path)
+            if proxy is None:
+                proxy = self._proxies[path] = self.bus.get_object(BLUEZ_BUS_NAME, path, introspect=False)
+            return proxy
+            
+    def interface(self, path: str, interface: str) -> dbus.Interface:
+        """Get a cached interface of an object"""
+        key = (path, interface)
+        with self._lock:
+            iface = self._interfaces.get(key)
+        if iface is None:
+            iface = dbus.Interface(self.get_object(path), interface)
+            with self._lock:
+                iface = self._interfaces.setdefault(key, iface)
+        return iface
+        
+    def get_property(self, path: str, interface: str, name: str, default: Any = None) -> Any:
+        """Get a property from the mirror"""
+        with self._lock:
+            return self.objects.get(path, {}).get(interface, {}).get(name, default)
+            
+    def paths_with(self, interface: str) -> List[str]:
+        """Get the paths of all objects implementing an interface"""
+        with self._lock:
+            return [path for path, interfaces in self.objects.items() if interface in interfaces]
+            
+    def _interfaces_added(self, path: str, interfaces: Dict):
+        path = str(path)
+        with self._lock:
+            self.objects.setdefault(path, {}).update(
+                (str(name), dict(properties)) for name, properties in interfaces.items())
+        if self.on_interfaces_added:
+            self.on_interfaces_added(path, interfaces)
+            
+    def _interfaces_removed(self, path: str, interfaces: List[str]):
+        path = str(path)
+        with self._lock:
+            known = self.objects.get(path, {})
+            for name in interfaces:
+                known.pop(str(name), None)
+                self._interfaces.pop((path, str(name)), None)
+            if not known:
+                self.objects.pop(path, None)
+                self._proxies.pop(path, None)
+                for key in [key for key in self._interfaces if key[0] == path]:
+                    del self._interfaces[key]
+        if self.on_interfaces_removed:
+            self.on_interfaces_removed(path, interfaces)
+            
+    def _properties_changed(self, interface: str, changed: Dict, invalidated: List[str], path: str = None):
+        path = str(path)
+        interface = str(interface)
+        with self._lock:
+            properties = self.objects.get(path, {}).get(interface)
+            if properties is not None:
+                properties.update(changed)
+                for name in invalidated:
+                    properties.pop(str(name), None)
+        if self.on_properties_changed:
+            self.on_properties_changed(path, interface, changed)
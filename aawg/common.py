@@ -1,19 +1,37 @@
 import os
-import logging
-import logging.handlers  # Add this import
+import sys
+import atexit
+import threading
+import time
 import syslog
+import re
+import importlib.util
+from collections import deque
 from enum import Enum, IntEnum
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, List, Tuple
 from dataclasses import dataclass
 import fcntl
 import socket
 import struct
 
+# Guards the creation of every instance() singleton, startup threads may ask for one at the same time.
+# Re-entrant as creating one singleton gets others, e.g. Config logs through the LogWriter
+SINGLETON_LOCK = threading.RLock()
+
 class ConnectionStrategy(Enum):
     DONGLE_MODE = 0
     PHONE_FIRST = 1
     USB_FIRST = 2
 
+class ForwardingEngine(Enum):
+    COPY = "copy"
+    SPLICE = "splice"
+    EPOLL = "epoll"
+
+class Orchestrator(Enum):
+    THREADS = "threads"
+    ASYNCIO = "asyncio"
+
 class SecurityMode(IntEnum):
     NONE = 0
     WEP = 1
@@ -24,7 +42,7 @@ class AccessPointType(IntEnum):
     STATIC = 0
     DYNAMIC = 1
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class WifiInfo:
     ssid: str
     key: str
@@ -34,118 +52,406 @@ class WifiInfo:
     ip_address: str
     port: int
 
+@dataclass(frozen=True)
+class SocketTuning:
+    tcp_nodelay: bool
+    tcp_quickack: bool
+    tcp_notsent_lowat: int  # 0 keeps the kernel default
+    rcvbuf: int  # 0 keeps kernel autotuning
+    sndbuf: int  # 0 keeps kernel autotuning
+
+@dataclass(frozen=True)
+class WatchdogThresholds:
+    """Seconds after which the watchdog ends a session, 0 disables the check"""
+    idle: float  # Nothing read from the source
+    stall: float  # Queued data not taken by the destination
+
+@dataclass(frozen=True)
+class WatchdogConfig:
+    directions: Dict[str, WatchdogThresholds]  # By direction name, e.g. "TCP->USB"
+    half_close_grace: float  # Seconds a peer may stay half-closed before the session ends
+
+class LogWriter:
+    """Writes log messages to syslog and stderr on a background thread
+    
+    Logging never blocks the caller on I/O: messages go into a bounded
+    queue that one writer thread drains in batches, with a single write to
+    stderr per batch. Once the queue is 3/4 full only every SAMPLE_RATE-th
+    non-error message is kept, and a full queue drops messages. Both count
+    towards dropped, which the writer reports in the log as well.
+    """
+    BATCH_SIZE = 64
+    SAMPLE_RATE = 8
+    REPORT_INTERVAL = 1.0  # Seconds between reports of dropped messages
+    
+    def __init__(self, max_queued: int = 1024, debug: bool = False, stream=None):
+        self.max_queued = max_queued
+        self.pressure = max_queued * 3 // 4
+        self.debug = debug
+        self.stream = stream or sys.stderr
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._reported_at = 0.0
+        self._sampled = 0
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self.thread = threading.Thread(target=self._write_loop, name="LogWriter", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        
+    def put(self, priority: int, name: str, message: str):
+        """Queue a message, never blocks on I/O"""
+        with self._cond:
+            queued = len(self._queue)
+            if queued >= self.max_queued:
+                self.dropped += 1
+                return
+            if queued >= self.pressure and priority != syslog.LOG_ERR:
+                self._sampled += 1
+                if self._sampled % self.SAMPLE_RATE:
+                    self.dropped += 1
+                    return
+            self._queue.append((priority, name, message))
+            if not queued:
+                # The writer only waits on an empty queue
+                self._cond.notify()
+                
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(self.BATCH_SIZE, len(self._queue)))]
+                dropped = 0
+                now = time.monotonic()
+                if self.dropped != self._reported_dropped and (self._stopping or now - self._reported_at >= self.REPORT_INTERVAL):
+                    dropped = self.dropped - self._reported_dropped
+                    self._reported_dropped = self.dropped
+                    self._reported_at = now
+                    
+            if dropped:
+                batch.append((syslog.LOG_WARNING, "Logger", f"Dropped {dropped} log messages under load"))
+            self._write(batch)
+            
+    def _write(self, batch):
+        lines = []
+        for priority, name, message in batch:
+            line = f"{name}: {message}"
+            syslog.syslog(priority, line)
+            lines.append(line)
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except Exception:
+            pass  # Nowhere left to report it
+            
+    def stop(self, timeout: float = 2.0):
+        """Write out what is queued and stop the writer thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self.thread.join(timeout)
+        
+    @staticmethod
+    def instance():
+        """Get singleton instance"""
+        if not hasattr(LogWriter, '_instance'):
+            with SINGLETON_LOCK:
+                if not hasattr(LogWriter, '_instance'):
+                    # Read without Config, which logs through this writer itself and
+                    # can't report an invalid value before the writer exists
+                    try:
+                        max_queued = max(1, int(os.environ.get("AAWG_LOG_QUEUE_SIZE", 1024)))
+                    except ValueError:
+                        max_queued = 1024
+                    LogWriter._instance = LogWriter(
+                        max_queued=max_queued,
+                        debug=os.environ.get("AAWG_LOG_DEBUG", "0") != "0"
+                    )
+        return LogWriter._instance
+
 class Logger:
     """Logging utility that mirrors the C++ version's functionality"""
     
     def __init__(self, name: str):
         self.name = name
-        self.logger = logging.getLogger(name)
+        self.writer = LogWriter.instance()
         
-        # Configure logging to both syslog and stderr
-        syslog_handler = logging.handlers.SysLogHandler(address='/dev/log')
-        stderr_handler = logging.StreamHandler()
-        
-        # Set format
-        formatter = logging.Formatter('%(name)s: %(message)s')
-        syslog_handler.setFormatter(formatter)
-        stderr_handler.setFormatter(formatter)
-        
-        self.logger.addHandler(syslog_handler)
-        self.logger.addHandler(stderr_handler)
-        self.logger.setLevel(logging.INFO)
+    def debug(self, message: str, *args):
+        """Log a debug message, only written with AAWG_LOG_DEBUG set"""
+        if not self.writer.debug:
+            return
+        if args:
+            message = message % args
+        self.writer.put(syslog.LOG_DEBUG, self.name, message)
         
     def info(self, message: str, *args):
         """Log an info message"""
         if args:
             message = message % args
-        self.logger.info(message)
-        syslog.syslog(syslog.LOG_INFO, f"{self.name}: {message}")
+        self.writer.put(syslog.LOG_INFO, self.name, message)
         
     def error(self, message: str, *args):
         """Log an error message"""
         if args:
             message = message % args
-        self.logger.error(message)
-        syslog.syslog(syslog.LOG_ERR, f"{self.name}: {message}")
+        self.writer.put(syslog.LOG_ERR, self.name, message)
         
     @staticmethod
     def instance():
         """Get singleton instance"""
         if not hasattr(Logger, '_instance'):
-            Logger._instance = Logger('AAWG')
+            with SINGLETON_LOCK:
+                if not hasattr(Logger, '_instance'):
+                    Logger._instance = Logger('AAWG')
         return Logger._instance
 
+def parse_env(env: Dict[str, str], name: str, default: Any) -> Any:
+    """Get a variable from env, converted to int if the default is one"""
+    value = env.get(name)
+    if value is None:
+        return default
+        
+    if isinstance(default, int):
+        try:
+            return int(value)
+        except ValueError:
+            return default
+    return value
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """All configuration values, parsed and validated at the same time"""
+    env: Dict[str, str]  # The environment the values were read from
+    connection_strategy: ConnectionStrategy
+    forwarding_engine: ForwardingEngine
+    orchestrator: Orchestrator
+    unique_suffix: str
+    wifi_info: WifiInfo
+    socket_tuning: SocketTuning
+    watchdog: WatchdogConfig
+
+MAC_ADDRESS_PATTERN = re.compile(r"^[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5}$")
+# Becomes part of the bluetooth name
+UNIQUE_SUFFIX_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
 class Config:
-    """Configuration management that mirrors the C++ version's functionality"""
+    """Configuration management that mirrors the C++ version's functionality
+    
+    Values are read from the environment once into a ConfigSnapshot, so the
+    getters don't parse anything or touch sysfs. reload() runs the
+    configuration file again, e.g. on SIGHUP, and only switches to the new
+    snapshot if all of its values are valid. At startup the init script has
+    already applied the file to the environment.
+    """
+    CONF_FILE = "/etc/aawgd.conf.py"
+    # Read once by the handlers, changing them needs a restart
+    RESTART_OPTIONS = ("AAWG_ORCHESTRATOR", "AAWG_PROXY_ENGINE", "AAWG_PROXY_PORT", "AAWG_PROXY_ENDPOINTS",
+                       "AAWG_METRICS_FILE", "AAWG_METRICS_INTERVAL", "AAWG_TRACE_FILE", "AAWG_TRACE_CHROME_FILE",
+                       "AAWG_LOG_QUEUE_SIZE", "AAWG_LOG_DEBUG", "AAWG_BT_HISTORY_FILE", "AAWG_UEVENT_FILTER",
+                       "AAWG_USB_GADGET_PATH", "AAWG_USB_UDC_PATH")
     
-    def __init__(self):
-        self._connection_strategy: Optional[ConnectionStrategy] = None
+    def __init__(self, env: Optional[Dict[str, str]] = None):
         self.logger = Logger("Config")
+        self._mac_addresses: Dict[str, str] = {}
+        self._serial_suffix: Optional[str] = None
+        # Called with the previous and the new snapshot after a reload
+        self.on_reload: List[Callable[[ConfigSnapshot, ConfigSnapshot], None]] = []
+        self._reload_lock = threading.Lock()
+        self.snapshot, errors = self._load(dict(os.environ if env is None else env))
+        for error in errors:
+            self.logger.error(f"{error}, using the default")
+            
+    def _load(self, env: Dict[str, str]) -> Tuple[ConfigSnapshot, List[str]]:
+        """Parse and validate the values in env, invalid ones are reported and replaced by their default"""
+        errors: List[str] = []
         
-    def get_env(self, name: str, default: Any) -> Any:
-        """Get environment variable with default value"""
-        value = os.environ.get(name)
-        if value is None:
-            return default
+        def get(name: str, default: Any) -> Any:
+            if isinstance(default, int) and name in env:
+                try:
+                    return int(env[name])
+                except ValueError:
+                    errors.append(f"{name}={env[name]} is not a number")
+                    return default
+            return env.get(name, default)
             
-        if isinstance(default, int):
+        def choice(name: str, kind, default):
+            value = get(name, default.value)
             try:
-                return int(value)
+                return kind(value.lower() if isinstance(value, str) else value)
             except ValueError:
+                errors.append(f"{name}={value} is not one of {', '.join(str(item.value) for item in kind)}")
                 return default
-        return value
+                
+        engine = choice("AAWG_PROXY_ENGINE", ForwardingEngine, ForwardingEngine.COPY)
+        if engine == ForwardingEngine.SPLICE and not hasattr(os, "splice"):
+            self.logger.error("splice() is not available on this platform, using copy")
+            engine = ForwardingEngine.COPY
+            
+        suffix = get("AAWG_UNIQUE_NAME_SUFFIX", "") or self._read_serial_suffix()
+        if not UNIQUE_SUFFIX_PATTERN.match(suffix):
+            errors.append(f"AAWG_UNIQUE_NAME_SUFFIX={suffix} must be 1 to 32 letters, digits, - or _")
+            suffix = self._read_serial_suffix()
+            
+        bssid = get("AAWG_WIFI_BSSID", "") or self.get_mac_address("wlan0")
+        if not MAC_ADDRESS_PATTERN.match(bssid):
+            errors.append(f"AAWG_WIFI_BSSID={bssid} is not a MAC address like 01:23:45:67:89:ab")
+            bssid = self.get_mac_address("wlan0")
+            
+        key = get("AAWG_WIFI_PASSWORD", "ConnectAAWirelessDongle")
+        if not 8 <= len(key) <= 63:
+            errors.append("AAWG_WIFI_PASSWORD must have 8 to 63 characters for WPA2")
+            key = "ConnectAAWirelessDongle"
+            
+        port = get("AAWG_PROXY_PORT", 5288)
+        if not 0 <= port <= 65535:
+            errors.append(f"AAWG_PROXY_PORT={port} is not a port number")
+            port = 5288
+            
+        def milliseconds(name: str, default: int) -> float:
+            value = get(name, default)
+            if value < 0:
+                errors.append(f"{name}={value} must not be negative")
+                value = default
+            return value / 1000
+            
+        snapshot = ConfigSnapshot(
+            env=env,
+            connection_strategy=choice("AAWG_CONNECTION_STRATEGY", ConnectionStrategy, ConnectionStrategy.PHONE_FIRST),
+            forwarding_engine=engine,
+            orchestrator=choice("AAWG_ORCHESTRATOR", Orchestrator, Orchestrator.THREADS),
+            unique_suffix=suffix,
+            wifi_info=WifiInfo(
+                ssid=get("AAWG_WIFI_SSID", "AAWirelessDongle"),
+                key=key,
+                bssid=bssid,
+                security_mode=SecurityMode.WPA2_PERSONAL,
+                access_point_type=AccessPointType.DYNAMIC,
+                ip_address=get("AAWG_PROXY_IP_ADDRESS", "10.0.0.1"),
+                port=port
+            ),
+            socket_tuning=SocketTuning(
+                tcp_nodelay=get("AAWG_PROXY_TCP_NODELAY", 1) != 0,
+                tcp_quickack=get("AAWG_PROXY_TCP_QUICKACK", 1) != 0,
+                tcp_notsent_lowat=get("AAWG_PROXY_TCP_NOTSENT_LOWAT", 16384),
+                rcvbuf=get("AAWG_PROXY_SO_RCVBUF", 0),
+                sndbuf=get("AAWG_PROXY_SO_SNDBUF", 0)
+            ),
+            watchdog=WatchdogConfig(
+                directions={
+                    "TCP->USB": WatchdogThresholds(
+                        idle=milliseconds("AAWG_WATCHDOG_TCP_USB_IDLE_MS", 30000),
+                        stall=milliseconds("AAWG_WATCHDOG_TCP_USB_STALL_MS", 10000)
+                    ),
+                    "USB->TCP": WatchdogThresholds(
+                        idle=milliseconds("AAWG_WATCHDOG_USB_TCP_IDLE_MS", 30000),
+                        stall=milliseconds("AAWG_WATCHDOG_USB_TCP_STALL_MS", 10000)
+                    ),
+                },
+                half_close_grace=milliseconds("AAWG_WATCHDOG_HALF_CLOSE_MS", 1000)
+            )
+        )
+        return snapshot, errors
+        
+    def reload(self) -> bool:
+        """Run the configuration file again and switch to its values, keeps the current ones if any is invalid"""
+        with self._reload_lock:
+            path = self.get_env("AAWG_CONF_FILE", self.CONF_FILE)
+            try:
+                spec = importlib.util.spec_from_file_location("aawgd_conf", path)
+                spec.loader.exec_module(importlib.util.module_from_spec(spec))
+            except Exception as e:
+                self.logger.error(f"Failed to load {path}, keeping the current configuration: {e}")
+                return False
+                
+            snapshot, errors = self._load(dict(os.environ))
+            if errors:
+                for error in errors:
+                    self.logger.error(error)
+                self.logger.error(f"Invalid values in {path}, keeping the current configuration")
+                return False
+                
+            previous, self.snapshot = self.snapshot, snapshot
+            
+        changed = sorted(name for name in set(previous.env) | set(snapshot.env)
+                         if name.startswith("AAWG_") and previous.env.get(name) != snapshot.env.get(name))
+        self.logger.info(f"Reloaded {path}, changed: {', '.join(changed) or 'nothing'}")
+        for name in changed:
+            if name in self.RESTART_OPTIONS:
+                self.logger.info(f"{name} takes effect after a restart")
+                
+        for callback in self.on_reload:
+            try:
+                callback(previous, snapshot)
+            except Exception as e:
+                self.logger.error(f"Error applying the reloaded configuration: {e}")
+        return True
+        
+    def get_env(self, name: str, default: Any) -> Any:
+        """Get environment variable with default value"""
+        return parse_env(self.snapshot.env, name, default)
         
     def get_mac_address(self, interface: str) -> str:
         """Get MAC address of network interface"""
-        try:
-            with open(f"/sys/class/net/{interface}/address") as f:
-                return f.read().strip()
-        except Exception as e:
-            self.logger.error(f"Failed to get MAC address for {interface}: {e}")
-            return "00:00:00:00:00:00"
-            
+        address = self._mac_addresses.get(interface)
+        if address is None:
+            try:
+                with open(f"/sys/class/net/{interface}/address") as f:
+                    address = f.read().strip()
+            except Exception as e:
+                self.logger.error(f"Failed to get MAC address for {interface}: {e}")
+                return "00:00:00:00:00:00"
+            self._mac_addresses[interface] = address
+        return address
+        
+    def _read_serial_suffix(self) -> str:
+        if self._serial_suffix is None:
+            try:
+                with open("/sys/firmware/devicetree/base/serial-number") as f:
+                    serial = f.read().strip('\0')
+                    # Pad with zeros and take last 6 characters
+                    self._serial_suffix = ("00000000" + serial)[-6:]
+            except Exception as e:
+                self.logger.error(f"Failed to get serial number: {e}")
+                return "000000"
+        return self._serial_suffix
+        
     def get_unique_suffix(self) -> str:
         """Get unique suffix for device naming"""
-        suffix = self.get_env("AAWG_UNIQUE_NAME_SUFFIX", "")
-        if suffix:
-            return suffix
-            
-        try:
-            with open("/sys/firmware/devicetree/base/serial-number") as f:
-                serial = f.read().strip('\0')
-                # Pad with zeros and take last 6 characters
-                return ("00000000" + serial)[-6:]
-        except Exception as e:
-            self.logger.error(f"Failed to get serial number: {e}")
-            return "000000"
-            
+        return self.snapshot.unique_suffix
+        
     def get_wifi_info(self) -> WifiInfo:
         """Get WiFi configuration information"""
-        return WifiInfo(
-            ssid=self.get_env("AAWG_WIFI_SSID", "AAWirelessDongle"),
-            key=self.get_env("AAWG_WIFI_PASSWORD", "ConnectAAWirelessDongle"),
-            bssid=self.get_env("AAWG_WIFI_BSSID", self.get_mac_address("wlan0")),
-            security_mode=SecurityMode.WPA2_PERSONAL,
-            access_point_type=AccessPointType.DYNAMIC,
-            ip_address=self.get_env("AAWG_PROXY_IP_ADDRESS", "10.0.0.1"),
-            port=self.get_env("AAWG_PROXY_PORT", 5288)
-        )
+        return self.snapshot.wifi_info
+        
+    def get_socket_tuning(self) -> SocketTuning:
+        """Get the socket options applied to the phone's TCP connection"""
+        return self.snapshot.socket_tuning
+        
+    def get_watchdog_config(self) -> WatchdogConfig:
+        """Get the liveness limits of the forwarding directions"""
+        return self.snapshot.watchdog
         
     def get_connection_strategy(self) -> ConnectionStrategy:
         """Get connection strategy configuration"""
-        if self._connection_strategy is None:
-            strategy_value = self.get_env("AAWG_CONNECTION_STRATEGY", 1)
-            
-            try:
-                self._connection_strategy = ConnectionStrategy(strategy_value)
-            except ValueError:
-                self._connection_strategy = ConnectionStrategy.PHONE_FIRST
-                
-        return self._connection_strategy
+        return self.snapshot.connection_strategy
+        
+    def get_forwarding_engine(self) -> ForwardingEngine:
+        """Get the proxy forwarding engine configuration"""
+        return self.snapshot.forwarding_engine
+        
+    def get_orchestrator(self) -> Orchestrator:
+        """Get how the daemon runs its session lifecycle"""
+        return self.snapshot.orchestrator
         
     @staticmethod
     def instance():
         """Get singleton instance"""
         if not hasattr(Config, '_instance'):
-            Config._instance = Config()
+            with SINGLETON_LOCK:
+                if not hasattr(Config, '_instance'):
+                    Config._instance = Config()
         return Config._instance
@@ -0,0 +1,122 @@
+import select
+import threading
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence
+
+from common import Logger, WatchdogConfig
+
+if TYPE_CHECKING:
+    from proxyHandler import ForwardDirection
+
+# Linux value, not exported by the select module everywhere
+POLLRDHUP = getattr(select, "POLLRDHUP", 0x2000)
+
+class WatchdogReason(Enum):
+    IDLE = "idle"  # A source stopped sending
+    STALL = "stall"  # A destination stopped taking data
+    HALF_CLOSE = "half_close"  # A peer shut down its sending side and the session didn't end
+    HANGUP = "hangup"  # An end reported a hangup or an error
+
+@dataclass(slots=True)
+class WatchdogExpiry:
+    reason: WatchdogReason
+    subject: str  # Direction name, or the end for half-close and hangup
+    silent: float  # Seconds without progress
+
+class ForwardWatchdog:
+    """Ends a session whose forwarding no longer makes progress
+    
+    Once its source sent something, each direction has to keep reading
+    from it within its idle limit, and data it queued has to be taken by the destination within its stall
+    limit. A peer that shuts down its sending side normally ends the session
+    through EOF; if the half-closed socket is still around after the grace
+    period, the direction reading it is stuck. A hangup or error on either
+    end is acted on right away. The checks run on their own thread, so a
+    forwarding thread blocked in a syscall can't hold them up.
+    """
+    MIN_INTERVAL = 0.01
+    MAX_INTERVAL = 1.0
+    
+    def __init__(self, config: WatchdogConfig, on_expired: Callable[[WatchdogExpiry], None]):
+        self.logger = Logger("ForwardWatchdog")
+        self.config = config
+        self.on_expired = on_expired
+        self.directions: List["ForwardDirection"] = []
+        self.ends: Dict[int, str] = {}
+        self.should_exit = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self._poller = select.poll()
+        self._half_closed: Dict[int, int] = {}  # monotonic_ns() when each end was first seen half-closed
+        
+        # Check often enough to act within a quarter of the shortest limit
+        limits = [limit for thresholds in config.directions.values()
+                  for limit in (thresholds.idle, thresholds.stall) if limit]
+        if config.half_close_grace:
+            limits.append(config.half_close_grace)
+        self.interval = min(self.MAX_INTERVAL, max(self.MIN_INTERVAL, min(limits, default=0) / 4))
+        
+    @property
+    def enabled(self) -> bool:
+        if self.config.half_close_grace:
+            return True
+        return any(thresholds.idle or thresholds.stall for thresholds in self.config.directions.values())
+        
+    def start(self, directions: Sequence["ForwardDirection"], ends: Dict[int, str]) -> Optional[threading.Thread]:
+        """Watch the directions of a session and its ends, given as fd and name"""
+        if not self.enabled:
+            return None
+        self.directions = list(directions)
+        self.ends = ends
+        self._half_closed = {}
+        self._poller = select.poll()
+        for fd in ends:
+            # Hangups and errors are always reported
+            self._poller.register(fd, POLLRDHUP)
+        self.should_exit.clear()
+        self.thread = threading.Thread(target=self._watch_loop, name="Watchdog", daemon=True)
+        self.thread.start()
+        return self.thread
+        
+    def _watch_loop(self):
+        while not self.should_exit.wait(self.interval):
+            expiry = self.check(time.monotonic_ns())
+            if expiry:
+                self.on_expired(expiry)
+                return
+                
+    def check(self, now: int) -> Optional[WatchdogExpiry]:
+        """Run all checks once, now is a monotonic_ns() timestamp"""
+        for direction in self.directions:
+            thresholds = self.config.directions.get(direction.name)
+            if not thresholds:
+                continue
+                
+            if thresholds.stall and direction.queue_depth:
+                # The stall clock starts when data was queued or last taken, whichever is later
+                since = max(direction.last_write, direction.queued_since or direction.last_read)
+                if now - since > thresholds.stall * 1e9:
+                    return WatchdogExpiry(WatchdogReason.STALL, direction.name, (now - since) / 1e9)
+                    
+            if thresholds.idle and direction.last_read and now - direction.last_read > thresholds.idle * 1e9:
+                return WatchdogExpiry(WatchdogReason.IDLE, direction.name, (now - direction.last_read) / 1e9)
+                
+        for fd, events in self._poller.poll(0):
+            end = self.ends.get(fd, str(fd))
+            if events & (select.POLLHUP | select.POLLERR):
+                return WatchdogExpiry(WatchdogReason.HANGUP, end, 0.0)
+            if events & POLLRDHUP and self.config.half_close_grace:
+                since = self._half_closed.setdefault(fd, now)
+                if now - since > self.config.half_close_grace * 1e9:
+                    return WatchdogExpiry(WatchdogReason.HALF_CLOSE, end, (now - since) / 1e9)
+        return None
+        
+    def stop(self):
+        """Stop watching, must not be called from on_expired"""
+        self.should_exit.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.directions = []
+        self.ends = {}
@@ -0,0 +1,130 @@
+from enum import IntEnum
+from typing import List, NamedTuple, Union
+
+# Android Auto transport frame layout:
+#   byte 0     channel id
+#   byte 1     flags (frame type, control, encrypted)
+#   bytes 2-3  payload length of this frame (big endian)
+#   bytes 4-7  total message length, only on the first frame of a multi-frame message
+FRAME_HEADER_SIZE = 4
+FRAME_EXT_HEADER_SIZE = 4
+
+FRAME_TYPE_FIRST = 1 << 0
+FRAME_TYPE_LAST = 1 << 1
+FRAME_TYPE_MASK = FRAME_TYPE_FIRST | FRAME_TYPE_LAST
+FRAME_CONTROL = 1 << 2
+FRAME_ENCRYPTED = 1 << 3
+
+MAX_CHANNELS = 256
+
+class Channel(IntEnum):
+    """Channel ids as assigned by aasdk based head units"""
+    CONTROL = 0
+    INPUT = 1
+    SENSOR = 2
+    VIDEO = 3
+    MEDIA_AUDIO = 4
+    SPEECH_AUDIO = 5
+    SYSTEM_AUDIO = 6
+    AV_INPUT = 7
+    BLUETOOTH = 8
+
+class FrameInfo(NamedTuple):
+    """Metadata of one Android Auto transport frame"""
+    channel: int
+    flags: int
+    length: int  # Payload bytes following the header
+    header_size: int
+    
+    @property
+    def size(self) -> int:
+        return self.header_size + self.length
+        
+    @property
+    def encrypted(self) -> bool:
+        return bool(self.flags & FRAME_ENCRYPTED)
+
+def header_size(flags: int) -> int:
+    """Get the header size of a frame with the given flags"""
+    if (flags & FRAME_TYPE_MASK) == FRAME_TYPE_FIRST:
+        return FRAME_HEADER_SIZE + FRAME_EXT_HEADER_SIZE
+    return FRAME_HEADER_SIZE
+
+def encode_frame(channel: int, flags: int, payload: bytes, total_length: int = 0) -> bytes:
+    """Build a frame, adding the extended header for a FIRST-only frame"""
+    header = bytes([channel, flags, len(payload) >> 8, len(payload) & 0xff])
+    if header_size(flags) != FRAME_HEADER_SIZE:
+        header += (total_length or len(payload)).to_bytes(4, "big")
+    return header + payload
+
+class FrameParser:
+    """Incremental parser that follows frame boundaries in a byte stream
+    
+    The parser only looks at headers: payload bytes are skipped in place
+    and never copied, and at most one partial header is carried between
+    feed() calls, so it can observe a forwarded stream without buffering it.
+    """
+    
+    def __init__(self):
+        self._header = bytearray(FRAME_HEADER_SIZE + FRAME_EXT_HEADER_SIZE)
+        self._header_len = 0
+        self._remaining = 0
+        self.frames = 0
+        self.channel_frames = [0] * MAX_CHANNELS
+        self.channel_bytes = [0] * MAX_CHANNELS
+        
+    @property
+    def at_boundary(self) -> bool:
+        """True if the data fed so far ends exactly on a frame boundary"""
+        return self._remaining == 0 and self._header_len == 0
+        
+    def feed(self, data: Union[bytes, bytearray, memoryview]) -> List[FrameInfo]:
+        """Consume a chunk of the stream and return the frames that start in it"""
+        frames = []
+        channel_frames = self.channel_frames
+        channel_bytes = self.channel_bytes
+        pos = 0
+        end = len(data)
+        
+        while pos < end:
+            if self._remaining:
+                skipped = min(self._remaining, end - pos)
+                self._remaining -= skipped
+                pos += skipped
+                continue
+                
+            if not self._header_len and end - pos >= FRAME_HEADER_SIZE:
+                # Fast path, the header is contiguous in this chunk
+                flags = data[pos + 1]
+                size = 8 if (flags & FRAME_TYPE_MASK) == FRAME_TYPE_FIRST else 4
+                if end - pos >= size:
+                    channel = data[pos]
+                    length = (data[pos + 2] << 8) | data[pos + 3]
+                    frames.append(FrameInfo(channel, flags, length, size))
+                    channel_frames[channel] += 1
+                    channel_bytes[channel] += length
+                    self._remaining = length
+                    pos += size
+                    continue
+                    
+            # Header split across chunks, collect it byte by byte
+            self._header[self._header_len] = data[pos]
+            self._header_len += 1
+            pos += 1
+            if self._header_len < FRAME_HEADER_SIZE:
+                continue
+                
+            header = self._header
+            size = header_size(header[1])
+            if self._header_len < size:
+                continue
+                
+            frame = FrameInfo(header[0], header[1], (header[2] << 8) | header[3], size)
+            frames.append(frame)
+            channel_frames[frame.channel] += 1
+            channel_bytes[frame.channel] += frame.length
+            self._remaining = frame.length
+            self._header_len = 0
+            
+        self.frames += len(frames)
+        return frames
@@ -0,0 +1,121 @@
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple, Union
+
+from frameParser import Channel, FRAME_HEADER_SIZE, FRAME_ENCRYPTED, header_size
+
+# Lower values are written first
+DEFAULT_CHANNEL_PRIORITIES = {
+    Channel.CONTROL: 0,
+    Channel.INPUT: 0,
+    Channel.MEDIA_AUDIO: 1,
+    Channel.SPEECH_AUDIO: 1,
+    Channel.SYSTEM_AUDIO: 1,
+    Channel.AV_INPUT: 1,
+    Channel.SENSOR: 1,
+    Channel.BLUETOOTH: 1,
+}
+DEFAULT_PRIORITY = 2  # Video and channels we don't know about
+
+class FrameScheduler:
+    """Queue that hands out complete frames in channel priority order
+    
+    Frames of one channel always leave in the order they arrived. All
+    encrypted frames share one TLS session, so they also keep their order
+    relative to each other; only plaintext frames can overtake them.
+    """
+    
+    def __init__(self, priorities: Optional[Dict[int, int]] = None,
+                 default_priority: int = DEFAULT_PRIORITY):
+        self.priorities = dict(DEFAULT_CHANNEL_PRIORITIES if priorities is None else priorities)
+        self.default_priority = default_priority
+        self._partial = bytearray()
+        self._queues: Dict[int, Deque[Tuple[int, bool, bytes]]] = {}
+        self._encrypted: Deque[int] = deque()
+        self._seq = 0
+        self._queued_bytes = 0
+        self.queued_frames = 0
+        self.promoted_frames = 0  # Frames written ahead of an older frame
+        
+    @property
+    def queued_bytes(self) -> int:
+        """Bytes pushed but not popped yet, including an incomplete frame"""
+        return self._queued_bytes + len(self._partial)
+        
+    def push(self, data: Union[bytes, bytearray, memoryview]):
+        """Split a chunk of the stream into frames and queue them"""
+        if self._partial:
+            self._partial += data
+            consumed = self._split(self._partial)
+            del self._partial[:consumed]
+        else:
+            consumed = self._split(data)
+            self._partial += memoryview(data)[consumed:]
+            
+    def _split(self, data) -> int:
+        """Queue every complete frame in data, returns the bytes consumed"""
+        pos = 0
+        end = len(data)
+        with memoryview(data) as view:
+            while end - pos >= FRAME_HEADER_SIZE:
+                flags = data[pos + 1]
+                size = header_size(flags) + ((data[pos + 2] << 8) | data[pos + 3])
+                if end - pos < size:
+                    break
+                self._enqueue(data[pos], flags, bytes(view[pos:pos + size]))
+                pos += size
+        return pos
+        
+    def _enqueue(self, channel: int, flags: int, frame: bytes):
+        self._seq += 1
+        encrypted = bool(flags & FRAME_ENCRYPTED)
+        if encrypted:
+            self._encrypted.append(self._seq)
+            
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = deque()
+        queue.append((self._seq, encrypted, frame))
+        self._queued_bytes += len(frame)
+        self.queued_frames += 1
+        
+    def pop(self) -> Optional[bytes]:
+        """Get the next frame to write, or None if no complete frame is queued"""
+        if not self.queued_frames:
+            return None
+            
+        oldest_encrypted = self._encrypted[0] if self._encrypted else None
+        oldest_seq = None
+        best_key = None
+        best_queue = None
+        
+        for channel, queue in self._queues.items():
+            if not queue:
+                continue
+            seq, encrypted, _ = queue[0]
+            if oldest_seq is None or seq < oldest_seq:
+                oldest_seq = seq
+            if encrypted and seq != oldest_encrypted:
+                continue
+            key = (self.priorities.get(channel, self.default_priority), seq)
+            if best_key is None or key < best_key:
+                best_key = key
+                best_queue = queue
+                
+        seq, encrypted, frame = best_queue.popleft()
+        if encrypted:
+            self._encrypted.popleft()
+        if seq != oldest_seq:
+            self.promoted_frames += 1
+        self._queued_bytes -= len(frame)
+        self.queued_frames -= 1
+        return frame
+        
+    def pop_batch(self, limit: int) -> bytes:
+        """Pop frames in priority order until at least limit bytes are collected"""
+        frames = []
+        size = 0
+        while size < limit and self.queued_frames:
+            frame = self.pop()
+            frames.append(frame)
+            size += len(frame)
+        return b"".join(frames)
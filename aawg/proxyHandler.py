@@ -2,112 +2,518 @@ import socket
 import threading
 import select
 import os
+import errno
 import signal
+import sys
 import time
-from typing import Optional, Tuple
-from dataclasses import dataclass
+from functools import partial
+from typing import TYPE_CHECKING, Optional, Tuple, Dict, List, Set, Callable
+from dataclasses import dataclass, field
 
-from common import Logger, Config, ConnectionStrategy
-from bluetoothHandler import BluetoothHandler
+from common import Logger, Config, ConnectionStrategy, ForwardingEngine, SocketTuning, WatchdogConfig
+from frameParser import FrameParser, FRAME_HEADER_SIZE, header_size
+from frameScheduler import FrameScheduler
+from proxyMetrics import ProxyMetrics, DirectionMetrics
+from sessionTrace import SessionTracer
+from sessionCapture import SessionCapture, DIRECTIONS as CAPTURE_DIRECTIONS
+from forwardWatchdog import ForwardWatchdog, WatchdogExpiry
 
-@dataclass
+if TYPE_CHECKING:
+    import asyncio  # Loaded at runtime by the asyncio orchestrator only
+
+# Linux value, not exported by the socket module
+TCP_NOTSENT_LOWAT = getattr(socket, "TCP_NOTSENT_LOWAT", 25)
+
+class AdaptiveReadSize:
+    """Read size that follows the traffic of one direction
+    
+    A read that fills the whole buffer means more data is waiting, as in a
+    video burst, so the size doubles to save syscalls. A run of small reads
+    means interactive traffic, and the size halves again to keep buffer
+    allocation cheap and the forwarding loop responsive.
+    """
+    SHRINK_AFTER = 8  # Consecutive small reads before shrinking
+    
+    def __init__(self, initial: int, minimum: int = 0, maximum: int = 0):
+        self.size = initial
+        self.minimum = minimum or initial
+        self.maximum = maximum or initial
+        self._small_reads = 0
+        
+    def update(self, length: int):
+        """Adjust the size after a read returned length bytes"""
+        if length >= self.size:
+            self._small_reads = 0
+            if self.size < self.maximum:
+                self.size = min(self.size * 2, self.maximum)
+        elif length <= self.size // 4:
+            self._small_reads += 1
+            if self._small_reads >= self.SHRINK_AFTER and self.size > self.minimum:
+                self.size = max(self.size // 2, self.minimum)
+                self._small_reads = 0
+        else:
+            self._small_reads = 0
+
+@dataclass(slots=True)
+class ForwardDirection:
+    """State of one forwarding direction"""
+    src_name: str
+    dst_name: str
+    src_fd: int
+    dst_fd: int
+    pending: bytearray = field(default_factory=bytearray)
+    in_flight: int = 0  # Bytes read but not yet written outside of pending
+    paused: bool = False  # Reads stopped until the destination catches up
+    parser: Optional[FrameParser] = None
+    scheduler: Optional[FrameScheduler] = None
+    metrics: Optional[DirectionMetrics] = None
+    read_size: AdaptiveReadSize = field(default_factory=lambda: AdaptiveReadSize(ProxyHandler.BUFFER_SIZE))
+    queued_since: int = 0  # monotonic_ns() when the oldest queued byte was read
+    # monotonic_ns() of the last read from the source and write to the destination, for the watchdog.
+    # last_read stays 0 until the first read
+    last_read: int = 0
+    last_write: int = 0
+    capture: Optional[Callable[[bytes], None]] = None  # Records the data read from the source
+    first_write_traced: bool = False
+    blocking_dst: bool = False  # The destination can't be polled, a helper thread writes to it
+    closed: bool = False  # Forwarding of the session stopped, helper threads may outlive it
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    drained: threading.Condition = field(init=False)
+    queued: threading.Condition = field(init=False)  # Signals a blocking writer that there is output
+    
+    def __post_init__(self):
+        self.drained = threading.Condition(self.lock)
+        self.queued = threading.Condition(self.lock)
+        if self.metrics is None:
+            self.metrics = DirectionMetrics(self.name)
+        
+    @property
+    def name(self) -> str:
+        return f"{self.src_name}->{self.dst_name}"
+        
+    @property
+    def queue_depth(self) -> int:
+        """Bytes accepted from the source that the destination hasn't taken yet"""
+        depth = len(self.pending) + self.in_flight
+        if self.scheduler:
+            depth += self.scheduler.queued_bytes
+        return depth
+        
+    @property
+    def has_output(self) -> bool:
+        """True if there is data ready to be written to the destination"""
+        return bool(self.pending) or bool(self.scheduler and self.scheduler.queued_frames)
+
+@dataclass(slots=True)
 class ProxyConnection:
     usb_fd: int = -1
     tcp_fd: int = -1
     usb_tcp_thread: Optional[threading.Thread] = None
     tcp_usb_thread: Optional[threading.Thread] = None
+    directions: List[ForwardDirection] = field(default_factory=list)
+
+# errno values returned by splice() when an fd does not implement it
+SPLICE_UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
 
 class ProxyHandler:
     BUFFER_SIZE = 16384
+    # Queued bytes at which a direction stops reading, and resumes below
+    PENDING_HIGH_WATER = 4 * BUFFER_SIZE
+    PENDING_LOW_WATER = BUFFER_SIZE
+    # A deeper queue gives the frame scheduler a backlog to reorder
+    PRIORITY_HIGH_WATER = 16 * BUFFER_SIZE
+    # Bounds of the adaptive read size, BUFFER_SIZE is the starting point
+    MIN_READ_SIZE = 4096
+    MAX_READ_SIZE = 65536
+    # Longest a paused reader sleeps before checking whether forwarding stopped
+    DRAIN_WAIT = 0.1
+    USB_ACCESSORY_PATH = "/dev/usb_accessory"
     
-    def __init__(self):
+    def __init__(self, accessory_path: str = USB_ACCESSORY_PATH,
+                 engine: Optional[ForwardingEngine] = None,
+                 parse_frames: Optional[bool] = None,
+                 prioritize: Optional[bool] = None,
+                 adaptive_reads: Optional[bool] = None,
+                 socket_tuning: Optional[SocketTuning] = None,
+                 watchdog: Optional[WatchdogConfig] = None):
         self.logger = Logger("ProxyHandler")
         self.connection = ProxyConnection()
         self.should_exit = threading.Event()
         self.log_communication = False
+        self.accessory_path = accessory_path
+        self.engine = engine or Config.instance().get_forwarding_engine()
+        # Options left at None are read for every session, so a reloaded configuration applies to the next one
+        self._parse_frames = parse_frames
+        self._prioritize = prioritize
+        self._adaptive_reads = adaptive_reads
+        self._socket_tuning = socket_tuning
+        self._read_session_options()
+        self.watchdog_config = watchdog
+        self.watchdog: Optional[ForwardWatchdog] = None
+        self._watchdog_fired: Optional[float] = None
+        self.capture: Optional[SessionCapture] = None
+        self.on_client_connected: Optional[Callable[[], None]] = None
+        # Blocks a connected session until the accessory may be opened
+        self.wait_accessory_ready: Optional[Callable[[], None]] = None
+        # Unblocks reads and writes on the accessory after the watchdog ended a session
+        self.on_watchdog_expired: Optional[Callable[[], None]] = None
+        self.client_connected = threading.Event()
+        self.server_sock: Optional[socket.socket] = None
+        self.server_port: Optional[int] = None
+        self._session_ended: Optional[float] = None
+        self.metrics = ProxyMetrics()
+        self.metrics.engine = self.engine.value
+        self.tracer = SessionTracer.instance()
+        self._wakeup_fds: Tuple[int, int] = (-1, -1)
         
     def start_server(self, port: int) -> Optional[threading.Thread]:
         """Start the TCP server"""
+        server_sock = self.listen(port)
+        if not server_sock:
+            return None
+            
+        server_thread = threading.Thread(target=self._handle_client, 
+                                      args=(server_sock,), name="ProxyServer")
+        server_thread.start()
+        return server_thread
+        
+    def listen(self, port: int, backlog: int = 1) -> Optional[socket.socket]:
+        """Get the listening socket for the phone's connection
+        
+        The socket stays open across sessions, so a phone that reconnects
+        while the previous session is still being torn down is queued by
+        the kernel instead of refused.
+        """
+        if self.server_sock:
+            return self.server_sock
+            
         self.logger.info(f"Starting TCP server on port {port}")
         try:
             server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             server_sock.bind(('', port))
-            server_sock.listen(1)
-            
-            server_thread = threading.Thread(target=self._handle_client, 
-                                          args=(server_sock,))
-            server_thread.start()
-            return server_thread
+            server_sock.listen(backlog)
+            self.server_port = server_sock.getsockname()[1]
+            self.server_sock = server_sock
+            return server_sock
         except Exception as e:
             self.logger.error(f"Failed to start server: {e}")
             return None
             
+    def close_server(self):
+        """Close the listening socket, waking up a pending accept"""
+        if not self.server_sock:
+            return
+            
+        try:
+            self.server_sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server_sock.close()
+        self.server_sock = None
+        
     def _handle_client(self, server_sock: socket.socket):
         """Handle incoming client connection"""
         try:
             client_sock, client_addr = server_sock.accept()
-            self.connection.tcp_fd = client_sock.fileno()
-            server_sock.close()
+        except Exception as e:
+            self.logger.error(f"Error handling client: {e}")
+            self._cleanup()
+            return
+        self.serve_client(client_sock)
+        
+    def serve_client(self, client_sock: socket.socket):
+        """Forward the session of an accepted client until it ends"""
+        try:
+            self._setup_session(client_sock)
             
-            self.logger.info("TCP server accepted connection")
+            if self.wait_accessory_ready:
+                with self.tracer.span("wait_accessory_ready"):
+                    self.wait_accessory_ready()
+                
+            if not self._open_session_accessory():
+                return
+                
+            self.logger.info(f"Starting data forwarding between TCP and USB ({self.engine.value})")
+            self._start_forwarding()
             
-            # Stop bluetooth retry when TCP connected
-            BluetoothHandler().instance().stop_connect_with_retry()
+        except Exception as e:
+            self.logger.error(f"Error handling client: {e}")
+        finally:
+            self._cleanup()
             
-            # Set socket timeout
-            client_sock.settimeout(10.0)
+    async def serve_async(self, server_sock: socket.socket,
+                          accessory_ready: Optional["asyncio.Event"] = None):
+        """Accept one client and forward its session on the running asyncio loop"""
+        import asyncio  # Only loaded by the asyncio orchestrator
+        loop = asyncio.get_running_loop()
+        try:
+            server_sock.setblocking(False)
+            client_sock, client_addr = await loop.sock_accept(server_sock)
+            self._setup_session(client_sock)
             
-            # Open USB accessory
-            try:
-                usb_fd = os.open("/dev/usb_accessory", os.O_RDWR)
-                self.connection.usb_fd = usb_fd
-            except OSError as e:
-                self.logger.error(f"Error opening /dev/usb_accessory: {e}")
+            if accessory_ready:
+                waiting = time.monotonic()
+                await accessory_ready.wait()
+                self.tracer.record("wait_accessory_ready", waiting)
+                
+            if not self._open_session_accessory():
                 return
                 
-            self.logger.info("Starting data forwarding between TCP and USB")
-            self._start_forwarding()
+            self.logger.info("Starting data forwarding between TCP and USB (asyncio)")
+            await self._forward_async()
             
         except Exception as e:
             self.logger.error(f"Error handling client: {e}")
         finally:
             self._cleanup()
             
+    def _read_session_options(self):
+        """Take the options not fixed by the constructor from the current configuration"""
+        config = Config.instance()
+        self.parse_frames = self._parse_frames if self._parse_frames is not None else \
+            config.get_env("AAWG_PROXY_PARSE_FRAMES", 0) != 0
+        self.prioritize = self._prioritize if self._prioritize is not None else \
+            config.get_env("AAWG_PROXY_PRIORITIZE", 0) != 0
+        self.adaptive_reads = self._adaptive_reads if self._adaptive_reads is not None else \
+            config.get_env("AAWG_PROXY_ADAPTIVE_READS", 1) != 0
+        self.socket_tuning = self._socket_tuning or config.get_socket_tuning()
+        # Each session's traffic is captured to a new file in this directory
+        self.capture_dir = config.get_env("AAWG_CAPTURE_DIR", "")
+        
+    def _setup_session(self, client_sock: socket.socket):
+        """Take over an accepted connection"""
+        self.logger.info("TCP server accepted connection")
+        self.tracer.mark("tcp_accepted")
+        self.metrics.sessions += 1
+        self._read_session_options()
+        self.client_connected.set()
+        
+        # Let the owner react, e.g. stop the bluetooth retry loop
+        if self.on_client_connected:
+            self.on_client_connected()
+            
+        # Set socket timeout
+        client_sock.settimeout(10.0)
+        self._tune_socket(client_sock)
+        
+        # The connection owns the fd from here on and closes it in _cleanup
+        self.connection.tcp_fd = client_sock.detach()
+        
+    def _open_session_accessory(self) -> bool:
+        """Open the accessory for a connected session, returns False on failure"""
+        try:
+            with self.tracer.span("open_accessory"):
+                self.connection.usb_fd = self._open_accessory()
+        except OSError as e:
+            self.logger.error(f"Error opening {self.accessory_path}: {e}")
+            return False
+            
+        # Time without forwarding since the previous session ended
+        if self._session_ended is not None:
+            gap = time.monotonic() - self._session_ended
+            self.metrics.session_gap.record(int(gap * 1e6))
+            self.metrics.last_session_gap = gap
+            self.logger.info(f"Reconnected {gap:.2f}s after the previous session")
+            
+        # Time from the watchdog ending a stuck session to forwarding again
+        if self._watchdog_fired is not None:
+            recovery = time.monotonic() - self._watchdog_fired
+            self.metrics.watchdog_recovery.record(int(recovery * 1e6))
+            self.metrics.last_watchdog_recovery = recovery
+            self._watchdog_fired = None
+        return True
+        
+    def _trace_first_write(self, direction: ForwardDirection):
+        direction.first_write_traced = True
+        self.tracer.mark("first_write", direction=direction.name)
+        
+    def _tune_socket(self, sock: socket.socket):
+        """Apply the socket tuning profile and report the resulting values"""
+        tuning = self.socket_tuning
+        options = [
+            (socket.IPPROTO_TCP, socket.TCP_NODELAY, "TCP_NODELAY", int(tuning.tcp_nodelay)),
+            (socket.SOL_SOCKET, socket.SO_RCVBUF, "SO_RCVBUF", tuning.rcvbuf),
+            (socket.SOL_SOCKET, socket.SO_SNDBUF, "SO_SNDBUF", tuning.sndbuf),
+            (socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, "TCP_NOTSENT_LOWAT", tuning.tcp_notsent_lowat),
+        ]
+        if hasattr(socket, "TCP_QUICKACK"):
+            # Not sticky, the kernel may return to delayed acks later in the session
+            options.append((socket.IPPROTO_TCP, socket.TCP_QUICKACK, "TCP_QUICKACK", int(tuning.tcp_quickack)))
+            
+        for level, option, name, value in options:
+            try:
+                # Zero keeps the kernel default, except for the boolean options
+                if value or name in ("TCP_NODELAY", "TCP_QUICKACK"):
+                    sock.setsockopt(level, option, value)
+                self.metrics.socket_options[name] = sock.getsockopt(level, option)
+            except OSError as e:
+                self.logger.error(f"Failed to set {name} to {value}: {e}")
+                
+        applied = ", ".join(f"{name}={value}" for name, value in self.metrics.socket_options.items())
+        self.logger.info(f"Socket tuning: {applied}")
+        
+    def _open_accessory(self) -> int:
+        """Open the accessory endpoint, returns its fd"""
+        return os.open(self.accessory_path, os.O_RDWR)
+        
+    def _create_directions(self, nonblocking: bool) -> Tuple[ForwardDirection, ForwardDirection]:
+        """Set up both forwarding directions of the connection"""
+        usb_tcp = ForwardDirection("USB", "TCP", self.connection.usb_fd, self.connection.tcp_fd,
+                                   metrics=self.metrics.direction("USB->TCP"))
+        tcp_usb = ForwardDirection("TCP", "USB", self.connection.tcp_fd, self.connection.usb_fd,
+                                   metrics=self.metrics.direction("TCP->USB"))
+        self.connection.directions = [usb_tcp, tcp_usb]
+        started = time.monotonic_ns()
+        for direction in self.connection.directions:
+            # The idle clock starts at the first read, a head unit may take a while to start sending
+            direction.last_write = started
+            if self.adaptive_reads:
+                direction.read_size = AdaptiveReadSize(self.BUFFER_SIZE, self.MIN_READ_SIZE, self.MAX_READ_SIZE)
+            else:
+                direction.read_size = AdaptiveReadSize(self.BUFFER_SIZE)
+            direction.metrics.queue_depth = lambda d=direction: d.queue_depth
+            direction.metrics.read_size = lambda d=direction: d.read_size.size
+        
+        if self.parse_frames:
+            if not nonblocking and self.engine == ForwardingEngine.SPLICE:
+                self.logger.info("Frame parsing needs data in userspace, not available with splice")
+            else:
+                for direction in self.connection.directions:
+                    direction.parser = FrameParser()
+                    
+        if self.prioritize:
+            if nonblocking:
+                # Audio and control frames from the phone overtake queued video
+                tcp_usb.scheduler = FrameScheduler()
+            else:
+                self.logger.info("Frame prioritization needs the epoll engine, forwarding in order")
+                
+        if self.capture_dir:
+            if not nonblocking and self.engine == ForwardingEngine.SPLICE:
+                self.logger.info("Capturing needs data in userspace, not available with splice")
+            else:
+                self._start_capture()
+                
+        return usb_tcp, tcp_usb
+        
+    def _start_capture(self):
+        """Capture the session's traffic to a new file in the capture directory"""
+        path = os.path.join(self.capture_dir, f"session-{time.strftime('%Y%m%d-%H%M%S')}-{self.metrics.sessions}.aawgcap")
+        try:
+            self.capture = SessionCapture(
+                path,
+                buffer_size=Config.instance().get_env("AAWG_CAPTURE_BUFFER_KB", 256) * 1024,
+                buffer_count=Config.instance().get_env("AAWG_CAPTURE_BUFFERS", 8)
+            )
+        except OSError as e:
+            self.logger.error(f"Failed to start capture to {path}: {e}")
+            return
+            
+        for direction in self.connection.directions:
+            direction.capture = partial(self.capture.record, CAPTURE_DIRECTIONS.index(direction.name))
+        
     def _start_forwarding(self):
         """Start forwarding data between TCP and USB"""
         self.should_exit.clear()
+        usb_tcp, tcp_usb = self._create_directions(self.engine == ForwardingEngine.EPOLL)
+        # Every engine waits on the wakeup fd as well, so stop_forwarding() takes effect right away
+        self._wakeup_fds = self._open_wakeup_fds()
+        self._start_watchdog()
+        try:
+            if self.engine == ForwardingEngine.EPOLL:
+                self._forward_epoll()
+                return
+                
+            forward = self._forward_splice if self.engine == ForwardingEngine.SPLICE else self._forward
+            
+            # Start USB to TCP forwarding thread
+            self.connection.usb_tcp_thread = threading.Thread(
+                target=forward,
+                args=(usb_tcp,),
+                name=usb_tcp.name
+            )
+            self.connection.usb_tcp_thread.start()
+            
+            # Start TCP to USB forwarding thread
+            self.connection.tcp_usb_thread = threading.Thread(
+                target=forward,
+                args=(tcp_usb,),
+                name=tcp_usb.name
+            )
+            self.connection.tcp_usb_thread.start()
+            
+            # Wait for threads to complete
+            self.connection.usb_tcp_thread.join()
+            self.connection.tcp_usb_thread.join()
+        finally:
+            self._stop_watchdog()
+            self._close_wakeup_fds()
+            
+    def _start_watchdog(self):
+        config = self.watchdog_config or Config.instance().get_watchdog_config()
+        self.watchdog = ForwardWatchdog(config, self._watchdog_expired)
+        self.watchdog.start(self.connection.directions,
+                            {self.connection.tcp_fd: "TCP", self.connection.usb_fd: "USB"})
+        
+    def _stop_watchdog(self):
+        if self.watchdog:
+            self.watchdog.stop()
+            self.watchdog = None
         
-        # Start USB to TCP forwarding thread
-        self.connection.usb_tcp_thread = threading.Thread(
-            target=self._forward,
-            args=("USB", "TCP", self.connection.usb_fd, self.connection.tcp_fd)
-        )
-        self.connection.usb_tcp_thread.start()
-        
-        # Start TCP to USB forwarding thread
-        self.connection.tcp_usb_thread = threading.Thread(
-            target=self._forward,
-            args=("TCP", "USB", self.connection.tcp_fd, self.connection.usb_fd)
-        )
-        self.connection.tcp_usb_thread.start()
-        
-        # Wait for threads to complete
-        self.connection.usb_tcp_thread.join()
-        self.connection.tcp_usb_thread.join()
-        
-    def _forward(self, src_name: str, dst_name: str, src_fd: int, dst_fd: int):
+    def _watchdog_expired(self, expiry: WatchdogExpiry):
+        """End a session that stopped making progress, so the main loop can start a fresh one"""
+        self.logger.error(f"Watchdog: {expiry.reason.value} on {expiry.subject} "
+                          f"after {expiry.silent:.1f}s, ending the session")
+        self._watchdog_fired = time.monotonic()
+        reason = expiry.reason.value
+        self.metrics.watchdog_teardowns[reason] = self.metrics.watchdog_teardowns.get(reason, 0) + 1
+        
+        # Blocking reads and writes on a character device can't be interrupted,
+        # the owner has to make them fail, e.g. by unbinding the USB gadget.
+        # Runs first, nothing below may wait for a thread stuck in one of them
+        if self.on_watchdog_expired:
+            try:
+                self.on_watchdog_expired()
+            except Exception as e:
+                self.logger.error(f"Error unblocking the accessory: {e}")
+                
+        self.stop_forwarding()
+        
+        # A silent phone never sends a FIN, shutting the socket down fails
+        # any read or write that is still blocked on it
+        try:
+            sock = socket.socket(fileno=os.dup(self.connection.tcp_fd))
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            finally:
+                sock.close()
+        except OSError:
+            pass
+            
+    def queue_depths(self) -> Dict[str, int]:
+        """Get the number of bytes queued in each forwarding direction"""
+        return {d.name: d.queue_depth for d in self.connection.directions}
+        
+    def _forward(self, direction: ForwardDirection):
         """Forward data between source and destination file descriptors"""
+        src_name, dst_name = direction.src_name, direction.dst_name
+        src_fd = direction.src_fd
+        wakeup_fd = self._wakeup_fds[0]
+        metrics = direction.metrics
+        read_size = direction.read_size
         try:
             while not self.should_exit.is_set():
                 # Use select to wait for data
-                readable, _, _ = select.select([src_fd], [], [], 1.0)
-                if not readable:
+                readable, _, _ = select.select([src_fd, wakeup_fd], [], [], 1.0)
+                if src_fd not in readable:
+                    if not readable:
+                        metrics.select_timeouts += 1
                     continue
                     
                 # Read data
                 try:
-                    data = os.read(src_fd, self.BUFFER_SIZE)
+                    data = os.read(src_fd, read_size.size)
                 except OSError as e:
                     self.logger.error(f"Read from {src_name} failed: {e}")
                     break
@@ -115,48 +521,539 @@ class ProxyHandler:
                 if not data:  # EOF
                     break
                     
+                read_time = direction.last_read = time.monotonic_ns()
+                metrics.reads += 1
+                read_size.update(len(data))
                 if self.log_communication:
                     self.logger.info(f"{len(data)} bytes read from {src_name}")
                     
-                # Write data
+                if direction.parser:
+                    metrics.frames += len(direction.parser.feed(data))
+                if direction.capture:
+                    direction.capture(data)
+                    
+                # Write data, no further reads happen until all of it is out
+                if not self._write_all(direction, data):
+                    break
+                metrics.latency.record((time.monotonic_ns() - read_time) // 1000)
+                    
+        except Exception as e:
+            self.logger.error(f"Error in forwarding {src_name} to {dst_name}: {e}")
+        finally:
+            self.stop_forwarding()
+            
+    def _write_all(self, direction: ForwardDirection, data: bytes) -> bool:
+        """Write all of data to the destination, waiting out short writes
+        
+        Returns:
+            bool: False if the write failed or forwarding was stopped
+        """
+        view = memoryview(data)
+        direction.in_flight = len(view)
+        metrics = direction.metrics
+        try:
+            while view:
+                if self.should_exit.is_set():
+                    return False
+                    
                 try:
-                    bytes_written = os.write(dst_fd, data)
-                    if self.log_communication:
-                        self.logger.info(f"{bytes_written} bytes written to {dst_name}")
+                    bytes_written = os.write(direction.dst_fd, view)
+                except BlockingIOError:
+                    # Destination buffer is full, wait for it to drain
+                    metrics.write_stalls += 1
+                    select.select([self._wakeup_fds[0]], [direction.dst_fd], [], 1.0)
+                    continue
                 except OSError as e:
-                    self.logger.error(f"Write to {dst_name} failed: {e}")
+                    self.logger.error(f"Write to {direction.dst_name} failed: {e}")
+                    return False
+                    
+                direction.last_write = time.monotonic_ns()
+                metrics.writes += 1
+                metrics.bytes += bytes_written
+                if not direction.first_write_traced:
+                    self._trace_first_write(direction)
+                if bytes_written < len(view):
+                    metrics.short_writes += 1
+                view = view[bytes_written:]
+                direction.in_flight = len(view)
+                if self.log_communication:
+                    self.logger.info(f"{bytes_written} bytes written to {direction.dst_name}")
+            return True
+        finally:
+            direction.in_flight = 0
+            
+    def _forward_splice(self, direction: ForwardDirection):
+        """Forward data through a kernel pipe with splice(), falling back to copying"""
+        try:
+            supported = self._splice_loop(direction)
+        except Exception as e:
+            self.logger.error(f"Error in splicing {direction.src_name} to {direction.dst_name}: {e}")
+            supported = True
+            
+        if supported:
+            self.stop_forwarding()
+        else:
+            self.logger.info(f"splice() not supported for {direction.name}, falling back to copy")
+            self._forward(direction)
+            
+    def _splice_loop(self, direction: ForwardDirection) -> bool:
+        """Move data from src_fd to dst_fd without copying it through userspace
+        
+        Returns:
+            bool: False if either end does not support splice() and nothing
+                  has been moved yet, so the caller can fall back to copying
+        """
+        src_name, dst_name = direction.src_name, direction.dst_name
+        src_fd, dst_fd = direction.src_fd, direction.dst_fd
+        wakeup_fd = self._wakeup_fds[0]
+        metrics = direction.metrics
+        pipe_r, pipe_w = os.pipe()
+        spliced_in = False
+        spliced_out = False
+        
+        try:
+            while not self.should_exit.is_set():
+                readable, _, _ = select.select([src_fd, wakeup_fd], [], [], 1.0)
+                if src_fd not in readable:
+                    if not readable:
+                        metrics.select_timeouts += 1
+                    continue
+                    
+                # Move data from the source into the pipe
+                try:
+                    pending = os.splice(src_fd, pipe_w, direction.read_size.size, flags=os.SPLICE_F_MOVE)
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    if e.errno in SPLICE_UNSUPPORTED_ERRNOS and not spliced_in:
+                        return False
+                    self.logger.error(f"Read from {src_name} failed: {e}")
+                    break
+                    
+                if not pending:  # EOF
                     break
                     
+                spliced_in = True
+                direction.in_flight = pending
+                read_time = direction.last_read = time.monotonic_ns()
+                metrics.reads += 1
+                direction.read_size.update(pending)
+                if self.log_communication:
+                    self.logger.info(f"{pending} bytes read from {src_name}")
+                    
+                # Drain the pipe into the destination
+                while pending and not self.should_exit.is_set():
+                    try:
+                        written = os.splice(pipe_r, dst_fd, pending, flags=os.SPLICE_F_MOVE)
+                    except BlockingIOError:
+                        metrics.write_stalls += 1
+                        select.select([wakeup_fd], [dst_fd], [], 1.0)
+                        continue
+                    except OSError as e:
+                        if e.errno in SPLICE_UNSUPPORTED_ERRNOS and not spliced_out:
+                            # Hand the bytes already in the pipe over before falling back
+                            return not self._write_all(direction, os.read(pipe_r, pending))
+                        self.logger.error(f"Write to {dst_name} failed: {e}")
+                        return True
+                        
+                    spliced_out = True
+                    direction.last_write = time.monotonic_ns()
+                    metrics.writes += 1
+                    metrics.bytes += written
+                    if not direction.first_write_traced:
+                        self._trace_first_write(direction)
+                    if written < pending:
+                        metrics.short_writes += 1
+                    pending -= written
+                    direction.in_flight = pending
+                    if self.log_communication:
+                        self.logger.info(f"{written} bytes written to {dst_name}")
+                        
+                if not pending:
+                    metrics.latency.record((time.monotonic_ns() - read_time) // 1000)
+        finally:
+            direction.in_flight = 0
+            os.close(pipe_r)
+            os.close(pipe_w)
+            
+        return True
+        
+    def _forward_epoll(self):
+        """Forward both directions from a single epoll loop"""
+        usb_fd = self.connection.usb_fd
+        tcp_fd = self.connection.tcp_fd
+        directions = self.connection.directions
+        by_src = {d.src_fd: d for d in directions}
+        by_dst = {d.dst_fd: d for d in directions}
+        
+        epoll = select.epoll()
+        wakeup_r = self._wakeup_fds[0]
+        epoll.register(wakeup_r, select.EPOLLIN)
+        
+        # Character devices without poll support (f_accessory) can't be
+        # registered; they are served by blocking helper threads instead
+        interest: Dict[int, int] = {}
+        for fd in (usb_fd, tcp_fd):
+            try:
+                epoll.register(fd, 0)
+                os.set_blocking(fd, False)
+                interest[fd] = 0
+            except PermissionError:
+                self._start_blocking_helpers(by_src[fd], by_dst[fd])
+                
+        try:
+            while not self.should_exit.is_set():
+                for fd in interest:
+                    mask = 0
+                    if not by_src[fd].paused:
+                        mask |= select.EPOLLIN
+                    if by_dst[fd].has_output:
+                        mask |= select.EPOLLOUT
+                    if mask != interest[fd]:
+                        epoll.modify(fd, mask)
+                        interest[fd] = mask
+                        
+                for fd, events in epoll.poll():
+                    if fd == wakeup_r:
+                        self._drain_wakeup_fd()
+                        # A blocking reader may have queued data
+                        for direction in directions:
+                            if direction.src_fd not in interest and not self._send_queued(direction):
+                                return
+                        continue
+                        
+                    if events & select.EPOLLOUT and not self._flush(by_dst[fd]):
+                        return
+                    if events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                        if not self._read_into(by_src[fd]) or not self._send_queued(by_src[fd]):
+                            return
         except Exception as e:
-            self.logger.error(f"Error in forwarding {src_name} to {dst_name}: {e}")
+            self.logger.error(f"Error in epoll forwarding: {e}")
+        finally:
+            self.stop_forwarding()
+            epoll.close()
+            
+    async def _forward_async(self):
+        """Forward both directions from callbacks on the running asyncio loop
+        
+        Works like the epoll engine, with the asyncio loop doing the polling
+        so forwarding shares one thread with the rest of the daemon.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.should_exit.clear()
+        directions = self._create_directions(True)
+        by_src = {d.src_fd: d for d in directions}
+        by_dst = {d.dst_fd: d for d in directions}
+        finished = loop.create_future()
+        pollable: Set[int] = set()
+        reading: Set[int] = set()
+        writing: Set[int] = set()
+        
+        def finish():
+            if not finished.done():
+                finished.set_result(None)
+                
+        def update_interest():
+            if finished.done():
+                return
+            for fd in pollable:
+                if not by_src[fd].paused and fd not in reading:
+                    loop.add_reader(fd, on_readable, fd)
+                    reading.add(fd)
+                elif by_src[fd].paused and fd in reading:
+                    loop.remove_reader(fd)
+                    reading.discard(fd)
+                if by_dst[fd].has_output and fd not in writing:
+                    loop.add_writer(fd, on_writable, fd)
+                    writing.add(fd)
+                elif not by_dst[fd].has_output and fd in writing:
+                    loop.remove_writer(fd)
+                    writing.discard(fd)
+                    
+        def on_readable(fd: int):
+            if not self._read_into(by_src[fd]) or not self._send_queued(by_src[fd]):
+                finish()
+            update_interest()
+            
+        def on_writable(fd: int):
+            if not self._flush(by_dst[fd]):
+                finish()
+            update_interest()
+            
+        def on_wakeup():
+            self._drain_wakeup_fd()
+            if self.should_exit.is_set():
+                finish()
+                return
+            # A blocking reader may have queued data
+            for direction in directions:
+                if direction.src_fd not in pollable and not self._send_queued(direction):
+                    finish()
+            update_interest()
+            
+        self._wakeup_fds = self._open_wakeup_fds()
+        loop.add_reader(self._wakeup_fds[0], on_wakeup)
+        self._start_watchdog()
+        try:
+            # Character devices without poll support (f_accessory) can't be
+            # watched by the loop; helper threads read and write them, so a
+            # head unit that stops reading never blocks the daemon's loop
+            for fd in (self.connection.usb_fd, self.connection.tcp_fd):
+                try:
+                    loop.add_reader(fd, on_readable, fd)
+                    os.set_blocking(fd, False)
+                    reading.add(fd)
+                    pollable.add(fd)
+                except PermissionError:
+                    self._start_blocking_helpers(by_src[fd], by_dst[fd])
+                    
+            await finished
         finally:
+            for fd in reading:
+                loop.remove_reader(fd)
+            for fd in writing:
+                loop.remove_writer(fd)
+            loop.remove_reader(self._wakeup_fds[0])
             self.stop_forwarding()
+            self._stop_watchdog()
+            self._close_wakeup_fds()
+            
+    def _read_into(self, direction: ForwardDirection) -> bool:
+        """Read available data from a direction's source, returns False on EOF or error"""
+        try:
+            data = os.read(direction.src_fd, direction.read_size.size)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            self.logger.error(f"Read from {direction.src_name} failed: {e}")
+            return False
+            
+        if not data:  # EOF
+            return False
+            
+        direction.last_read = time.monotonic_ns()
+        direction.metrics.reads += 1
+        direction.read_size.update(len(data))
+        if self.log_communication:
+            self.logger.info(f"{len(data)} bytes read from {direction.src_name}")
             
+        if direction.parser:
+            direction.metrics.frames += len(direction.parser.feed(data))
+        if direction.capture:
+            direction.capture(data)
+            
+        self._queue_data(direction, data)
+        return True
+        
+    def _queue_data(self, direction: ForwardDirection, data: bytes):
+        """Queue data read from a direction's source for writing"""
+        with direction.lock:
+            if not direction.queued_since:
+                direction.queued_since = time.monotonic_ns()
+            if direction.scheduler:
+                direction.scheduler.push(data)
+            else:
+                direction.pending += data
+            high_water = self.PRIORITY_HIGH_WATER if direction.scheduler else self.PENDING_HIGH_WATER
+            if direction.queue_depth >= high_water:
+                direction.paused = True
+                
+    def _flush(self, direction: ForwardDirection, dst_fd: int = -1) -> bool:
+        """Write as much pending data as the destination accepts, returns False on error
+        
+        The lock only guards the queue. The data is taken out of it for the
+        write and what the destination didn't take is put back, so a write
+        that blocks never holds up a reader queueing data or stop_forwarding().
+        A blocking writer passes its own duplicate of the destination as dst_fd.
+        """
+        metrics = direction.metrics
+        while True:
+            with direction.lock:
+                if not direction.pending and direction.scheduler and direction.scheduler.queued_frames:
+                    direction.pending += direction.scheduler.pop_batch(self.BUFFER_SIZE)
+                if not direction.pending:
+                    break
+                chunk, direction.pending = direction.pending, bytearray()
+                direction.in_flight = len(chunk)
+                
+            try:
+                bytes_written = os.write(direction.dst_fd if dst_fd == -1 else dst_fd, chunk)
+            except BlockingIOError:
+                metrics.write_stalls += 1
+                bytes_written = 0
+            except OSError as e:
+                self.logger.error(f"Write to {direction.dst_name} failed: {e}")
+                direction.in_flight = 0
+                return False
+                
+            short = bytes_written < len(chunk)
+            with direction.lock:
+                direction.in_flight = 0
+                if short:
+                    # Goes back ahead of anything queued during the write
+                    del chunk[:bytes_written]
+                    chunk += direction.pending
+                    direction.pending = chunk
+                    
+            if not bytes_written:
+                break
+            direction.last_write = time.monotonic_ns()
+            metrics.writes += 1
+            metrics.bytes += bytes_written
+            if not direction.first_write_traced:
+                self._trace_first_write(direction)
+            if short:
+                metrics.short_writes += 1
+            if self.log_communication:
+                self.logger.info(f"{bytes_written} bytes written to {direction.dst_name}")
+                
+        resumed = False
+        with direction.lock:
+            # Latency is measured for the oldest byte of each queue backlog
+            if direction.queued_since and not direction.queue_depth:
+                metrics.latency.record((time.monotonic_ns() - direction.queued_since) // 1000)
+                direction.queued_since = 0
+                
+            if direction.paused and direction.queue_depth <= self.PENDING_LOW_WATER:
+                direction.paused = False
+                direction.drained.notify_all()
+                resumed = True
+        if resumed and direction.blocking_dst:
+            # Written from the blocking writer, the loop has to resume reading the source
+            self._wake_loop()
+        return True
+        
+    def _start_blocking_helpers(self, reader: ForwardDirection, writer: ForwardDirection):
+        """Serve an fd the loop can't poll from helper threads, so the loop never blocks on it"""
+        self.logger.info(f"{reader.src_name} fd is not pollable, using a blocking reader and writer")
+        writer.blocking_dst = True
+        threading.Thread(target=self._blocking_reader, args=(reader,),
+                         name=f"{reader.name} reader", daemon=True).start()
+        threading.Thread(target=self._blocking_writer, args=(writer,),
+                         name=f"{writer.name} writer", daemon=True).start()
+        
+    def _send_queued(self, direction: ForwardDirection) -> bool:
+        """Write a direction's queue from the loop, or hand it to its blocking writer"""
+        if direction.blocking_dst:
+            with direction.lock:
+                direction.queued.notify()
+            return True
+        return self._flush(direction)
+        
+    def _blocking_reader(self, direction: ForwardDirection):
+        """Feed an fd that epoll can't watch into the loop from a helper thread"""
+        # Read from a private duplicate so closing the session fd in _cleanup
+        # can't hand this thread a reused descriptor
+        src_fd = os.dup(direction.src_fd)
+        try:
+            while not direction.closed:
+                try:
+                    data = os.read(src_fd, direction.read_size.size)
+                except OSError as e:
+                    if not direction.closed:
+                        self.logger.error(f"Read from {direction.src_name} failed: {e}")
+                    break
+                    
+                if not data:  # EOF
+                    break
+                    
+                direction.last_read = time.monotonic_ns()
+                direction.metrics.reads += 1
+                direction.read_size.update(len(data))
+                if direction.parser:
+                    direction.metrics.frames += len(direction.parser.feed(data))
+                if direction.capture:
+                    direction.capture(data)
+                    
+                self._queue_data(direction, data)
+                self._wake_loop()
+                
+                # Hold off reading until the loop has drained the queue,
+                # stop_forwarding() may not get the lock to wake this thread
+                with direction.lock:
+                    while direction.paused and not direction.closed:
+                        direction.drained.wait(self.DRAIN_WAIT)
+        finally:
+            os.close(src_fd)
+            if not direction.closed:
+                self.stop_forwarding()
+                
+    def _blocking_writer(self, direction: ForwardDirection):
+        """Write the queue to an fd that epoll can't watch from a helper thread
+        
+        Writes to f_accessory block while the head unit isn't reading. Here
+        they only hold up this thread, the loop keeps forwarding the other
+        direction and can be stopped at any time.
+        """
+        # A private duplicate, like the blocking reader's
+        dst_fd = os.dup(direction.dst_fd)
+        try:
+            while not direction.closed:
+                with direction.lock:
+                    while not direction.has_output and not direction.closed:
+                        direction.queued.wait(self.DRAIN_WAIT)
+                if direction.closed:
+                    break
+                    
+                if not self._flush(direction, dst_fd):
+                    break
+        finally:
+            os.close(dst_fd)
+            if not direction.closed:
+                self.stop_forwarding()
+            
+    def _open_wakeup_fds(self) -> Tuple[int, int]:
+        """Create the fd pair used to interrupt the epoll loop"""
+        if hasattr(os, "eventfd"):
+            fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            return fd, fd
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        return read_fd, write_fd
+        
+    def _drain_wakeup_fd(self):
+        try:
+            os.read(self._wakeup_fds[0], 4096)
+        except BlockingIOError:
+            pass
+            
+    def _wake_loop(self):
+        """Interrupt the epoll loop, if one is running"""
+        write_fd = self._wakeup_fds[1]
+        if write_fd == -1:
+            return
+        try:
+            os.write(write_fd, (1).to_bytes(8, sys.byteorder))
+        except OSError:
+            pass
+            
+    def _close_wakeup_fds(self):
+        read_fd, write_fd = self._wakeup_fds
+        self._wakeup_fds = (-1, -1)
+        for fd in {read_fd, write_fd}:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+                
     def _read_message(self, fd: int) -> Tuple[bool, bytes]:
         """Read a complete message from the file descriptor"""
         try:
             # Read header (4 bytes)
-            header = os.read(fd, 4)
-            if len(header) != 4:
+            header = self._read_exact(fd, FRAME_HEADER_SIZE)
+            if len(header) != FRAME_HEADER_SIZE:
                 return False, b''
                 
             # Parse message length
             message_length = (header[2] << 8) + header[3]
             
-            # Check if extended header
-            FRAME_TYPE_FIRST = 1 << 0
-            FRAME_TYPE_LAST = 1 << 1
-            FRAME_TYPE_MASK = FRAME_TYPE_FIRST | FRAME_TYPE_LAST
+            # First frames of a multi-frame message carry an extended header
+            message_length += header_size(header[1]) - FRAME_HEADER_SIZE
             
-            if (header[1] & FRAME_TYPE_MASK) == FRAME_TYPE_FIRST:
-                # Read extended header (4 more bytes)
-                ext_header = os.read(fd, 4)
-                if len(ext_header) != 4:
-                    return False, b''
-                message_length += 4
-                
             # Read message body
-            message = os.read(fd, message_length)
+            message = self._read_exact(fd, message_length)
             if len(message) != message_length:
                 return False, b''
                 
@@ -166,15 +1063,44 @@ class ProxyHandler:
             self.logger.error(f"Error reading message: {e}")
             return False, b''
             
+    def _read_exact(self, fd: int, length: int) -> bytes:
+        """Read length bytes, returning fewer only at EOF"""
+        data = bytearray()
+        while len(data) < length:
+            chunk = os.read(fd, length - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+        
     def stop_forwarding(self):
         """Stop all forwarding threads"""
         self.logger.info("Stopping data forwarding")
         self.should_exit.set()
+        self._wake_loop()
+        for direction in self.connection.directions:
+            direction.closed = True
+            
+        # Helper threads check closed at least every DRAIN_WAIT, so this never
+        # waits for the lock of a direction in the middle of an update
+        for direction in self.connection.directions:
+            if direction.lock.acquire(blocking=False):
+                try:
+                    direction.drained.notify_all()
+                    direction.queued.notify_all()
+                finally:
+                    direction.lock.release()
         
     def _cleanup(self):
         """Clean up resources"""
         self.stop_forwarding()
         
+        if self.client_connected.is_set():
+            self.client_connected.clear()
+            self._session_ended = time.monotonic()
+            if self._watchdog_fired is not None:
+                self.metrics.watchdog_teardown.record(int((self._session_ended - self._watchdog_fired) * 1e6))
+        
         if self.connection.usb_fd != -1:
             try:
                 os.close(self.connection.usb_fd)
@@ -188,3 +1114,8 @@ class ProxyHandler:
             except OSError:
                 pass
             self.connection.tcp_fd = -1
+            
+        if self.capture:
+            self.capture.close()
+            self.metrics.capture_dropped_bytes += self.capture.dropped_bytes
+            self.capture = None
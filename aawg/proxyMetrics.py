@@ -0,0 +1,275 @@
+import os
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+
+from common import Logger, LogWriter
+
+# Histogram bounds exported to Prometheus, in seconds
+EXPORT_BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                  0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+SESSION_GAP_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]
+
+class LatencyHistogram:
+    """Log-linear histogram of durations in microseconds
+    
+    Like an HDR histogram, every power of two is split into 16 linear
+    sub-buckets, which keeps the relative error around 6% over the whole
+    range with a fixed, small array and an O(1) record().
+    """
+    SUB_BUCKETS = 16
+    MAX_VALUE_US = 60 * 1000 * 1000
+    
+    def __init__(self, max_value_us: int = MAX_VALUE_US):
+        self.max_value_us = max_value_us
+        self.counts = [0] * (self._index(max_value_us) + 1)
+        self.count = 0
+        self.sum_us = 0
+        
+    @classmethod
+    def _index(cls, value: int) -> int:
+        if value < 2 * cls.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - 5
+        return (shift + 1) * cls.SUB_BUCKETS + (value >> shift) - cls.SUB_BUCKETS
+        
+    @classmethod
+    def _upper_bound(cls, index: int) -> int:
+        """Smallest value above the given bucket"""
+        if index < 2 * cls.SUB_BUCKETS:
+            return index + 1
+        shift = index // cls.SUB_BUCKETS - 1
+        return (index % cls.SUB_BUCKETS + cls.SUB_BUCKETS + 1) << shift
+        
+    def record(self, value_us: int):
+        """Record one duration"""
+        if value_us < 0:
+            value_us = 0
+        elif value_us > self.max_value_us:
+            value_us = self.max_value_us
+        self.counts[self._index(value_us)] += 1
+        self.count += 1
+        self.sum_us += value_us
+        
+    def percentile(self, pct: float) -> int:
+        """Get the upper bound in microseconds below which pct percent of values fall"""
+        if not self.count:
+            return 0
+        target = self.count * pct / 100
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if bucket_count and seen >= target:
+                return self._upper_bound(index)
+        return self.max_value_us
+        
+    def cumulative(self, bounds_us: List[float]) -> List[int]:
+        """Count values in buckets that end at or below each bound"""
+        result = []
+        seen = 0
+        index = 0
+        for bound in bounds_us:
+            while index < len(self.counts) and self._upper_bound(index) <= bound:
+                seen += self.counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+class DirectionMetrics:
+    """Counters for one forwarding direction
+    
+    Every counter has a single writing thread, so they are plain attributes
+    without a lock; the exporter may see values that are a few updates
+    behind, which is fine for export.
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.bytes = 0
+        self.reads = 0
+        self.frames = 0  # Only counted when frame parsing is enabled
+        self.writes = 0
+        self.short_writes = 0
+        self.write_stalls = 0
+        self.select_timeouts = 0
+        self.queue_depth: Callable[[], int] = lambda: 0
+        self.read_size: Callable[[], int] = lambda: 0
+        self.latency = LatencyHistogram()
+
+class ProxyMetrics:
+    """Metrics of the proxy data path, kept across sessions"""
+    
+    def __init__(self):
+        self.sessions = 0
+        self.engine = ""
+        # Time from the end of one session to the start of forwarding in the next
+        self.session_gap = LatencyHistogram(3600 * 1000 * 1000)
+        self.last_session_gap = 0.0
+        self.directions: Dict[str, DirectionMetrics] = {}
+        self.socket_options: Dict[str, int] = {}  # Values read back from the phone's socket
+        self.capture_dropped_bytes = 0
+        self.watchdog_teardowns: Dict[str, int] = {}  # Sessions ended by the watchdog, by reason
+        # From the watchdog ending a session to the end of its cleanup, and to forwarding in the next one
+        self.watchdog_teardown = LatencyHistogram()
+        self.watchdog_recovery = LatencyHistogram(3600 * 1000 * 1000)
+        self.last_watchdog_recovery = 0.0
+        self.labels: Dict[str, str] = {}  # Added to every sample, e.g. to tell sessions apart
+        
+    def direction(self, name: str) -> DirectionMetrics:
+        """Get the metrics of a direction, creating them on first use"""
+        metrics = self.directions.get(name)
+        if metrics is None:
+            metrics = self.directions[name] = DirectionMetrics(name)
+        return metrics
+        
+    def render(self, process: bool = True) -> str:
+        """Render all metrics in the Prometheus text exposition format
+        
+        process=False leaves out the process-wide series, for an owner that
+        renders several ProxyMetrics and adds those once.
+        """
+        lines = []
+        
+        def metric(name: str, kind: str, help_text: str, samples: List[tuple]):
+            render_metric(lines, name, kind, help_text, [({**self.labels, **labels}, value)
+                                                         for labels, value in samples])
+                
+        directions = list(self.directions.values())
+        
+        def per_direction(attribute: Callable[[DirectionMetrics], float]) -> List[tuple]:
+            return [({"direction": d.name}, attribute(d)) for d in directions]
+            
+        metric("aawg_proxy_sessions_total", "counter", "Proxy sessions started",
+               [({"engine": self.engine}, self.sessions)])
+        metric("aawg_proxy_bytes_total", "counter", "Bytes forwarded",
+               per_direction(lambda d: d.bytes))
+        metric("aawg_proxy_reads_total", "counter", "Reads from the source",
+               per_direction(lambda d: d.reads))
+        metric("aawg_proxy_frames_total", "counter", "Android Auto frames seen by the frame parser",
+               per_direction(lambda d: d.frames))
+        metric("aawg_proxy_writes_total", "counter", "Writes to the destination",
+               per_direction(lambda d: d.writes))
+        metric("aawg_proxy_short_writes_total", "counter", "Writes that took only part of the data",
+               per_direction(lambda d: d.short_writes))
+        metric("aawg_proxy_write_stalls_total", "counter", "Writes that had to wait for the destination",
+               per_direction(lambda d: d.write_stalls))
+        metric("aawg_proxy_select_timeouts_total", "counter", "Idle select() timeouts",
+               per_direction(lambda d: d.select_timeouts))
+        metric("aawg_proxy_queue_depth_bytes", "gauge", "Bytes read but not yet written",
+               per_direction(lambda d: d.queue_depth()))
+               
+        metric("aawg_proxy_read_size_bytes", "gauge", "Current read size",
+               per_direction(lambda d: d.read_size()))
+        metric("aawg_proxy_socket_option", "gauge", "Socket options of the current TCP connection",
+               [({"option": name}, value) for name, value in self.socket_options.items()])
+            
+        def histogram(name: str, help_text: str, bounds: List[float], samples: List[tuple]):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            bounds_us = [bound * 1e6 for bound in bounds]
+            for labels, values in samples:
+                labels = {**self.labels, **labels}
+                label_text = "".join(f'{key}="{val}",' for key, val in labels.items())
+                for bound, count in zip(bounds, values.cumulative(bounds_us)):
+                    lines.append(f'{name}_bucket{{{label_text}le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{label_text}le="+Inf"}} {values.count}')
+                label_text = f"{{{label_text.rstrip(',')}}}" if labels else ""
+                lines.append(f"{name}_sum{label_text} {values.sum_us / 1e6}")
+                lines.append(f"{name}_count{label_text} {values.count}")
+                
+        histogram("aawg_proxy_latency_seconds", "Time from reading data to having written it",
+                  EXPORT_BUCKETS, per_direction(lambda d: d.latency))
+        histogram("aawg_proxy_session_gap_seconds", "Time without forwarding between two sessions",
+                  SESSION_GAP_BUCKETS, [({}, self.session_gap)])
+        metric("aawg_proxy_last_session_gap_seconds", "gauge", "Gap before the current or last session",
+               [({}, self.last_session_gap)])
+        metric("aawg_watchdog_teardowns_total", "counter", "Sessions ended because forwarding made no progress",
+               [({"reason": reason}, count) for reason, count in self.watchdog_teardowns.items()])
+        histogram("aawg_watchdog_teardown_seconds", "Time from the watchdog firing to the end of the session",
+                  EXPORT_BUCKETS, [({}, self.watchdog_teardown)])
+        histogram("aawg_watchdog_recovery_seconds", "Time from the watchdog firing to forwarding in the next session",
+                  SESSION_GAP_BUCKETS, [({}, self.watchdog_recovery)])
+        metric("aawg_watchdog_last_recovery_seconds", "gauge", "Recovery time after the last watchdog teardown",
+               [({}, self.last_watchdog_recovery)])
+        metric("aawg_capture_dropped_bytes_total", "counter", "Forwarded bytes missing from session captures",
+               [({}, self.capture_dropped_bytes)])
+            
+        for pct in (50, 99):
+            metric(f"aawg_proxy_latency_p{pct}_seconds", "gauge", f"{pct}th percentile of the proxy latency",
+                   per_direction(lambda d: d.latency.percentile(pct) / 1e6))
+                   
+        text = "\n".join(lines) + "\n"
+        return text + render_process_metrics() if process else text
+
+def render_metric(lines: List[str], name: str, kind: str, help_text: str, samples: List[tuple]):
+    """Append a metric family with (labels, value) samples in the Prometheus text format"""
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        
+def render_process_metrics() -> str:
+    """Render the series that belong to the whole process rather than a proxy"""
+    lines: List[str] = []
+    render_metric(lines, "aawg_log_dropped_total", "counter", "Log messages dropped or sampled out under load",
+                  [({}, LogWriter.instance().dropped)])
+    return "\n".join(lines) + "\n"
+
+def merge_rendered(texts: Iterable[str]) -> str:
+    """Merge rendered metrics of several sources, keeping the samples of each metric together"""
+    families: Dict[str, List[str]] = {}
+    headers = set()
+    for text in texts:
+        name = ""
+        for line in text.splitlines():
+            if line.startswith("# "):
+                name = line.split(" ", 3)[2]
+                families.setdefault(name, [])
+                if line in headers:
+                    continue
+                headers.add(line)
+            families.setdefault(name, []).append(line)
+    return "\n".join(line for lines in families.values() for line in lines) + "\n"
+
+class MetricsExporter:
+    """Periodically rewrites a metrics file for node_exporter's textfile collector"""
+    
+    def __init__(self, path: str, interval: float, render: Callable[[], str]):
+        self.logger = Logger("MetricsExporter")
+        self.path = path
+        self.interval = interval
+        self.render = render
+        self.should_exit = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        
+    def start(self) -> Optional[threading.Thread]:
+        """Start the export thread"""
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        except OSError as e:
+            self.logger.error(f"Failed to create metrics directory for {self.path}: {e}")
+            return None
+            
+        self.thread = threading.Thread(target=self._export_loop, name="MetricsExporter", daemon=True)
+        self.thread.start()
+        self.logger.info(f"Exporting metrics to {self.path} every {self.interval}s")
+        return self.thread
+        
+    def _export_loop(self):
+        while not self.should_exit.wait(self.interval):
+            self.export()
+        self.export()
+        
+    def export(self):
+        """Write the metrics file, replacing it atomically"""
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(self.render())
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.logger.error(f"Failed to write metrics to {self.path}: {e}")
+            
+    def stop(self):
+        """Stop exporting after writing the final values"""
+        self.should_exit.set()
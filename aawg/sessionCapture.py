@@ -0,0 +1,145 @@
+import os
+import struct
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Iterator, List, Optional, Tuple
+
+from common import Logger
+
+# File header: magic and the wall clock time of the capture start
+MAGIC = b"AAWGCAP\x01"
+FILE_HEADER = struct.Struct(">8sd")
+# Record header: nanoseconds since the capture start, direction index and data length
+RECORD = struct.Struct(">QBI")
+
+# Direction names by their index in a record
+DIRECTIONS = ("USB->TCP", "TCP->USB")
+
+@dataclass(slots=True)
+class CaptureRecord:
+    timestamp: int  # Nanoseconds since the capture start
+    direction: str
+    data: bytes
+
+class SessionCapture:
+    """Append-only capture of the data forwarded in both directions
+    
+    record() copies the data into one of a fixed set of buffers allocated
+    up front and never touches the file, so it costs the forwarding path a
+    copy and no I/O. A writer thread appends full buffers to the file, and
+    a partly filled one after FLUSH_INTERVAL. When the writer falls behind
+    and no buffer is free, data is dropped and counted in dropped_bytes, so
+    a capture may have gaps but never slows down forwarding.
+    """
+    FLUSH_INTERVAL = 1.0
+    
+    def __init__(self, path: str, buffer_size: int = 256 * 1024, buffer_count: int = 8):
+        self.logger = Logger("SessionCapture")
+        self.path = path
+        self.origin = time.monotonic_ns()
+        self.records = 0
+        self.dropped_bytes = 0
+        self._free: List[bytearray] = [bytearray(buffer_size) for _ in range(buffer_count)]
+        self._full: Deque[Tuple[bytearray, int]] = deque()
+        self._current: Optional[bytearray] = None
+        self._used = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._write_failed = False
+        
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "ab")
+        self._file.write(FILE_HEADER.pack(MAGIC, time.time()))
+        self.thread = threading.Thread(target=self._write_loop, name="CaptureWriter", daemon=True)
+        self.thread.start()
+        self.logger.info(f"Capturing session to {path}")
+        
+    def record(self, direction: int, data: bytes):
+        """Append data forwarded in a direction, never blocks on I/O"""
+        timestamp = time.monotonic_ns() - self.origin
+        view = memoryview(data)
+        with self._cond:
+            if self._stopping:
+                return
+            while view:
+                if self._current is None:
+                    if not self._free:
+                        self.dropped_bytes += len(view)
+                        return
+                    self._current = self._free.pop()
+                    
+                # Data that doesn't fit is split into several records with the same timestamp
+                space = len(self._current) - self._used - RECORD.size
+                if space <= 0:
+                    self._hand_over()
+                    continue
+                chunk = view[:space]
+                RECORD.pack_into(self._current, self._used, timestamp, direction, len(chunk))
+                start = self._used + RECORD.size
+                self._current[start:start + len(chunk)] = chunk
+                self._used = start + len(chunk)
+                self.records += 1
+                view = view[len(chunk):]
+                
+    def _hand_over(self):
+        """Queue the current buffer for the writer, called with the lock held"""
+        self._full.append((self._current, self._used))
+        self._current = None
+        self._used = 0
+        self._cond.notify()
+        
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                if not self._full and not self._stopping:
+                    self._cond.wait(self.FLUSH_INTERVAL)
+                if not self._full and self._used:
+                    # Nothing filled up in time, write out what there is
+                    self._hand_over()
+                if not self._full:
+                    if self._stopping:
+                        return
+                    continue
+                buffer, used = self._full.popleft()
+                
+            if not self._write_failed:
+                try:
+                    self._file.write(memoryview(buffer)[:used])
+                    self._file.flush()
+                except OSError as e:
+                    self._write_failed = True
+                    self.logger.error(f"Failed to write capture to {self.path}: {e}")
+                    
+            with self._cond:
+                self._free.append(buffer)
+                
+    def close(self, timeout: float = 2.0):
+        """Write out the buffered data and close the file"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self.thread.join(timeout)
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        dropped = f", dropped {self.dropped_bytes} bytes" if self.dropped_bytes else ""
+        self.logger.info(f"Captured {self.records} records to {self.path}{dropped}")
+
+def read_capture(path: str) -> Iterator[CaptureRecord]:
+    """Read the records of a capture file in the order they were recorded"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < FILE_HEADER.size or FILE_HEADER.unpack_from(data)[0] != MAGIC:
+        raise ValueError(f"{path} is not a session capture")
+        
+    offset = FILE_HEADER.size
+    while offset + RECORD.size <= len(data):
+        timestamp, direction, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break  # Truncated by a crash or a full disk
+        yield CaptureRecord(timestamp, DIRECTIONS[direction], data[offset:offset + length])
+        offset += length
@@ -0,0 +1,147 @@
+import os
+import socket
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+from common import Logger
+from proxyHandler import ProxyHandler
+from proxyMetrics import merge_rendered, render_process_metrics
+from sessionTrace import SessionTracer
+
+@dataclass
+class Endpoint:
+    """An accessory endpoint and the handler forwarding its sessions"""
+    path: str
+    handler: ProxyHandler
+    client: str = ""  # Address of the connected client, empty while the endpoint is free
+    thread: Optional[threading.Thread] = None
+
+class SessionManager:
+    """Runs independent proxy sessions for several clients at once
+    
+    Every accessory endpoint has its own ProxyHandler, so the fds, threads,
+    metrics, trace and cleanup of one session never touch another. An accepted
+    client is mapped to the first free endpoint and served on its own
+    thread. A client arriving while every endpoint is busy is closed right
+    away, so it can retry instead of waiting on a session that may last
+    for hours.
+    """
+    BACKLOG = 64
+    
+    def __init__(self, endpoints: Sequence[str],
+                 handler_factory: Callable[[str], ProxyHandler] = ProxyHandler):
+        self.logger = Logger("SessionManager")
+        self.endpoints: List[Endpoint] = []
+        for path in endpoints:
+            handler = handler_factory(path)
+            handler.logger = Logger(f"ProxyHandler[{path}]")
+            handler.metrics.labels = {"endpoint": path}
+            # The shared tracer follows the daemon's sessions, which don't exist here
+            shared = SessionTracer.instance()
+            handler.tracer = SessionTracer(shared.path, labels={"endpoint": path})
+            self.endpoints.append(Endpoint(path, handler))
+        self.server_sock: Optional[socket.socket] = None
+        self.server_port: Optional[int] = None
+        self.accept_thread: Optional[threading.Thread] = None
+        self.should_exit = threading.Event()
+        self.rejected = 0
+        self._lock = threading.Lock()
+        
+    def start(self, port: int) -> Optional[threading.Thread]:
+        """Listen on port and serve clients until stop() is called"""
+        self.logger.info(f"Serving {len(self.endpoints)} endpoints on port {port}")
+        try:
+            server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_sock.bind(('', port))
+            server_sock.listen(self.BACKLOG)
+        except Exception as e:
+            self.logger.error(f"Failed to start server: {e}")
+            return None
+            
+        self.server_sock = server_sock
+        self.server_port = server_sock.getsockname()[1]
+        self.should_exit.clear()
+        self.accept_thread = threading.Thread(target=self._accept_loop, name="SessionManager")
+        self.accept_thread.start()
+        return self.accept_thread
+        
+    def _accept_loop(self):
+        while not self.should_exit.is_set():
+            try:
+                client_sock, client_addr = self.server_sock.accept()
+            except OSError as e:
+                if self.should_exit.is_set():
+                    break
+                self.logger.error(f"Accept failed: {e}")
+                continue
+                
+            client = f"{client_addr[0]}:{client_addr[1]}"
+            endpoint = self._claim(client)
+            if not endpoint:
+                self.rejected += 1
+                self.logger.error(f"All {len(self.endpoints)} endpoints are busy, closing connection from {client}")
+                client_sock.close()
+                continue
+                
+            self.logger.info(f"Session from {client} on {endpoint.path}")
+            endpoint.thread = threading.Thread(target=self._serve, args=(endpoint, client_sock),
+                                               name=f"Session {os.path.basename(endpoint.path)}")
+            endpoint.thread.start()
+            
+    def _claim(self, client: str) -> Optional[Endpoint]:
+        """Reserve the first free endpoint for a client"""
+        with self._lock:
+            for endpoint in self.endpoints:
+                if not endpoint.client:
+                    endpoint.client = client
+                    return endpoint
+        return None
+        
+    def _serve(self, endpoint: Endpoint, client_sock: socket.socket):
+        try:
+            endpoint.handler.serve_client(client_sock)
+        finally:
+            endpoint.handler.tracer.next_session()
+            self.logger.info(f"Session from {endpoint.client} on {endpoint.path} ended")
+            with self._lock:
+                endpoint.client = ""
+                
+    def active_sessions(self) -> Dict[str, str]:
+        """Get the client of each busy endpoint"""
+        with self._lock:
+            return {endpoint.path: endpoint.client for endpoint in self.endpoints if endpoint.client}
+            
+    def render_metrics(self) -> str:
+        """Render the metrics of all endpoints, told apart by an endpoint label"""
+        active = len(self.active_sessions())
+        own = "\n".join([
+            "# HELP aawg_sessions_active Sessions being forwarded",
+            "# TYPE aawg_sessions_active gauge",
+            f"aawg_sessions_active {active}",
+            "# HELP aawg_sessions_rejected_total Clients closed because every endpoint was busy",
+            "# TYPE aawg_sessions_rejected_total counter",
+            f"aawg_sessions_rejected_total {self.rejected}",
+        ]) + "\n"
+        # Process-wide series once, not once per endpoint
+        return merge_rendered([own, render_process_metrics()] +
+                              [endpoint.handler.metrics.render(process=False) for endpoint in self.endpoints])
+        
+    def stop(self):
+        """Stop accepting and end all sessions"""
+        self.should_exit.set()
+        if self.server_sock:
+            try:
+                self.server_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_sock.close()
+        if self.accept_thread:
+            self.accept_thread.join()
+            
+        for endpoint in self.endpoints:
+            endpoint.handler.stop_forwarding()
+        for endpoint in self.endpoints:
+            if endpoint.thread:
+                endpoint.thread.join()
@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from common import Logger, Config, SINGLETON_LOCK
+
+@dataclass(slots=True)
+class Span:
+    """One phase of a session, an instant if duration is 0"""
+    name: str
+    thread: str
+    start: float  # time.monotonic()
+    duration: float
+    args: Dict[str, Any] = field(default_factory=dict)
+
+@dataclass
+class SessionTimeline:
+    session: int
+    start: float  # time.monotonic() when the session began
+    wall_start: float  # time.time() at the same moment
+    spans: List[Span] = field(default_factory=list)
+
+class SessionTracer:
+    """Records when each phase of a session happens, shared by all handlers
+    
+    Spans and marks use the monotonic clock and may come from any thread.
+    The first session starts when the tracer is created, i.e. at power-on,
+    and next_session() closes a session by appending its timeline as one
+    JSON line to AAWG_TRACE_FILE. The last few timelines are kept in memory
+    for write_chrome_trace(), which renders them in the trace event format
+    understood by chrome://tracing and Perfetto. Labels are added to every
+    written timeline, e.g. to tell the endpoints of a SessionManager apart.
+    """
+    HISTORY = 16
+    
+    def __init__(self, path: str = "", chrome_path: str = "", labels: Optional[Dict[str, str]] = None):
+        self.logger = Logger("SessionTracer")
+        self.path = path
+        self.chrome_path = chrome_path
+        self.labels = labels or {}
+        self._lock = threading.Lock()
+        self.origin = time.monotonic()
+        self.current = SessionTimeline(1, self.origin, time.time())
+        self.history: Deque[SessionTimeline] = deque(maxlen=self.HISTORY)
+        
+    def record(self, name: str, start: float, end: Optional[float] = None, **args):
+        """Record a span that started at a time.monotonic() value and ends now or at end"""
+        if end is None:
+            end = time.monotonic()
+        span = Span(name, threading.current_thread().name, start, end - start, args)
+        with self._lock:
+            self.current.spans.append(span)
+            
+    def mark(self, name: str, **args):
+        """Record an instant, e.g. the first forwarded byte"""
+        now = time.monotonic()
+        self.record(name, now, now, **args)
+        
+    @contextmanager
+    def span(self, name: str, **args) -> Iterator[None]:
+        """Record the time spent in the with block"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, start, **args)
+            
+    def next_session(self):
+        """Close the current session's timeline and start the next one"""
+        now = time.monotonic()
+        with self._lock:
+            finished = self.current
+            self.current = SessionTimeline(finished.session + 1, now, time.time())
+            self.history.append(finished)
+        self._write_timeline(finished)
+        
+    def _write_timeline(self, timeline: SessionTimeline):
+        if not self.path:
+            return
+        line = json.dumps({
+            **self.labels,
+            "session": timeline.session,
+            "started": timeline.wall_start,
+            "spans": [{
+                "name": span.name,
+                "thread": span.thread,
+                "start_ms": round((span.start - timeline.start) * 1000, 3),
+                "duration_ms": round(span.duration * 1000, 3),
+                **({"args": span.args} if span.args else {}),
+            } for span in sorted(timeline.spans, key=lambda span: span.start)]
+        })
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+        except Exception as e:
+            self.logger.error(f"Failed to write session timeline to {self.path}: {e}")
+            
+    def write_chrome_trace(self, path: Optional[str] = None):
+        """Write the kept timelines and the current one as a Chrome trace event file"""
+        path = path or self.chrome_path
+        with self._lock:
+            timelines = list(self.history) + [self.current]
+            timelines[-1] = SessionTimeline(self.current.session, self.current.start,
+                                            self.current.wall_start, list(self.current.spans))
+                                            
+        events = []
+        thread_ids: Dict[str, int] = {}
+        for timeline in timelines:
+            # One process per session keeps them apart in the viewer
+            events.append({"name": "process_name", "ph": "M", "pid": timeline.session,
+                           "args": {"name": f"session {timeline.session}"}})
+            for span in timeline.spans:
+                tid = thread_ids.setdefault(span.thread, len(thread_ids) + 1)
+                event = {"name": span.name, "pid": timeline.session, "tid": tid,
+                         "ts": round((span.start - self.origin) * 1e6), "args": span.args}
+                if span.duration:
+                    event.update(ph="X", dur=round(span.duration * 1e6))
+                else:
+                    event.update(ph="i", s="t")
+                events.append(event)
+        for timeline in timelines:
+            for thread, tid in thread_ids.items():
+                events.append({"name": "thread_name", "ph": "M", "pid": timeline.session, "tid": tid,
+                               "args": {"name": thread}})
+                               
+        tmp_path = f"{path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+            os.replace(tmp_path, path)
+            self.logger.info(f"Wrote trace of {len(timelines)} sessions to {path}")
+        except Exception as e:
+            self.logger.error(f"Failed to write trace to {path}: {e}")
+            
+    @staticmethod
+    def instance():
+        """Get singleton instance"""
+        if not hasattr(SessionTracer, '_instance'):
+            with SINGLETON_LOCK:
+                if not hasattr(SessionTracer, '_instance'):
+                    SessionTracer._instance = SessionTracer(
+                        Config.instance().get_env("AAWG_TRACE_FILE", "/run/aawgd/sessions.jsonl"),
+                        Config.instance().get_env("AAWG_TRACE_CHROME_FILE", "/run/aawgd/trace.json")
+                    )
+        return SessionTracer._instance
@@ -0,0 +1,82 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Sequence
+
+from common import Logger
+from sessionTrace import SessionTracer
+
+@dataclass
+class StartupStep:
+    """One step of the daemon's startup and the steps it has to wait for"""
+    name: str
+    run: Callable[[], None]
+    requires: Sequence[str] = ()
+    start: float = 0.0
+    end: float = 0.0
+    error: str = ""
+
+class StartupGraph:
+    """Runs startup steps in parallel as soon as their prerequisites are done
+    
+    Steps can only require steps added before them, so the graph has no
+    cycles. A failing step is logged and its dependents still run, as they
+    did when startup was sequential. When everything is done, the chain of
+    steps that determined the total time is logged.
+    """
+    
+    def __init__(self, name: str = "Startup"):
+        self.logger = Logger("StartupGraph")
+        self.name = name
+        self.steps: Dict[str, StartupStep] = {}
+        
+    def add(self, name: str, run: Callable[[], None], requires: Sequence[str] = ()):
+        """Add a step that runs once all steps in requires are done"""
+        for required in requires:
+            if required not in self.steps:
+                raise ValueError(f"Startup step {name} requires unknown step {required}")
+        self.steps[name] = StartupStep(name, run, tuple(requires))
+        
+    def run(self) -> List[StartupStep]:
+        """Run all steps, returns the critical path"""
+        if not self.steps:
+            return []
+        started = time.monotonic()
+        pending = dict(self.steps)
+        done = set()
+        running: Dict[Future, StartupStep] = {}
+        
+        with ThreadPoolExecutor(max_workers=len(self.steps), thread_name_prefix=self.name) as pool:
+            while pending or running:
+                for step in [step for step in pending.values() if done.issuperset(step.requires)]:
+                    del pending[step.name]
+                    running[pool.submit(self._run_step, step)] = step
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done.add(running.pop(future).name)
+                    
+        path = self.critical_path()
+        total = max(step.end for step in self.steps.values()) - started
+        self.logger.info(f"{self.name} took {total * 1000:.1f} ms, critical path: " +
+                         " -> ".join(f"{step.name} ({(step.end - step.start) * 1000:.1f} ms)" for step in path))
+        return path
+        
+    def _run_step(self, step: StartupStep):
+        step.start = time.monotonic()
+        try:
+            step.run()
+        except Exception as e:
+            step.error = str(e)
+            self.logger.error(f"Startup step {step.name} failed: {e}")
+        finally:
+            step.end = time.monotonic()
+            SessionTracer.instance().record(step.name, step.start, step.end)
+            
+    def critical_path(self) -> List[StartupStep]:
+        """Get the chain of steps ending with the last one, each preceded by the prerequisite that finished last"""
+        step = max(self.steps.values(), key=lambda step: step.end)
+        path = [step]
+        while step.requires:
+            step = max((self.steps[name] for name in step.requires), key=lambda step: step.end)
+            path.append(step)
+        return path[::-1]
@@ -0,0 +1,100 @@
+import builtins
+import os
+import resource
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, TextIO
+
+# Imports only the standard library, so it can be installed before any other module is loaded
+
+def rss_kb() -> int:
+    """Get the resident set size of this process"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+@dataclass(slots=True)
+class ModuleImport:
+    """First import of one module, including the modules it imported"""
+    name: str
+    depth: int
+    time: float = 0.0
+    rss_kb: int = 0
+    children: List["ModuleImport"] = field(default_factory=list)
+    
+    @property
+    def self_time(self) -> float:
+        return self.time - sum(child.time for child in self.children)
+        
+    @property
+    def self_rss_kb(self) -> int:
+        return self.rss_kb - sum(child.rss_kb for child in self.children)
+
+class ImportProfiler:
+    """Measures the time and RSS that loading each module adds to startup
+    
+    Wraps the import statement while installed. Only the first import of a
+    module is recorded, since later ones just look it up in sys.modules.
+    Startup steps import from several threads, each has its own stack of
+    imports in progress. RSS is per process, so while threads import at the
+    same time their figures include each other's.
+    """
+    MIN_TIME = 0.001  # Imports below both thresholds are left out of the report
+    MIN_RSS_KB = 64
+    
+    def __init__(self):
+        self.imports: List[ModuleImport] = []
+        self._local = threading.local()
+        self._original_import = None
+        self.started = time.monotonic()
+        self.rss_at_start = rss_kb()
+        
+    @staticmethod
+    def install() -> "ImportProfiler":
+        profiler = ImportProfiler()
+        profiler._original_import = builtins.__import__
+        builtins.__import__ = profiler._import
+        return profiler
+        
+    def uninstall(self):
+        # Imports still running in other threads keep using _original_import
+        if builtins.__import__ == self._import:
+            builtins.__import__ = self._original_import
+            
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._original_import(name, globals, locals, fromlist, level)
+            
+        stack = self._local.__dict__.setdefault("stack", [])
+        module = ModuleImport(name, len(stack))
+        (stack[-1].children if stack else self.imports).append(module)
+        stack.append(module)
+        start, rss = time.perf_counter(), rss_kb()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            module.time = time.perf_counter() - start
+            module.rss_kb = rss_kb() - rss
+            stack.pop()
+            
+    def report(self, out: TextIO = sys.stdout, init_time: Optional[float] = None):
+        """Write the imports as a tree with their cumulative and own cost, then the totals"""
+        out.write(f"{'total ms':>9} {'self ms':>8} {'total KB':>9} {'self KB':>8}  module\n")
+        
+        def write(modules: List[ModuleImport]):
+            for module in modules:
+                if module.time < self.MIN_TIME and module.rss_kb < self.MIN_RSS_KB:
+                    continue
+                out.write(f"{module.time * 1000:9.1f} {module.self_time * 1000:8.1f} "
+                          f"{module.rss_kb:9} {module.self_rss_kb:8}  {'  ' * module.depth}{module.name}\n")
+                write(module.children)
+        write(self.imports)
+        
+        import_time = sum(module.time for module in self.imports)
+        out.write(f"Imports took {import_time * 1000:.1f} ms and {sum(module.rss_kb for module in self.imports)} KB\n")
+        if init_time is not None:
+            out.write(f"Initialization took {init_time * 1000:.1f} ms\n")
+        out.write(f"RSS is {rss_kb()} KB, {rss_kb() - self.rss_at_start} KB since the profiler was installed, "
+                  f"peak {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss} KB\n")
+        out.flush()
@@ -1,32 +1,149 @@
 import os
+import ctypes
+from concurrent.futures import Future
 import socket
 import struct
 import threading
-from typing import Optional, Dict, List, Callable
-from dataclasses import dataclass
+from typing import Optional, Dict, List, Callable, Sequence, Tuple, Set
+from dataclasses import dataclass, field
 
-from common import Logger
+from common import Logger, Config, SINGLETON_LOCK
 
 # Netlink constants
 NETLINK_KOBJECT_UEVENT = 15
 NETLINK_MSG_SIZE = 8 * 1024
 
-@dataclass
+# Socket filter constants, not exported by the socket module
+SO_ATTACH_FILTER = 26
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_JEQ_K = 0x15
+BPF_RET_K = 0x06
+BPF_MAX_JUMP = 255
+SOCK_FILTER = struct.Struct("HBBI")
+
+# Kernel uevents start with an ACTION@DEVPATH header. f_accessory reports
+# the head unit's accessory start request as a change of its misc device.
+ACCESSORY_UEVENT_PREFIX = "change@/devices/virtual/misc/usb_accessory"
+
+@dataclass(slots=True)
 class UeventEnv:
-    """Class to hold uevent environment variables"""
-    env_vars: Dict[str, str] = None
+    """Environment of one uevent, a value is only decoded when it is asked for"""
+    raw: bytes = b""
+    _values: Dict[str, Optional[str]] = field(default_factory=dict, repr=False)
     
-    def __post_init__(self):
-        if self.env_vars is None:
-            self.env_vars = {}
-            
+    @property
+    def header(self) -> str:
+        """The ACTION@DEVPATH line the kernel puts first"""
+        return self.raw.split(b'\0', 1)[0].decode('utf-8', 'replace')
+        
     def get(self, key: str, default: str = None) -> str:
-        return self.env_vars.get(key, default)
+        if key not in self._values:
+            self._values[key] = self._find(key)
+        value = self._values[key]
+        return default if value is None else value
+        
+    def _find(self, key: str) -> Optional[str]:
+        # Every variable follows a NUL, the header comes first
+        needle = b'\0' + key.encode() + b'='
+        start = self.raw.find(needle)
+        if start < 0:
+            return None
+        start += len(needle)
+        end = self.raw.find(b'\0', start)
+        try:
+            return self.raw[start:end if end >= 0 else len(self.raw)].decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+            
+    @property
+    def env_vars(self) -> Dict[str, str]:
+        """All variables, decodes the whole message"""
+        env_vars = {}
+        for part in self.raw.split(b'\0')[1:]:
+            key, sep, value = part.partition(b'=')
+            if not sep:
+                continue
+            try:
+                env_vars[key.decode('utf-8')] = value.decode('utf-8')
+            except UnicodeDecodeError:
+                continue
+        return env_vars
+
+def build_prefix_filter(prefixes: Sequence[bytes]) -> List[Tuple[int, int, int, int]]:
+    """Build a classic BPF program that accepts messages starting with one of the prefixes
+    
+    Each prefix is compared in big-endian words, then a half word and a
+    byte for the rest. A mismatch jumps to the next prefix, a message
+    matching none is dropped.
+    """
+    program = []
+    for prefix in prefixes:
+        chunks = []
+        offset = 0
+        for size, load in ((4, BPF_LD_W_ABS), (2, BPF_LD_H_ABS), (1, BPF_LD_B_ABS)):
+            while len(prefix) - offset >= size:
+                chunks.append((load, offset, int.from_bytes(prefix[offset:offset + size], "big")))
+                offset += size
+                if size < 4:
+                    break
+                    
+        # Two instructions per chunk, then the accept
+        remaining = 2 * len(chunks) + 1
+        if remaining > BPF_MAX_JUMP:
+            raise ValueError(f"Uevent filter prefix too long: {prefix!r}")
+        for load, offset, value in chunks:
+            program.append((load, 0, 0, offset))
+            remaining -= 2
+            program.append((BPF_JEQ_K, 0, remaining, value))
+        program.append((BPF_RET_K, 0, 0, 0xffffffff))
+    program.append((BPF_RET_K, 0, 0, 0))
+    return program
+
+def attach_filter(sock: socket.socket, program: List[Tuple[int, int, int, int]]):
+    """Attach a classic BPF program to a socket, the kernel keeps its own copy"""
+    instructions = b"".join(SOCK_FILTER.pack(*instruction) for instruction in program)
+    buffer = ctypes.create_string_buffer(instructions, len(instructions))
+    # struct sock_fprog, padded to the pointer's alignment
+    fprog = struct.pack("HL", len(program), ctypes.addressof(buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+# Variables tried in order to pick the one a subscription is indexed by, most selective first
+INDEX_KEYS = ("DEVNAME", "DEVPATH", "SUBSYSTEM", "ACTION")
+
+@dataclass(eq=False)
+class UeventSubscription:
+    """Callback for the uevents whose variables equal all of match"""
+    match: Dict[str, str]
+    callback: Callable[[UeventEnv], None]
+    once: bool = False
+    active: bool = True
+    
+    @property
+    def index_key(self) -> Optional[Tuple[str, str]]:
+        for key in INDEX_KEYS + tuple(sorted(self.match)):
+            if key in self.match:
+                return key, self.match[key]
+        return None
+        
+    def matches(self, env: UeventEnv) -> bool:
+        return all(env.get(key) == value for key, value in self.match.items())
 
 class UeventHandler:
-    def __init__(self):
+    def __init__(self, prefixes: Optional[List[str]] = None):
         self.logger = Logger("UeventHandler")
-        self.handlers: List[Callable[[UeventEnv], bool]] = []
+        # Subscriptions by the (variable, value) pair they are indexed by,
+        # those without a predicate are called for every uevent
+        self._index: Dict[Tuple[str, str], List[UeventSubscription]] = {}
+        self._index_keys: Set[str] = set()
+        self._unindexed: List[UeventSubscription] = []
+        self._lock = threading.Lock()
+        if prefixes is None:
+            prefixes = [prefix for prefix in Config.instance().get_env(
+                "AAWG_UEVENT_FILTER", ACCESSORY_UEVENT_PREFIX).split(",") if prefix]
+        # Only uevents starting with one of these reach the handlers, all of them if empty
+        self.prefixes: Tuple[bytes, ...] = tuple(prefix.encode() for prefix in prefixes)
         self.running = False
         self.monitor_thread: Optional[threading.Thread] = None
         
@@ -35,18 +152,7 @@ class UeventHandler:
         self.logger.info("Starting uevent monitoring")
         
         try:
-            # Create netlink socket
-            sock = socket.socket(
-                socket.AF_NETLINK,
-                socket.SOCK_DGRAM | socket.SOCK_CLOEXEC,
-                NETLINK_KOBJECT_UEVENT
-            )
-            
-            # Bind the socket
-            sock.bind((os.getpid(), -1))
-            
-            # Set socket options
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_PASSCRED, 1)
+            sock = self.open_socket()
             
             self.running = True
             self.monitor_thread = threading.Thread(
@@ -62,6 +168,31 @@ class UeventHandler:
             self.logger.error(f"Failed to start uevent monitoring: {e}")
             return None
             
+    def open_socket(self) -> socket.socket:
+        """Open a netlink socket subscribed to kernel uevents"""
+        # Create netlink socket
+        sock = socket.socket(
+            socket.AF_NETLINK,
+            socket.SOCK_DGRAM | socket.SOCK_CLOEXEC,
+            NETLINK_KOBJECT_UEVENT
+        )
+        
+        # Bind the socket
+        sock.bind((os.getpid(), -1))
+        
+        # Set socket options
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_PASSCRED, 1)
+        
+        # Let the kernel drop the uevents nobody listens to, e.g. during
+        # hot-plug storms, instead of waking up for each of them
+        if self.prefixes:
+            try:
+                attach_filter(sock, build_prefix_filter(self.prefixes))
+                self.logger.info(f"Filtering uevents in the kernel: {', '.join(p.decode() for p in self.prefixes)}")
+            except (OSError, ValueError) as e:
+                self.logger.error(f"Failed to attach uevent filter, filtering in userspace: {e}")
+        return sock
+        
     def _monitor_loop(self, sock: socket.socket):
         """Main monitoring loop for uevent messages"""
         while self.running:
@@ -71,11 +202,7 @@ class UeventHandler:
                 if not msg:
                     continue
                     
-                # Parse the message
-                env_map = self._parse_uevent_message(msg)
-                
-                # Process handlers
-                self._process_handlers(env_map)
+                self.handle_message(msg)
                 
             except Exception as e:
                 if self.running:  # Only log if we're still supposed to be running
@@ -83,53 +210,91 @@ class UeventHandler:
                     
         sock.close()
         
-    def _parse_uevent_message(self, msg: bytes) -> UeventEnv:
-        """Parse a uevent message into environment variables"""
-        env_map = UeventEnv()
+    def handle_message(self, msg: bytes):
+        """Pass a netlink message to the registered handlers"""
+        # Also covers a socket without the kernel filter
+        if not (self._index or self._unindexed) or (self.prefixes and not msg.startswith(self.prefixes)):
+            return
+            
+        self.dispatch(UeventEnv(msg))
         
-        try:
-            # Split message into null-terminated strings
-            parts = msg.split(b'\0')
+    def dispatch(self, env: UeventEnv):
+        """Call the subscriptions matching a uevent"""
+        with self._lock:
+            index_keys = list(self._index_keys)
+            candidates = list(self._unindexed)
             
-            # Process each part
-            for part in parts:
-                if not part:  # Skip empty parts
-                    continue
-                    
-                # Decode the part
-                try:
-                    decoded = part.decode('utf-8')
-                except UnicodeDecodeError:
-                    continue
-                    
-                # Split into key-value if possible
-                if '=' in decoded:
-                    key, value = decoded.split('=', 1)
-                    env_map.env_vars[key] = value
+        # Only the indexed variables are decoded to find the candidates
+        for key in index_keys:
+            value = env.get(key)
+            if value is not None:
+                with self._lock:
+                    candidates.extend(self._index.get((key, value), ()))
                     
-        except Exception as e:
-            self.logger.error(f"Error parsing uevent message: {e}")
-            
-        return env_map
-        
-    def _process_handlers(self, env_map: UeventEnv):
-        """Process all registered handlers with the uevent"""
-        # Create a copy of handlers to avoid modification during iteration
-        handlers = self.handlers.copy()
-        
-        # Process each handler
-        for handler in handlers:
+        for subscription in candidates:
+            if not subscription.active or not subscription.matches(env):
+                continue
+            # A one-shot subscription fires once, even with concurrent dispatches
+            if subscription.once and not self._remove(subscription):
+                continue
             try:
-                if handler(env_map):
-                    # If handler returns True, remove it
-                    try:
-                        self.handlers.remove(handler)
-                    except ValueError:
-                        # Handler might have been removed by another thread
-                        pass
+                subscription.callback(env)
             except Exception as e:
                 self.logger.error(f"Error in uevent handler: {e}")
                 
+    def subscribe(self, callback: Callable[[UeventEnv], None], once: bool = False,
+                  **match: str) -> UeventSubscription:
+        """Call callback for every uevent whose variables equal match, or only the first if once
+        
+        e.g. subscribe(callback, DEVNAME="usb_accessory", ACCESSORY="START")
+        """
+        subscription = UeventSubscription(match, callback, once)
+        key = subscription.index_key
+        with self._lock:
+            if key is None:
+                self._unindexed.append(subscription)
+            else:
+                self._index.setdefault(key, []).append(subscription)
+                self._index_keys.add(key[0])
+        return subscription
+        
+    def unsubscribe(self, subscription: UeventSubscription):
+        """Stop calling a subscription, does nothing if it is already gone"""
+        self._remove(subscription)
+        
+    def _remove(self, subscription: UeventSubscription) -> bool:
+        """Remove a subscription, returns False if it was removed before"""
+        key = subscription.index_key
+        with self._lock:
+            if not subscription.active:
+                return False
+            subscription.active = False
+            if key is None:
+                self._unindexed.remove(subscription)
+                return True
+            bucket = self._index[key]
+            bucket.remove(subscription)
+            if not bucket:
+                del self._index[key]
+                if not any(index_key[0] == key[0] for index_key in self._index):
+                    self._index_keys.discard(key[0])
+            return True
+            
+    def wait_for(self, **match: str) -> Future:
+        """Get a future resolved with the next uevent whose variables equal match
+        
+        Cancelling the future removes the subscription. Use asyncio.wrap_future() to await it.
+        """
+        future: Future = Future()
+        
+        def resolve(env: UeventEnv):
+            if future.set_running_or_notify_cancel():
+                future.set_result(env)
+                
+        subscription = self.subscribe(resolve, once=True, **match)
+        future.add_done_callback(lambda f: self.unsubscribe(subscription))
+        return future
+        
     def add_handler(self, handler: Callable[[UeventEnv], bool]):
         """Add a new uevent handler
         
@@ -137,7 +302,11 @@ class UeventHandler:
             handler: Callback function that takes a UeventEnv and returns bool.
                     Return True to remove the handler, False to keep it.
         """
-        self.handlers.append(handler)
+        def callback(env: UeventEnv):
+            if handler(env):
+                self.unsubscribe(subscription)
+                
+        subscription = self.subscribe(callback)
         
     def stop(self):
         """Stop the uevent monitoring"""
@@ -145,6 +314,15 @@ class UeventHandler:
         if self.monitor_thread and self.monitor_thread.is_alive():
             self.monitor_thread.join()
             
+    @staticmethod
+    def instance():
+        """Get singleton instance"""
+        if not hasattr(UeventHandler, '_instance'):
+            with SINGLETON_LOCK:
+                if not hasattr(UeventHandler, '_instance'):
+                    UeventHandler._instance = UeventHandler()
+        return UeventHandler._instance
+        
     def __del__(self):
         """Ensure resources are cleaned up"""
         self.stop()
@@ -1,14 +1,17 @@
 import os
+import errno
+import select
 import time
-import threading
-from typing import Optional
+from concurrent.futures import Future, TimeoutError, CancelledError
+from typing import Optional, Dict, Iterable
 from pathlib import Path
 import glob
 from dataclasses import dataclass
 from datetime import timedelta
 
-from common import Logger
-from uevent import UeventHandler, UeventEnv
+from common import Logger, Config, SINGLETON_LOCK
+from uevent import UeventHandler
+from sessionTrace import SessionTracer
 
 @dataclass
 class UsbGadgetConfig:
@@ -17,23 +20,139 @@ class UsbGadgetConfig:
     GADGET_CONFIG_PATH = "/sys/kernel/config/usb_gadget"
     UDC_CLASS_PATH = "/sys/class/udc"
 
+# UDC states in which no gadget is bound to the host anymore. An unknown
+# state, e.g. an unreadable state file, never counts as detached
+UDC_DETACHED_STATES = ("not attached",)
+# Shortest time between unbinding the default gadget and binding the accessory
+# gadget, the UDC may report the detach before the host has handled it
+MIN_SWITCH_DELAY = 0.02
+
+class GadgetManager:
+    """Binds the gadgets set up in configfs by S92usb_gadget to the UDC
+    
+    stage() checks the gadget trees once and keeps their UDC attributes and
+    the UDC's state attribute open, so binding a gadget is a single write
+    and reading the state a single read.
+    """
+    STATE_POLL_INTERVAL = 0.01
+    
+    def __init__(self, gadget_path: str, udc_class_path: str):
+        self.logger = Logger("GadgetManager")
+        self.gadget_path = Path(gadget_path)
+        self.udc_class_path = Path(udc_class_path)
+        self.udc_fds: Dict[str, int] = {}
+        self.state_fd = -1
+        
+    def stage(self, gadget_names: Iterable[str], udc_name: Optional[str]) -> bool:
+        """Validate the gadget trees and open their UDC attributes, returns False if one is unusable"""
+        staged = True
+        for name in gadget_names:
+            gadget_dir = self.gadget_path / name
+            configs = list(gadget_dir.glob("configs/*/*.*"))
+            if not configs:
+                self.logger.error(f"Gadget {name} has no function linked in {gadget_dir}/configs")
+                staged = False
+            try:
+                self.udc_fds[name] = self._open_udc_file(name)
+            except OSError as e:
+                self.logger.error(f"Gadget {name} can't be bound: {e}")
+                staged = False
+                
+        if udc_name:
+            try:
+                self.state_fd = os.open(self.udc_class_path / udc_name / "state", os.O_RDONLY | os.O_CLOEXEC)
+            except OSError as e:
+                self.logger.error(f"Can't open the state of UDC {udc_name}: {e}")
+        return staged
+        
+    def _open_udc_file(self, name: str) -> int:
+        return os.open(self.gadget_path / name / "UDC", os.O_WRONLY | os.O_CLOEXEC)
+        
+    def set_udc(self, name: str, udc_name: str):
+        """Bind a gadget to a UDC, or unbind it with an empty name"""
+        fd = self.udc_fds.get(name)
+        if fd is None:
+            # Not staged, e.g. the tree appeared after init
+            fd = self.udc_fds[name] = self._open_udc_file(name)
+        data = (udc_name + "\n").encode()
+        os.pwrite(fd, data, 0)
+        try:
+            # configfs ignores it, a regular file in a fake configfs would keep stale bytes
+            os.ftruncate(fd, len(data))
+        except OSError:
+            pass
+            
+    def udc_state(self) -> str:
+        """Get the UDC state, empty if unknown"""
+        if self.state_fd < 0:
+            return ""
+        try:
+            return os.pread(self.state_fd, 64, 0).decode().strip()
+        except OSError:
+            return ""
+        
+    def wait_for_state(self, states: Iterable[str], timeout: float) -> bool:
+        """Wait until the UDC reaches one of the states, returns False on timeout
+        
+        The kernel notifies state changes with sysfs_notify(), which wakes a
+        poll for POLLPRI. The poll is capped at STATE_POLL_INTERVAL, which
+        covers files that never notify, like those of a fake configfs.
+        """
+        states = tuple(states)
+        deadline = time.monotonic() + timeout
+        poller = None
+        if self.state_fd >= 0:
+            poller = select.poll()
+            poller.register(self.state_fd, select.POLLPRI | select.POLLERR)
+            
+        while True:
+            if self.udc_state() in states:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            wait = min(remaining, self.STATE_POLL_INTERVAL)
+            if poller:
+                poller.poll(wait * 1000)
+            else:
+                time.sleep(wait)
+                
+    def close(self):
+        for fd in list(self.udc_fds.values()) + [self.state_fd]:
+            if fd >= 0:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.udc_fds.clear()
+        self.state_fd = -1
+
 class UsbHandler:
-    def __init__(self):
+    def __init__(self, gadget_path: Optional[str] = None, udc_class_path: Optional[str] = None):
         self.logger = Logger("UsbHandler")
         self.udc_name: Optional[str] = None
         self.gadget_enabled = False
-        self.accessory_promise: Optional[threading.Event] = None
+        self.accessory_promise: Optional[Future] = None
+        # Both paths can point to a fake configfs and sysfs, e.g. for testing
+        self.udc_class_path = udc_class_path or Config.instance().get_env("AAWG_USB_UDC_PATH", UsbGadgetConfig.UDC_CLASS_PATH)
+        self.gadgets = GadgetManager(
+            gadget_path or Config.instance().get_env("AAWG_USB_GADGET_PATH", UsbGadgetConfig.GADGET_CONFIG_PATH),
+            self.udc_class_path
+        )
+        
+    @property
+    def switch_timeout(self) -> float:
+        """Upper bound for the host to see the default gadget go away before the accessory gadget appears"""
+        # Read on every switch, so a reloaded configuration applies to the next one
+        return Config.instance().get_env("AAWG_USB_SWITCH_TIMEOUT_MS", 100) / 1000
         
     def init(self):
         """Initialize USB handler"""
         self.logger.info("Initializing USB Handler")
         
-        # Disable any active gadgets first
-        self.disable_gadget()
-        
         # Find UDC name
         try:
-            udc_paths = glob.glob(f"{UsbGadgetConfig.UDC_CLASS_PATH}/*")
+            udc_paths = glob.glob(f"{self.udc_class_path}/*")
             for udc_path in udc_paths:
                 name = os.path.basename(udc_path)
                 if name.startswith('.'):
@@ -49,15 +168,12 @@ class UsbHandler:
         except Exception as e:
             self.logger.error(f"Error initializing USB handler: {e}")
             
-    def _write_gadget_file(self, gadget_name: str, relative_path: str, content: str):
-        """Write content to a gadget file"""
-        try:
-            file_path = Path(UsbGadgetConfig.GADGET_CONFIG_PATH) / gadget_name / relative_path
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            file_path.write_text(content + '\n')
-        except Exception as e:
-            self.logger.error(f"Error writing to gadget file {file_path}: {e}")
+        if self.gadgets.stage([UsbGadgetConfig.DEFAULT_GADGET, UsbGadgetConfig.ACCESSORY_GADGET], self.udc_name):
+            self.logger.info("USB gadgets staged")
             
+        # Disable any active gadgets first
+        self.disable_gadget()
+        
     def enable_gadget(self, gadget_name: str):
         """Enable a USB gadget"""
         if not self.udc_name:
@@ -65,7 +181,7 @@ class UsbHandler:
             return
             
         try:
-            self._write_gadget_file(gadget_name, "UDC", self.udc_name)
+            self.gadgets.set_udc(gadget_name, self.udc_name)
             self.gadget_enabled = True
             self.logger.info(f"Enabled gadget: {gadget_name}")
         except Exception as e:
@@ -73,29 +189,44 @@ class UsbHandler:
             
     def disable_gadget(self, gadget_name: Optional[str] = None):
         """Disable a USB gadget or all gadgets if no name specified"""
-        try:
-            if gadget_name:
-                self._write_gadget_file(gadget_name, "UDC", "")
-                self.logger.info(f"Disabled gadget: {gadget_name}")
-            else:
-                # Disable all gadgets
-                self._write_gadget_file(UsbGadgetConfig.DEFAULT_GADGET, "UDC", "")
-                self._write_gadget_file(UsbGadgetConfig.ACCESSORY_GADGET, "UDC", "")
-                self.logger.info("Disabled all USB gadgets")
-            self.gadget_enabled = False
-        except Exception as e:
-            self.logger.error(f"Error disabling gadget(s): {e}")
+        names = [gadget_name] if gadget_name else [UsbGadgetConfig.DEFAULT_GADGET, UsbGadgetConfig.ACCESSORY_GADGET]
+        for name in names:
+            try:
+                self.gadgets.set_udc(name, "")
+            except OSError as e:
+                # Unbinding a gadget that isn't bound fails with ENODEV
+                if e.errno != errno.ENODEV:
+                    self.logger.error(f"Error disabling gadget {name}: {e}")
+        self.gadget_enabled = False
+        self.logger.info(f"Disabled gadget: {gadget_name}" if gadget_name else "Disabled all USB gadgets")
             
     def switch_to_accessory_gadget(self):
         """Switch from default to accessory gadget"""
         try:
-            self.disable_gadget(UsbGadgetConfig.DEFAULT_GADGET)
-            time.sleep(0.1)  # 100ms delay to let host recognize the change
-            self.enable_gadget(UsbGadgetConfig.ACCESSORY_GADGET)
+            with SessionTracer.instance().span("usb_switch_to_accessory"):
+                self.disable_gadget(UsbGadgetConfig.DEFAULT_GADGET)
+                unbound = time.monotonic()
+                # Let the host recognize the change before the accessory appears
+                if not self.gadgets.wait_for_state(UDC_DETACHED_STATES, self.switch_timeout):
+                    self.logger.info(f"UDC still {self.get_udc_state() or 'unknown'} "
+                                     f"after {self.switch_timeout * 1000:.0f} ms")
+                time.sleep(max(0.0, unbound + MIN_SWITCH_DELAY - time.monotonic()))
+                self.enable_gadget(UsbGadgetConfig.ACCESSORY_GADGET)
             self.logger.info("Switched to accessory gadget from default")
         except Exception as e:
             self.logger.error(f"Error switching to accessory gadget: {e}")
             
+    def get_udc_state(self) -> str:
+        """Get the state of the UDC as reported by the kernel, e.g. configured or not attached"""
+        if not self.udc_name:
+            return ""
+            
+        try:
+            return self.gadgets.udc_state()
+        except Exception as e:
+            self.logger.error(f"Error reading UDC state: {e}")
+            return ""
+            
     def enable_default_and_wait_for_accessory(self, timeout: Optional[timedelta] = None) -> bool:
         """Enable default gadget and wait for accessory mode request
         
@@ -105,37 +236,36 @@ class UsbHandler:
         Returns:
             bool: True if accessory mode was requested, False if timeout occurred
         """
-        self.accessory_promise = threading.Event()
-        
-        def accessory_handler(env: UeventEnv) -> bool:
-            if (env.get("DEVNAME") == "usb_accessory" and 
-                env.get("ACCESSORY") == "START"):
-                self.logger.info("Received accessory start request")
-                self.switch_to_accessory_gadget()
-                self.accessory_promise.set()
-                return True
-            return False
-            
-        UeventHandler().instance().add_handler(accessory_handler)
+        self.accessory_promise = UeventHandler.instance().wait_for(DEVNAME="usb_accessory", ACCESSORY="START")
         
         self.enable_gadget(UsbGadgetConfig.DEFAULT_GADGET)
         self.logger.info("Enabled default gadget")
         
-        if timeout is None:
-            self.accessory_promise.wait()
-            return True
-        else:
-            return self.accessory_promise.wait(timeout.total_seconds())
+        try:
+            self.accessory_promise.result(None if timeout is None else timeout.total_seconds())
+        except TimeoutError:
+            self.accessory_promise.cancel()
+            return False
+        except CancelledError:
+            return False
+            
+        self.logger.info("Received accessory start request")
+        SessionTracer.instance().mark("accessory_start_request")
+        self.switch_to_accessory_gadget()
+        return True
             
     def cleanup(self):
         """Clean up resources"""
         self.disable_gadget()
+        self.gadgets.close()
         if self.accessory_promise:
-            self.accessory_promise.set()  # Unblock any waiting threads
+            self.accessory_promise.cancel()  # Unblock any waiting threads
             
     @staticmethod
     def instance():
         """Get singleton instance"""
         if not hasattr(UsbHandler, '_instance'):
-            UsbHandler._instance = UsbHandler()
+            with SINGLETON_LOCK:
+                if not hasattr(UsbHandler, '_instance'):
+                    UsbHandler._instance = UsbHandler()
         return UsbHandler._instance
@@ -0,0 +1,251 @@
+import os
+import struct
+import time
+from dataclasses import dataclass
+from enum import Enum, IntEnum
+from typing import Callable, Dict, Optional
+
+import dbus
+import dbus.service
+from gi.repository import GLib
+
+from common import Logger, WifiInfo, SecurityMode
+from sessionTrace import SessionTracer
+import WifiInfoResponse_pb2
+import WifiStartRequest_pb2  # Generated from proto/WifiStartRequest.proto at build time
+
+PROFILE_INTERFACE = "org.bluez.Profile1"
+
+# Every message is a big-endian payload length and message id followed by the protobuf payload
+HEADER = struct.Struct(">HH")
+
+class MessageId(IntEnum):
+    WIFI_START_REQUEST = 1
+    WIFI_INFO_REQUEST = 2
+    WIFI_INFO_RESPONSE = 3
+    WIFI_VERSION_REQUEST = 4
+    WIFI_VERSION_RESPONSE = 5
+    WIFI_CONNECT_STATUS = 6
+    WIFI_START_RESPONSE = 7
+
+# Our SecurityMode values don't match the protocol's, e.g. WPA2_PERSONAL is 8 on the wire
+PROTO_SECURITY_MODES: Dict[SecurityMode, str] = {
+    SecurityMode.NONE: "OPEN",
+    SecurityMode.WEP: "WEP_128",
+    SecurityMode.WPA_PERSONAL: "WPA_PERSONAL",
+    SecurityMode.WPA2_PERSONAL: "WPA2_PERSONAL",
+}
+
+class HandshakeState(Enum):
+    WAIT_INFO_REQUEST = "wait_info_request"
+    WAIT_START_RESPONSE = "wait_start_response"
+    WAIT_CONNECT_STATUS = "wait_connect_status"
+    DONE = "done"
+    FAILED = "failed"
+
+def encode_message(message_id: MessageId, payload: bytes) -> bytes:
+    """Frame a serialized protobuf message"""
+    return HEADER.pack(len(payload), message_id) + payload
+
+def encode_start_request(wifi_info: WifiInfo) -> bytes:
+    """Tell the phone where to connect to once it joined the access point"""
+    request = WifiStartRequest_pb2.WifiStartRequest(ip_address=wifi_info.ip_address, port=wifi_info.port)
+    return encode_message(MessageId.WIFI_START_REQUEST, request.SerializeToString())
+
+def encode_info_response(wifi_info: WifiInfo) -> bytes:
+    """Give the phone the credentials of the access point"""
+    response = WifiInfoResponse_pb2.WifiInfoResponse(
+        ssid=wifi_info.ssid,
+        key=wifi_info.key,
+        bssid=wifi_info.bssid,
+        security_mode=WifiInfoResponse_pb2.SecurityMode.Value(PROTO_SECURITY_MODES[wifi_info.security_mode]),
+        access_point_type=WifiInfoResponse_pb2.AccessPointType.Value(wifi_info.access_point_type.name)
+    )
+    return encode_message(MessageId.WIFI_INFO_RESPONSE, response.SerializeToString())
+
+class WifiHandshake:
+    """The Wi-Fi credential exchange on one RFCOMM connection
+    
+    We send the start request, answer the phone's info request with the
+    credentials and then wait for its start response and connect status.
+    The fd is non-blocking, handle_readable() and handle_writable() are
+    called whenever it is ready and never block.
+    """
+    READ_SIZE = 4096
+    
+    # What each state waits for, and the state and reply that follow it
+    TRANSITIONS = {
+        HandshakeState.WAIT_INFO_REQUEST: (MessageId.WIFI_INFO_REQUEST, HandshakeState.WAIT_START_RESPONSE, True),
+        HandshakeState.WAIT_START_RESPONSE: (MessageId.WIFI_START_RESPONSE, HandshakeState.WAIT_CONNECT_STATUS, False),
+        HandshakeState.WAIT_CONNECT_STATUS: (MessageId.WIFI_CONNECT_STATUS, HandshakeState.DONE, False),
+    }
+    
+    def __init__(self, fd: int, start_request: bytes, info_response: bytes):
+        self.logger = Logger("WifiHandshake")
+        self.fd = fd
+        self.info_response = info_response
+        self.state = HandshakeState.WAIT_INFO_REQUEST
+        self.outgoing = bytearray(start_request)
+        self.incoming = bytearray()
+        self.started = time.monotonic()
+        os.set_blocking(fd, False)
+        
+    @property
+    def finished(self) -> bool:
+        return self.state in (HandshakeState.DONE, HandshakeState.FAILED)
+        
+    def handle_writable(self):
+        """Write as much of the pending output as the socket takes"""
+        try:
+            while self.outgoing:
+                del self.outgoing[:os.write(self.fd, self.outgoing)]
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self.fail(f"write failed: {e}")
+            
+    def handle_readable(self):
+        """Read what arrived and advance through the exchange"""
+        try:
+            while not self.finished:
+                data = os.read(self.fd, self.READ_SIZE)
+                if not data:
+                    self.fail("connection closed by the phone")
+                    return
+                self.incoming += data
+                self._process_messages()
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self.fail(f"read failed: {e}")
+            
+    def _process_messages(self):
+        while len(self.incoming) >= HEADER.size and not self.finished:
+            length, message_id = HEADER.unpack_from(self.incoming)
+            if len(self.incoming) < HEADER.size + length:
+                return
+            payload = bytes(self.incoming[HEADER.size:HEADER.size + length])
+            del self.incoming[:HEADER.size + length]
+            self._handle_message(message_id, payload)
+            
+    def _handle_message(self, message_id: int, payload: bytes):
+        expected, next_state, reply = self.TRANSITIONS[self.state]
+        if message_id != expected:
+            self.logger.info(f"Ignoring message {message_id} with {len(payload)} bytes while in state {self.state.value}")
+            return
+            
+        self.logger.info(f"Received {MessageId(message_id).name} after {self._elapsed_ms():.1f} ms")
+        self.state = next_state
+        if reply:
+            self.outgoing += self.info_response
+            self.handle_writable()
+        if self.state == HandshakeState.DONE:
+            self.logger.info(f"Wi-Fi handshake completed in {self._elapsed_ms():.1f} ms")
+            
+    def fail(self, reason: str):
+        """Abort the exchange"""
+        self.logger.error(f"Wi-Fi handshake failed in state {self.state.value} after {self._elapsed_ms():.1f} ms: {reason}")
+        self.state = HandshakeState.FAILED
+        
+    def _elapsed_ms(self) -> float:
+        return (time.monotonic() - self.started) * 1000
+        
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+@dataclass
+class HandshakeConnection:
+    """GLib sources driving one handshake"""
+    handshake: WifiHandshake
+    io_source: Optional[int] = None
+    timeout_source: Optional[int] = None
+    writing: bool = False  # Whether io_source also watches for output space
+
+class WifiHandshakeProfile(dbus.service.Object):
+    """org.bluez.Profile1 implementation of the AA Wireless RFCOMM profile
+    
+    The replies only depend on the Wi-Fi configuration, so they are
+    serialized once and every connection reuses the same bytes. Connections
+    are driven by GLib io watches on the main loop thread.
+    """
+    
+    def __init__(self, bus: dbus.Bus, path: str, wifi_info: WifiInfo, timeout: float = 15):
+        self.logger = Logger("WifiHandshakeProfile")
+        self.path = path
+        self.timeout = timeout
+        self.set_wifi_info(wifi_info)
+        self.on_finished: Optional[Callable[[bool], None]] = None
+        super().__init__(bus, path)
+        
+    def set_wifi_info(self, wifi_info: WifiInfo):
+        """Serialize the replies for new connections, running handshakes keep the old ones"""
+        self.wifi_info = wifi_info
+        self.start_request = encode_start_request(wifi_info)
+        self.info_response = encode_info_response(wifi_info)
+        
+    @dbus.service.method(PROFILE_INTERFACE, in_signature="", out_signature="")
+    def Release(self):
+        self.logger.info(f"Profile {self.path} released")
+        
+    @dbus.service.method(PROFILE_INTERFACE, in_signature="oha{sv}", out_signature="")
+    def NewConnection(self, device: str, fd: dbus.UnixFd, properties: Dict):
+        self.logger.info(f"New RFCOMM connection from {device}")
+        handshake = WifiHandshake(fd.take(), self.start_request, self.info_response)
+        self._start(handshake)
+        
+    @dbus.service.method(PROFILE_INTERFACE, in_signature="o", out_signature="")
+    def RequestDisconnection(self, device: str):
+        self.logger.info(f"Disconnection requested by {device}")
+        
+    def _start(self, handshake: WifiHandshake):
+        # Most of the time the start request fits into the socket buffer right away
+        handshake.handle_writable()
+        connection = HandshakeConnection(handshake)
+        connection.timeout_source = GLib.timeout_add(int(self.timeout * 1000), self._on_timeout, connection)
+        self._watch(connection)
+        
+    def _watch(self, connection: HandshakeConnection):
+        """Watch for input, and for output space while there is something left to write"""
+        condition = GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR
+        connection.writing = bool(connection.handshake.outgoing)
+        if connection.writing:
+            condition |= GLib.IOCondition.OUT
+        connection.io_source = GLib.io_add_watch(connection.handshake.fd, GLib.PRIORITY_DEFAULT, condition,
+                                                 self._on_io, connection)
+                                                 
+    def _on_io(self, fd: int, condition: GLib.IOCondition, connection: HandshakeConnection) -> bool:
+        handshake = connection.handshake
+        if condition & GLib.IOCondition.OUT:
+            handshake.handle_writable()
+        if condition & GLib.IOCondition.IN:
+            handshake.handle_readable()
+        elif condition & (GLib.IOCondition.HUP | GLib.IOCondition.ERR):
+            handshake.fail("connection lost")
+            
+        if handshake.finished:
+            connection.io_source = None
+            self._finish(connection)
+            return False
+        if connection.writing != bool(handshake.outgoing):
+            self._watch(connection)
+            return False  # Replaced by the new watch
+        return True
+        
+    def _on_timeout(self, connection: HandshakeConnection) -> bool:
+        connection.timeout_source = None
+        connection.handshake.fail(f"timed out after {self.timeout}s")
+        self._finish(connection)
+        return False
+        
+    def _finish(self, connection: HandshakeConnection):
+        for source in (connection.io_source, connection.timeout_source):
+            if source is not None:
+                GLib.source_remove(source)
+        connection.handshake.close()
+        SessionTracer.instance().record("wifi_handshake", connection.handshake.started,
+                                        completed=connection.handshake.state == HandshakeState.DONE)
+        if self.on_finished:
+            self.on_finished(connection.handshake.state == HandshakeState.DONE)